@@ -45,10 +45,22 @@ from Bio.Blast import NCBIWWW
 from Bio.Blast import NCBIXML
 from Bio import Entrez
 import xml.etree.ElementTree as ET
+from multiprocessing.pool import ThreadPool
 import re
+import csv
+import threading
+import urlparse
+import HTMLParser
 import difflib
 import logging
+import dill
 import filename_generator
+import CoregFilesIO
+import TaxonomyTree
+import OrthologGroups
+import SequenceStore
+import BlastXML
+import RunContext
 
 if platform.system() == 'Windows':
     from win32com.shell import shell, shellcon
@@ -56,6 +68,61 @@ if platform.system() == 'Windows':
 # Let NCBI know who is responsible for all the requests
 Entrez.email = 'coregulationdataharvester@gmail.com'
 
+# With an NCBI API key, E-utilities allow 10 requests per second instead of
+# 3. Bio.Entrez spaces the requests out to match whichever applies.
+if os.environ.get('NCBI_API_KEY'):
+    Entrez.api_key = os.environ['NCBI_API_KEY']
+
+# Databases to search, smallest first, when the user asks for tiered forward
+# searches. The last one should always be nr.
+SEARCH_TIERS = ['swissprot', 'nr']
+# A tier is escalated from unless the most common phrase of its hits is
+# found in at least this many pairs of hit definitions (three hits that
+# share it, for example)
+INFORMATIVE_PHRASE_PAIRS = 3
+
+# Chunked forward searches: queries longer than CHUNK_THRESHOLD are split into
+# windows of CHUNK_WINDOW that overlap by CHUNK_OVERLAP (nucleotides for
+# blastx, amino acids for blastp), and CHUNK_WORKERS windows are searched at
+# a time.
+CHUNK_THRESHOLD = {'blastx': 4500, 'blastp': 1500}
+CHUNK_WINDOW = {'blastx': 3000, 'blastp': 1000}
+CHUNK_OVERLAP = {'blastx': 600, 'blastp': 200}
+CHUNK_WORKERS = 3
+
+# When clades are derived locally from one unrestricted search, that search
+# asks for DERIVED_HITLIST_SIZE hits, so that each derived clade still gets
+# close to the DEFAULT_HITLIST_SIZE hits that a restricted search would give.
+DEFAULT_HITLIST_SIZE = 50
+DERIVED_HITLIST_SIZE = 250
+
+# Number of accessions per Entrez request
+ENTREZ_BATCH_SIZE = 200
+
+# The Tetrahymena proteome that the reciprocal BLASTs are run against on the
+# TGD server. Cached reciprocal results are kept per TGD_PROTEOME_RELEASE, so
+# it should be changed whenever the TGD updates the proteome.
+TGD_BLAST_URL = 'http://www.ciliate.org/blast/blast_link_result.cgi'
+TGD_DATALIB = 'tetrahymena/ttherm.aa'
+TGD_PROTEOME_RELEASE = 'TGD2014'
+
+# Reciprocal BLASTs are run RECIPROCAL_WORKERS at a time, but no more than
+# HOST_CONNECTIONS requests are ever open to the same server at once.
+RECIPROCAL_WORKERS = 6
+HOST_CONNECTIONS = 3
+
+# Budgeted reciprocal mode: the hits of a gene are reciprocated a round of
+# RECIPROCAL_WORKERS at a time, best first, until the rest of the hits can
+# no longer change the summary phrases (see CoregFilesIO.summary_is_settled)
+# or the budget is spent.
+
+# Family-representative mode: proteins are put in the same family when they
+# share at least FAMILY_SIMILARITY of their FAMILY_KMER-mers (Jaccard index)
+# and their lengths are within FAMILY_LENGTH_RATIO of each other.
+FAMILY_KMER = 3
+FAMILY_SIMILARITY = 0.5
+FAMILY_LENGTH_RATIO = 0.8
+
 # function to account for cross-analyses
 def to_blast(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, threshold):
     toBLAST = []
@@ -75,15 +142,744 @@ def to_blast(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, threshold):
     return toBLAST
 
 
+def homologs_are_informative(blast_result, TTHERM_ID):
+    """ Decide whether a forward BLAST result is worth keeping, by running
+        its hit definitions through the same cleanup and phrase analysis
+        that CoregFilesIO uses for the reports. A result is informative if
+        its most common phrase is shared by at least INFORMATIVE_PHRASE_PAIRS
+        pairs of hit definitions; results without hits (this includes NCBI
+        database errors) never are.
+
+        Called by forward_BLAST when the user asked for tiered searches.
+    """
+    try:
+        root = ET.fromstring(blast_result)
+    except ET.ParseError:
+        return False
+
+    homologs = [[hitDef.text, 'ortholog'] for hitDef in root.iter('Hit_def')]
+    if homologs == []:
+        return False
+
+    clean_homologue_dict = CoregFilesIO.clean_homologue_info(
+        {TTHERM_ID: homologs}, '')
+    definitions = [info[0] for info in clean_homologue_dict[TTHERM_ID]]
+
+    phrase_dict = CoregFilesIO.longest_phrases_in_homologue_info(
+        {TTHERM_ID: definitions})
+    best = CoregFilesIO.get_best_reciprocal_longest_matches(phrase_dict)
+
+    if phrase_dict[TTHERM_ID] == {}:
+        return False
+    return phrase_dict[TTHERM_ID][best[TTHERM_ID][0]] >= INFORMATIVE_PHRASE_PAIRS
+
+
+def split_query(query, window, overlap):
+    """ Split a query sequence into overlapping windows. Returns a list of
+        (offset, window sequence) tuples, where offset is the position of
+        the window in the full query. The last window is pushed back so
+        that it is full-length, rather than a short leftover.
+    """
+    if len(query) <= window:
+        return [(0, query)]
+
+    step = window - overlap
+    offsets = range(0, len(query) - window, step)
+    offsets.append(len(query) - window)
+
+    return [(offset, query[offset:offset + window]) for offset in offsets]
+
+
+def merge_chunked_results(windowResults, queryLength):
+    """ Merge the XML results of the windows of a chunked search into one
+        result in the same shape as an ordinary qblast XML result, so that
+        get_BLAST_homologues_dict and reciprocal_BLAST can read it as usual.
+
+        windowResults is a list of (offset, XML string) tuples. Each subject
+        is kept only once, from the window where it had the best e-value,
+        and its HSP query coordinates are shifted back onto the full query.
+        Hits are then sorted by e-value (and bit score for ties) and
+        renumbered. The merged hit list is capped at the length of the
+        longest single window hit list, so that a chunked gene does not
+        create more reciprocal work than an ordinary one would.
+    """
+    mergedRoot = None
+    bestHits = {}
+    maxHits = 0
+
+    for offset, windowXML in windowResults:
+        try:
+            root = ET.fromstring(windowXML)
+        except ET.ParseError:
+            continue
+
+        if mergedRoot is None:
+            mergedRoot = root
+
+        hits = list(root.iter('Hit'))
+        maxHits = max(maxHits, len(hits))
+
+        for hit in hits:
+            hsps = list(hit.iter('Hsp'))
+            if hsps == []:
+                continue
+
+            for hsp in hsps:
+                for tag in ['Hsp_query-from', 'Hsp_query-to']:
+                    position = hsp.find(tag)
+                    if position is not None:
+                        position.text = str(int(position.text) + offset)
+
+            evalue = min([float(hsp.find('Hsp_evalue').text) for hsp in hsps])
+            bitscore = max([float(hsp.find('Hsp_bit-score').text) for hsp in hsps])
+            accession = hit.find('Hit_accession').text
+
+            if accession not in bestHits or \
+                (evalue, -bitscore) < bestHits[accession][:2]:
+                bestHits[accession] = (evalue, -bitscore, hit)
+
+    if mergedRoot is None:
+        return None
+
+    mergedHits = sorted(bestHits.values(), key = lambda h: h[:2])[:maxHits]
+
+    # The hits of the first window are replaced by the merged hit list
+    iteration = mergedRoot.find('BlastOutput_iterations').find('Iteration')
+    iteration_hits = iteration.find('Iteration_hits')
+    for hit in list(iteration_hits):
+        iteration_hits.remove(hit)
+
+    for hitNum, (evalue, bitscore, hit) in enumerate(mergedHits):
+        hit.find('Hit_num').text = str(hitNum + 1)
+        iteration_hits.append(hit)
+
+    for tag in ['BlastOutput_query-len', 'Iteration_query-len']:
+        for element in mergedRoot.iter(tag):
+            element.text = str(queryLength)
+
+    return '<?xml version="1.0"?>\n' + ET.tostring(mergedRoot)
+
+
+def chunked_qBLAST(program, database, query, entrez, extraParameters, workers):
+    """ Search a long query as overlapping windows, several at a time, and
+        merge the results with merge_chunked_results. Long proteins and
+        cDNAs are the ones that hit the NCBI CPU usage limit, and windows
+        are both faster and less likely to fail. Windows whose search fails
+        are left out of the merge; if every window fails, None is returned.
+    """
+    windows = split_query(query, CHUNK_WINDOW[program], CHUNK_OVERLAP[program])
+
+    print 'Splitting %s query of length %d into %d windows' \
+        % (program, len(query), len(windows))
+    logging.info('Splitting %s query of length %d into %d windows' \
+        % (program, len(query), len(windows)))
+
+    def search_window(window):
+        offset, windowQuery = window
+        try:
+            result_handle = NCBIWWW.qblast(program, database, windowQuery,
+                entrez_query = entrez, **extraParameters)
+        except Exception:
+            logging.info('Window at %d of the %s query failed' % (offset, program))
+            return (offset, None)
+
+        if not result_handle:
+            return (offset, None)
+
+        return (offset, result_handle.read())
+
+    pool = ThreadPool(min(workers, len(windows)))
+    try:
+        windowResults = pool.map(search_window, windows)
+    finally:
+        pool.close()
+        pool.join()
+
+    windowResults = [(offset, windowXML) for offset, windowXML in windowResults
+        if windowXML]
+
+    if windowResults == []:
+        return None
+
+    return merge_chunked_results(windowResults, len(query))
+
+
+def forward_BLAST(program, coreg_gene, entrez, runOptions = None):
+    """ Run the forward NCBI BLAST (blastx or blastp) for a single gene and
+        return the XML result as a string, or None if the search failed.
+
+        By default this is a single search against nr. If the user asked
+        for tiered searches (runOptions['tieredSearch']), the databases in
+        runOptions['searchTiers'] (SEARCH_TIERS by default) are searched in
+        order, and the first result that homologs_are_informative accepts
+        is kept. A tier whose search fails (with an error, or an empty
+        result) is escalated from like an uninformative one. The last tier
+        is always kept, whatever it contains. The database that produced
+        the result is recorded by the NCBI in the BlastOutput_db field of
+        the XML, so the tier is carried along into the reciprocal results
+        and the report (see CoregFilesIO.get_blast_databases).
+
+        If the user asked for chunked searches (runOptions['chunkedSearch']),
+        queries longer than CHUNK_THRESHOLD are searched in overlapping
+        windows by chunked_qBLAST.
+    """
+    if runOptions is None:
+        runOptions = {}
+
+    if program == 'blastx':
+        query = coreg_gene.cDNA[10:]
+        extraParameters = {'genetic_code': 'Ciliate Nuclear'}
+    elif program == 'blastp':
+        query = coreg_gene.protein[13:]
+        extraParameters = {}
+
+    if runOptions.get('hitlistSize'):
+        extraParameters['hitlist_size'] = runOptions['hitlistSize']
+
+    if runOptions.get('tieredSearch', False):
+        tiers = runOptions.get('searchTiers', SEARCH_TIERS)
+    else:
+        tiers = ['nr']
+
+    blast_result = None
+    for tierNum, database in enumerate(tiers):
+        lastTier = tierNum == len(tiers) - 1
+        try:
+            if runOptions.get('chunkedSearch', False) and \
+                len(query) > CHUNK_THRESHOLD[program]:
+                blast_result = chunked_qBLAST(program, database, query, entrez,
+                    extraParameters, runOptions.get('chunkWorkers', CHUNK_WORKERS))
+
+            else:
+                result_handle = NCBIWWW.qblast(program, database, query,
+                    entrez_query = entrez, **extraParameters)
+
+                if result_handle:
+                    blast_result = result_handle.read()
+                else:
+                    blast_result = None
+
+        except Exception as error:
+            # Only the last tier's failure is the caller's to handle
+            if lastTier:
+                raise
+            blast_result = None
+            logging.info('%s for %s raised %r in %s' \
+                % (program, coreg_gene.TTHERM_ID, error, database))
+
+        if lastTier:
+            break
+
+        if not blast_result:
+            print '%s for %s failed in %s. Escalating to %s...' \
+                % (program, coreg_gene.TTHERM_ID, database, tiers[tierNum + 1])
+            logging.info('%s for %s failed in %s. Escalating to %s...' \
+                % (program, coreg_gene.TTHERM_ID, database, tiers[tierNum + 1]))
+
+        elif homologs_are_informative(blast_result, coreg_gene.TTHERM_ID):
+            print '%s for %s was informative in %s' \
+                % (program, coreg_gene.TTHERM_ID, database)
+            logging.info('%s for %s was informative in %s' \
+                % (program, coreg_gene.TTHERM_ID, database))
+            break
+
+        else:
+            print '%s for %s was uninformative in %s. Escalating to %s...' \
+                % (program, coreg_gene.TTHERM_ID, database, tiers[tierNum + 1])
+            logging.info('%s for %s was uninformative in %s. Escalating to %s...' \
+                % (program, coreg_gene.TTHERM_ID, database, tiers[tierNum + 1]))
+
+    return blast_result or None
+
+
+def fetch_taxids(accessions):
+    """ Get the taxid of each accession from Entrez esummary, a batch of
+        accessions at a time. Returns a dictionary from accession (with and
+        without version) to taxid.
+    """
+    taxidDict = {}
+    for start in xrange(0, len(accessions), ENTREZ_BATCH_SIZE):
+        batch = accessions[start:start + ENTREZ_BATCH_SIZE]
+        handle = Entrez.esummary(db = 'protein', id = ','.join(batch))
+        records = Entrez.read(handle)
+        handle.close()
+
+        for record in records:
+            taxid = int(record['TaxId'])
+            taxidDict[str(record['Caption'])] = taxid
+            taxidDict[str(record['AccessionVersion'])] = taxid
+
+    return taxidDict
+
+
+def parse_fasta(fasta_text):
+    # Returns a list of (header, sequence) pairs from FASTA text
+    records = []
+    for block in fasta_text.split('>')[1:]:
+        lines = block.strip().splitlines()
+        if lines:
+            records.append((lines[0], ''.join(lines[1:]).strip()))
+    return records
+
+
+def fetch_homolog_sequences(accessions):
+    """ Get the protein sequences of accessions from Entrez, posting each
+        batch of ENTREZ_BATCH_SIZE accessions to the history server with
+        epost and fetching them back as FASTA in one efetch. Returns a
+        dictionary from accession (as given) to sequence, lower-case as in
+        GBSeq_sequence. Accessions whose FASTA headers cannot be matched up
+        are fetched one at a time, the way they all used to be.
+
+        The persistent SequenceStore is consulted first, so only the
+        accessions that have never been fetched before go to Entrez, and
+        everything fetched is added to it.
+    """
+    sequenceStore = SequenceStore.open_store()
+    accessionseqDict = sequenceStore.get_many(accessions)
+    storedCount = len(accessionseqDict)
+    accessions = [accession for accession in accessions
+        if accession not in accessionseqDict]
+
+    # Accessions in the headers may or may not carry a version, and may be
+    # wrapped up as e.g. 'sp|P12345.2|NAME_HUMAN'
+    unversioned = {}
+    for accession in accessions:
+        unversioned.setdefault(accession.split('.')[0], []).append(accession)
+
+    for start in xrange(0, len(accessions), ENTREZ_BATCH_SIZE):
+        batch = accessions[start:start + ENTREZ_BATCH_SIZE]
+        try:
+            handle = Entrez.epost(db = 'protein', id = ','.join(batch))
+            post = Entrez.read(handle)
+            handle.close()
+
+            handle = Entrez.efetch(db = 'protein', rettype = 'fasta',
+                retmode = 'text', webenv = post['WebEnv'],
+                query_key = post['QueryKey'], retmax = len(batch))
+            fasta_text = handle.read()
+            handle.close()
+        except Exception:
+            print 'Batched sequence retrieval failed. Fetching one at a time...'
+            logging.info('Batched sequence retrieval failed:')
+            logging.info(traceback.format_exc())
+            continue
+
+        for header, sequence in parse_fasta(fasta_text):
+            for field in header.split()[0].split('|'):
+                for accession in unversioned.get(field.split('.')[0], []):
+                    accessionseqDict[accession] = sequence.lower()
+
+    for accession in accessions:
+        if accession not in accessionseqDict:
+            # Figured this out from Biopython tutorial section 9
+            handle = Entrez.efetch(db='protein', id=accession, retmode='xml')
+            record = Entrez.read(handle)
+            handle.close()
+            accessionseqDict[accession] = record[0]['GBSeq_sequence']
+
+    sequenceStore.put_many(dict([(accession, accessionseqDict[accession])
+        for accession in accessions]))
+
+    print 'Retrieved %d homolog sequences (%d from the local store)' \
+        % (len(accessionseqDict), storedCount)
+    logging.info('Retrieved %d homolog sequences (%d from the local store)' \
+        % (len(accessionseqDict), storedCount))
+
+    return accessionseqDict
+
+
+def hsp_subject_sequences(root):
+    """ Build reciprocal queries from the forward BLAST XML itself instead of
+        fetching the homologs from Entrez. Each hit's query is its aligned
+        subject region(s) (Hsp_hseq, without gaps), in subject order. HSPs
+        that overlap a region already taken are skipped. Returns the same
+        accession to sequence dictionary as fetch_homolog_sequences.
+    """
+    accessionseqDict = {}
+    for hit in root.iter('Hit'):
+        regions = []
+        for hsp in hit.iter('Hsp'):
+            regions.append((int(hsp.find('Hsp_hit-from').text),
+                int(hsp.find('Hsp_hit-to').text),
+                hsp.find('Hsp_hseq').text.replace('-', '')))
+
+        sequence = ''
+        end = 0
+        for hitFrom, hitTo, hseq in sorted(regions):
+            if hitFrom > end:
+                sequence += hseq
+                end = hitTo
+
+        accessionseqDict[hit.find('Hit_accession').text] = sequence.lower()
+
+    return accessionseqDict
+
+
+def compare_reciprocal_modes(sample, blastOption, clade, report_address):
+    """ Run the reciprocal BLASTs for the genes in sample both with full
+        homolog sequences and with HSP-subject queries, and write a CSV
+        report of how each homolog was classified by each, so that the
+        accuracy of the HSP-subject mode can be judged. Uses the forward
+        BLAST files that are already there; genes without one are skipped.
+
+        Called by get_BLAST_homologues_dict in CoregFilesIO.
+    """
+    rows = []
+    for coreg_gene in sample:
+        blast_address = filename_generator.filename_generator('blast',
+            [coreg_gene.TTHERM_ID], clade = clade, blastOption = blastOption)[0]
+        if not os.path.exists(blast_address):
+            continue
+
+        print 'Comparing full-sequence and HSP-subject reciprocal BLASTs for %s' \
+            % coreg_gene.TTHERM_ID
+        logging.info('Comparing full-sequence and HSP-subject reciprocal BLASTs for %s' \
+            % coreg_gene.TTHERM_ID)
+
+        root = BlastXML.load_blast_xml(blast_address).getroot()
+        hspLengths = dict([(accession, len(sequence)) for accession, sequence
+            in hsp_subject_sequences(root).items()])
+
+        qualities = []
+        for hspQueries in [False, True]:
+            recipTree = reciprocal_BLAST(blast_address, coreg_gene, blastOption,
+                clade, runOptions = {'hspQueries': hspQueries})[0]
+            qualities.append(dict([(hit.find('Hit_accession').text,
+                hit.find('Hit_def').get('quality', 'none'))
+                for hit in recipTree.getroot().iter('Hit')]))
+
+        for accession in qualities[0]:
+            rows.append([coreg_gene.TTHERM_ID, accession, qualities[0][accession],
+                qualities[1].get(accession, 'none'), hspLengths.get(accession, 0)])
+
+    if rows == []:
+        print 'No forward BLAST results to compare yet.'
+        logging.info('No forward BLAST results to compare yet.')
+        return
+
+    agreed = len([row for row in rows if row[2] == row[3]])
+
+    with open(report_address, 'wb') as report_file:
+        reportWriter = csv.writer(report_file)
+        reportWriter.writerow(['TTHERM_ID', 'Accession', 'Full.Sequence.Quality',
+            'HSP.Subject.Quality', 'HSP.Subject.Length'])
+        for row in rows:
+            reportWriter.writerow(row)
+        reportWriter.writerow([])
+        reportWriter.writerow(['Agreement', '%d/%d' % (agreed, len(rows))])
+
+    print 'HSP-subject queries agreed with full sequences for %d of %d homologs.' \
+        % (agreed, len(rows))
+    print 'See %s' % report_address
+    logging.info('HSP-subject queries agreed with full sequences for %d of %d homologs. See %s' \
+        % (agreed, len(rows), report_address))
+
+
+def reciprocate_sequences(sequences, ignoreErrors = False):
+    """ Run cached_reciprocal_search on sequences with RECIPROCAL_WORKERS
+        threads. Returns a dictionary from sequence to reciprocal hits. With
+        ignoreErrors, sequences whose search fails are left out instead of
+        the error being raised.
+    """
+    sequences = list(set(sequences))
+
+    def search(sequence):
+        try:
+            return cached_reciprocal_search(sequence)
+        except:
+            if not ignoreErrors:
+                raise
+            logging.info('Reciprocal BLAST failed:')
+            logging.info(traceback.format_exc())
+            return None
+
+    if len(sequences) > 1:
+        # The cache is opened here, before the threads start, so that none
+        # of them opens it alongside another
+        SequenceStore.open_reciprocal_cache()
+        pool = ThreadPool(min(RECIPROCAL_WORKERS, len(sequences)))
+        try:
+            results = pool.map(search, sequences)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [search(sequence) for sequence in sequences]
+
+    return dict([(sequence, hits) for sequence, hits in zip(sequences, results)
+        if hits is not None])
+
+
+def reciprocal_queries(root, runOptions):
+    """ The sequences to reciprocate for the hits in a (species-filtered)
+        forward BLAST XML tree, as a dictionary from accession to sequence:
+        the aligned subject regions with runOptions['hspQueries'], and the
+        full homolog sequences otherwise.
+    """
+    if runOptions.get('hspQueries', False):
+        return hsp_subject_sequences(root)
+    else:
+        # Much better way than the commented-out chunk below.
+        accessionidList = [ids.text for ids in root.iter('Hit_accession')]
+        return fetch_homolog_sequences(accessionidList)
+
+
+def prepare_reciprocal_stage(blast_addresses, runOptions):
+    """ Planning pass over all the forward BLAST files that are about to be
+        reciprocated in this run (for every gene, and for both programs in
+        'both' mode). The homologs are pooled across the files, so each
+        distinct sequence is fetched once, in as few Entrez batches as
+        possible, and reciprocated once. The answers land in the
+        SequenceStore and the ReciprocalCache, from which reciprocal_BLAST
+        then classifies each gene's homologs without going to the network.
+
+        Called by dictionary_work in CoregFilesIO.
+    """
+    # In budgeted mode, only the hits that are sure to be reciprocated are
+    # planned; the rest are up to the per-gene pass.
+    budget = runOptions.get('reciprocalBudget', 0)
+    def planned(root):
+        if budget:
+            return set(rank_hits(root)[:budget_minimum(budget)])
+        return set([ids.text for ids in root.iter('Hit_accession')])
+
+    # The files are read one at a time, and only what is planned from each
+    # is kept
+    sequences = set()
+    accessions = set()
+    accessionCount = 0
+    fileCount = 0
+    for blast_address in blast_addresses:
+        try:
+            root = BlastXML.load_blast_xml(blast_address).getroot()
+        except:
+            continue
+        remove_redundant_species(root)
+        fileCount += 1
+
+        plannedAccessions = planned(root)
+        accessionCount += len(plannedAccessions)
+        if runOptions.get('hspQueries', False):
+            sequences.update([sequence for accession, sequence
+                in hsp_subject_sequences(root).items()
+                if accession in plannedAccessions])
+        else:
+            accessions.update(plannedAccessions)
+
+    if fileCount == 0:
+        return
+
+    if not runOptions.get('hspQueries', False):
+        print 'Planning the reciprocal stage: %d homologs in %d BLAST results, %d distinct' \
+            % (accessionCount, fileCount, len(accessions))
+        logging.info('Planning the reciprocal stage: %d homologs in %d BLAST results, %d distinct' \
+            % (accessionCount, fileCount, len(accessions)))
+        sequences = set(fetch_homolog_sequences(list(accessions)).values())
+
+    print 'Reciprocating %d distinct homolog sequences' % len(sequences)
+    logging.info('Reciprocating %d distinct homolog sequences' % len(sequences))
+
+    # Failures are left for the per-gene pass to try again
+    reciprocate_sequences(sequences, ignoreErrors = True)
+
+
+def add_hit_taxids(root):
+    """ Record the taxid of every hit in a BLAST XML tree as a Hit_taxid
+        element (0 if the NCBI does not know it). Hits that already have one
+        are left alone. Returns True if the tree was changed.
+    """
+    hits = [hit for hit in root.iter('Hit') if hit.find('Hit_taxid') is None]
+    if hits == []:
+        return False
+
+    accessions = [hit.find('Hit_accession').text for hit in hits]
+    taxidDict = fetch_taxids(accessions)
+
+    for hit, accession in zip(hits, accessions):
+        taxid_element = ET.SubElement(hit, 'Hit_taxid')
+        taxid_element.text = str(taxidDict.get(accession, 0))
+
+    return True
+
+
+def filter_hits(root, keep, maxHits = None):
+    """ Remove the hits for which keep(hit) is False from a BLAST XML tree
+        (keeping at most maxHits), and renumber the ones that are left.
+    """
+    kept = 0
+    for iteration_hits in root.iter('Iteration_hits'):
+        for hit in list(iteration_hits):
+            if keep(hit) and (maxHits is None or kept < maxHits):
+                kept += 1
+                hit_num = hit.find('Hit_num')
+                if hit_num is not None:
+                    hit_num.text = str(kept)
+            else:
+                iteration_hits.remove(hit)
+
+    return kept
+
+
+def get_clade_test(entrez):
+    """ Translate the entrez query for a clade into a taxid test with the
+        local taxonomy (see TaxonomyTree). Returns None if the clade cannot
+        be derived locally, in which case it has to be searched at the NCBI.
+    """
+    taxonomy = TaxonomyTree.load_taxonomy()
+    if taxonomy is None:
+        return None
+
+    cladeTest = taxonomy.clade_test(entrez)
+    if cladeTest is None:
+        print 'The entrez query "%s" is too complex to derive locally.' % entrez
+        logging.info('The entrez query "%s" is too complex to derive locally.' % entrez)
+
+    return cladeTest
+
+
+def write_blast_files(tree, address, drop_address, syncOption):
+    # Write a BLAST XML tree locally and/or to Dropbox, as chosen by the user
+    if syncOption in [1, 2]:
+        tree.write(drop_address)
+    if syncOption in [1, 3]:
+        tree.write(address)
+
+
+def derive_clade_forward_BLAST(coreg_gene, program, clade, cladeTest, syncOption):
+    """ Make the forward BLAST result of one clade for coreg_gene from the
+        unrestricted result (see NCBI_qBLAST), without going to the NCBI.
+        The taxids of the unrestricted hits are fetched once (and stored in
+        the source file), and the hits outside the clade are dropped. The
+        clade keeps its best DEFAULT_HITLIST_SIZE hits, like a restricted
+        search, and these are all that get reciprocated for it.
+    """
+    all_address, drop_all_address, reciprocal_all_address, drop_reciprocal_all_address = \
+        filename_generator.filename_generator('derivation_source',
+            [coreg_gene.TTHERM_ID], blastOption = program)
+    clade_address, drop_clade_address, reciprocal_clade_address, drop_reciprocal_clade_address = \
+        filename_generator.filename_generator('blast', [coreg_gene.TTHERM_ID],
+            clade = clade, blastOption = program)
+
+    sources = [address for address in [all_address, drop_all_address]
+        if os.path.exists(address)]
+    if sources == []:
+        print 'No unrestricted %s for %s to derive %s from. Skipping...' \
+            % (program, coreg_gene.TTHERM_ID, clade)
+        logging.info('No unrestricted %s for %s to derive %s from. Skipping...' \
+            % (program, coreg_gene.TTHERM_ID, clade))
+        return
+
+    tree = ET.parse(sources[0])
+    root = tree.getroot()
+
+    # Keep the taxids with the unrestricted results, so that every other
+    # clade can be derived from them without the network
+    if add_hit_taxids(root):
+        for address in sources:
+            tree.write(address)
+
+    kept = filter_hits(root,
+        lambda hit: cladeTest(int(hit.findtext('Hit_taxid', '0'))),
+        DEFAULT_HITLIST_SIZE)
+
+    write_blast_files(tree, clade_address, drop_clade_address, syncOption)
+
+    print 'Derived %s %s profile for %s locally (%d hits)' \
+        % (clade, program, coreg_gene.TTHERM_ID, kept)
+    logging.info('Derived %s %s profile for %s locally (%d hits)' \
+        % (clade, program, coreg_gene.TTHERM_ID, kept))
+
+
+def cluster_gene_families(toBLAST):
+    """ Group the proteins of the genes in toBLAST into tight families of
+        near-identical paralogs, which will hit nearly the same homologs.
+        This is a greedy clustering: genes are taken longest protein first,
+        and each one joins the family of the first representative it is
+        similar enough to (see FAMILY_SIMILARITY), or else becomes a new
+        representative. Comparing k-mer sets is much faster than aligning,
+        and an index from k-mers to representatives means that each gene
+        is only compared with the representatives it shares k-mers with.
+
+        Returns a dictionary from each TTHERM_ID to the TTHERM_ID of its
+        family representative (representatives map to themselves).
+    """
+    def kmers(protein):
+        return set([protein[i:i + FAMILY_KMER]
+            for i in xrange(len(protein) - FAMILY_KMER + 1)])
+
+    genes = sorted(toBLAST, key = lambda g: len(g.protein), reverse = True)
+
+    familyDict = {}
+    repKmers = {}
+    repLengths = {}
+    kmerIndex = {}
+
+    for coreg_gene in genes:
+        protein = coreg_gene.protein[13:]
+        geneKmers = kmers(protein)
+
+        # Count shared k-mers with every representative at once
+        shared = {}
+        for kmer in geneKmers:
+            for rep in kmerIndex.get(kmer, []):
+                shared[rep] = shared.get(rep, 0) + 1
+
+        family = None
+        for rep in sorted(shared, key = lambda r: -shared[r]):
+            if len(protein) < FAMILY_LENGTH_RATIO * repLengths[rep]:
+                continue
+            union = len(geneKmers) + len(repKmers[rep]) - shared[rep]
+            if union and shared[rep] / float(union) >= FAMILY_SIMILARITY:
+                family = rep
+                break
+
+        if family is None:
+            family = coreg_gene.TTHERM_ID
+            repKmers[family] = geneKmers
+            repLengths[family] = len(protein)
+            for kmer in geneKmers:
+                kmerIndex.setdefault(kmer, []).append(family)
+
+        familyDict[coreg_gene.TTHERM_ID] = family
+
+    return familyDict
+
+
+def reuse_family_BLAST(coreg_gene, representative, program, clade, owOption,
+    blastMode = 'blast'):
+    """ Give a family member the forward BLAST result of its representative
+        (see cluster_gene_families), locally and/or in Dropbox, wherever the
+        representative's result was written. With owOption == 3, results
+        that the member already has are kept. The member still gets its own
+        reciprocal BLASTs, which decide orthology against its own TTHERM_ID.
+        blastMode is the filename_generator mode of the forward results.
+    """
+    rep_address, drop_rep_address, reciprocal_rep_address, drop_reciprocal_rep_address = \
+        filename_generator.filename_generator(blastMode, [representative],
+            clade = clade, blastOption = program)
+    member_address, drop_member_address, reciprocal_member_address, drop_reciprocal_member_address = \
+        filename_generator.filename_generator(blastMode, [coreg_gene.TTHERM_ID],
+            clade = clade, blastOption = program)
+
+    for src, dst in [(rep_address, member_address),
+        (drop_rep_address, drop_member_address)]:
+        if os.path.exists(src) and (owOption != 3 or not os.path.exists(dst)):
+            shutil.copy2(src, dst)
+            print 'Reused the %s profile of %s for family member %s' \
+                % (program, representative, coreg_gene.TTHERM_ID)
+            logging.info('Reused the %s profile of %s for family member %s' \
+                % (program, representative, coreg_gene.TTHERM_ID))
+
 
 # Runs the BLAST searches for each gene in the co-regulated set
-def NCBI_qBLAST(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption, 
-    blastOption, syncOption, entrez, clade, threshold):
+def NCBI_qBLAST(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption,
+    blastOption, syncOption, entrez, clade, threshold, runOptions = None):
     """ This fundtion calls NCBIWWW.qblast() from the biopython module.
         I am giving it the following parameters:
             - blast(p/x): protein or cDNA blast using translated nucleotide
               query
-            - nr: non-redundant protein sequences
+            - nr: non-redundant protein sequences (or smaller databases
+              first, when tiered searches are asked for; see forward_BLAST)
             - cDNA or protein from my coregs_zscores_cDNA_list
             - genetic_code = 'Ciliate Nuclear' for proper translation if using
               cDNA
@@ -96,7 +892,46 @@ def NCBI_qBLAST(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption,
         that is naming scheme will make it easy to process data from the files
         using regular expressions, as well as easily readable and understanble 
         to the human eye.
+
+        runOptions is the dictionary of optional search strategies chosen
+        in the master module. It is handed to forward_BLAST for each search.
+        If runOptions['deriveClades'] is set, the searches are run once
+        without any taxonomic restriction, for DERIVED_HITLIST_SIZE hits,
+        and the results for the requested clade are derived from them
+        locally by derive_clade_forward_BLAST. These searches are kept in
+        their own files (filename_generator mode 'derivation_source'), apart
+        from the ordinary clade 'all' results.
+        If runOptions['familyRepresentatives'] is set, the genes are grouped
+        into families by cluster_gene_families, only one representative of
+        each family is searched, and the other members reuse its result.
+        The families are pickled for the report.
+        If runOptions['orthologGroups'] is set, genes covered by the imported
+        ortholog groups (see OrthologGroups) are not searched at all.
     """
+    if runOptions is None:
+        runOptions = {}
+
+    if blastOption == 'both':
+        programs = ['blastx', 'blastp']
+    else:
+        programs = [blastOption]
+
+    # The clade of the run, before it may be widened for deriving
+    cladeEntrez = entrez
+
+    cladeTest = None
+    blastMode = 'blast'
+    if runOptions.get('deriveClades', False) and clade != 'all':
+        cladeTest = get_clade_test(entrez)
+        if cladeTest is not None:
+            derivedClade = clade
+            entrez = '(none)'
+            blastMode = 'derivation_source'
+            runOptions = dict(runOptions)
+            runOptions['hitlistSize'] = DERIVED_HITLIST_SIZE
+        else:
+            print 'Searching %s at the NCBI instead.' % clade
+            logging.info('Searching %s at the NCBI instead.' % clade)
 
     print 'Initializing BLAST API: This may take some time...'
 
@@ -105,11 +940,56 @@ def NCBI_qBLAST(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption,
     BLASTs_performed = 1
     toBLAST = to_blast(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, threshold)
 
+    # Genes covered by imported ortholog groups are answered from them
+    # in CoregFilesIO, and do not need forward searches.
+    coveredGenes = set()
+    if runOptions.get('orthologGroups', False):
+        orthologGroupStore = OrthologGroups.open_store(cladeEntrez)
+        if orthologGroupStore is not None:
+            coveredGenes = orthologGroupStore.covered(
+                [g.TTHERM_ID for g in toBLAST])
+            orthologGroupStore.close()
+            print '%d of %d genes are covered by imported ortholog groups' \
+                % (len(coveredGenes), len(toBLAST))
+            logging.info('%d of %d genes are covered by imported ortholog groups' \
+                % (len(coveredGenes), len(toBLAST)))
+            # Left out before the families are formed, so that every
+            # family representative is searched
+            toBLAST = [g for g in toBLAST if g.TTHERM_ID not in coveredGenes]
+
+    familyDict = {}
+    if runOptions.get('familyRepresentatives', False):
+        familyDict = cluster_gene_families(toBLAST)
+        representatives = set(familyDict.values())
+        print 'Grouped %d genes into %d families; only the representatives will be searched' \
+            % (len(toBLAST), len(representatives))
+        logging.info('Grouped %d genes into %d families; only the representatives will be searched' \
+            % (len(toBLAST), len(representatives)))
+
+        families_address = filename_generator.filename_generator(
+            'families', formatted_TTHERM_ID_list, threshold = threshold)
+        RunContext.dump_pickle(familyDict, families_address)
+
+        # Search the representatives before the members that reuse them
+        toBLAST = [g for g in toBLAST if g.TTHERM_ID in representatives] + \
+            [g for g in toBLAST if g.TTHERM_ID not in representatives]
+
     # print 'here'
     # pdb.set_trace()
     
     for coreg_gene in toBLAST:
 
+        representative = familyDict.get(coreg_gene.TTHERM_ID, coreg_gene.TTHERM_ID)
+        if representative != coreg_gene.TTHERM_ID:
+            for program in programs:
+                reuse_family_BLAST(
+                    coreg_gene, representative, program, clade, owOption, blastMode)
+
+                if cladeTest is not None:
+                    derive_clade_forward_BLAST(
+                        coreg_gene, program, derivedClade, cladeTest, syncOption)
+            continue
+
         if (BLASTs_performed % 25) == 0:
             print
             print "Giving the NCBI a minute's rest."
@@ -122,28 +1002,21 @@ def NCBI_qBLAST(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption,
         # with empty files.
         # the reciprocal addresses here are wasted
         xf_address, drop_xf_address, reciprocal_blastx_address, drop_reciprocal_blastx_address = \
-        filename_generator.filename_generator('blast', [coreg_gene.TTHERM_ID], clade = clade, blastOption = 'blastx')
+        filename_generator.filename_generator(blastMode, [coreg_gene.TTHERM_ID], clade = clade, blastOption = 'blastx')
 
         pf_address, drop_pf_address, reciprocal_blastp_address, drop_reciprocal_blastp_address = \
-        filename_generator.filename_generator('blast', [coreg_gene.TTHERM_ID], clade = clade, blastOption = 'blastp')
+        filename_generator.filename_generator(blastMode, [coreg_gene.TTHERM_ID], clade = clade, blastOption = 'blastp')
         # Case when user wants all BLAST results overwritten
         if owOption != 3:
             if blastOption == 'blastx':
-                xblast_result_handle = NCBIWWW.qblast("blastx", "nr", 
-                    coreg_gene.cDNA[10:],
-                    genetic_code = 'Ciliate Nuclear',
-                    entrez_query = entrez)
+                xblast_result = forward_BLAST("blastx", coreg_gene, entrez, runOptions)
                 BLASTs_performed += 1
 
-                if not xblast_result_handle:
+                if not xblast_result:
                     print 'BLASTx for %s failed. Skipping...' % coreg_gene.TTHERM_ID
                     logging.info('BLASTx for %s failed. Skipping...' % coreg_gene.TTHERM_ID)
                     break
 
-                else:
-                    # This is the case when the BLAST was successful
-                    xblast_result = xblast_result_handle.read()
-
                 # Write both locally and to Dropbox
                 if syncOption == 1:
                     drop_xf = open(drop_xf_address, 'wb')
@@ -183,20 +1056,14 @@ def NCBI_qBLAST(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption,
                         % coreg_gene.TTHERM_ID)
 
             elif blastOption == 'blastp':
-                pblast_result_handle = NCBIWWW.qblast("blastp", "nr", 
-                    coreg_gene.protein[13:],
-                    entrez_query = entrez)
+                pblast_result = forward_BLAST("blastp", coreg_gene, entrez, runOptions)
                 BLASTs_performed += 1
 
-                if not pblast_result_handle:
+                if not pblast_result:
                     print 'BLASTp for %s failed. Skipping...' % coreg_gene.TTHERM_ID
                     logging.info('BLASTp for %s failed. Skipping...' % coreg_gene.TTHERM_ID)
                     break
 
-                else:
-                    # This is the case when BLAST was successful
-                    pblast_result = pblast_result_handle.read()
-
                 # Write both locally and to Dropbox
                 if syncOption == 1:
                     drop_pf = open(drop_pf_address, 'wb')
@@ -240,36 +1107,23 @@ def NCBI_qBLAST(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption,
             elif blastOption == 'both':
 
                 # First run BLAST
-                xblast_result_handle = NCBIWWW.qblast("blastx", "nr", 
-                    coreg_gene.cDNA[10:],
-                    genetic_code = 'Ciliate Nuclear',
-                    entrez_query = entrez)
+                xblast_result = forward_BLAST("blastx", coreg_gene, entrez, runOptions)
                 BLASTs_performed += 1
 
-                if not xblast_result_handle:
+                if not xblast_result:
                     print 'BLASTx for %s failed. Skipping...'
                     logging.info('BLASTx for %s failed. Skipping...')
                     break
 
-                else:
-                    # This is the case when BLAST was successful
-                    xblast_result = xblast_result_handle.read()
-
                 # Then run BLASTp
-                pblast_result_handle = NCBIWWW.qblast("blastp", "nr", 
-                    coreg_gene.protein[13:],
-                    entrez_query = entrez)
+                pblast_result = forward_BLAST("blastp", coreg_gene, entrez, runOptions)
                 BLASTs_performed += 1
 
-                if not pblast_result_handle:
+                if not pblast_result:
                     print 'BLASTp for %s failed. Skipping...'
                     logging.info('BLASTp for %s failed. Skipping...')
                     break
 
-                else:
-                    # This is the case when BLAST was successful
-                    pblast_result = pblast_result_handle.read()
-
                 # Write both locally and to Dropbox
                 if syncOption == 1:
                     # Write BLASTx results...
@@ -366,21 +1220,15 @@ def NCBI_qBLAST(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption,
                     if not os.path.exists(xf_address) and \
                         not os.path.exists(drop_xf_address):
 
-                        xblast_result_handle = NCBIWWW.qblast("blastx", "nr", 
-                            coreg_gene.cDNA[10:],
-                            genetic_code = 'Ciliate Nuclear',
-                            entrez_query = entrez)
+                        xblast_result = forward_BLAST("blastx", coreg_gene, entrez, runOptions)
                         BLASTs_performed += 1
 
-                        if not xblast_result_handle:
+                        if not xblast_result:
                             print 'BLASTx for %s failed. Skipping...' \
                                 % coreg_gene.TTHERM_ID
                             logging.info('BLASTx for %s failed. Skipping...' \
                                 % coreg_gene.TTHERM_ID)
                             break
-                        else:
-                            # This is the case when BLAST was successful
-                            xblast_result = xblast_result_handle.read()
 
                         xf = open(xf_address, 'wb')
                         xf.write(xblast_result)
@@ -442,23 +1290,16 @@ def NCBI_qBLAST(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption,
                 # same approach as before Dropbox integration
                 elif syncOption == 3:
                     if not os.path.exists(xf_address):
-                        xblast_result_handle = NCBIWWW.qblast("blastx", "nr", 
-                            coreg_gene.cDNA[10:],
-                            genetic_code = 'Ciliate Nuclear',
-                            entrez_query = entrez)
+                        xblast_result = forward_BLAST("blastx", coreg_gene, entrez, runOptions)
                         BLASTs_performed += 1
 
-                        if not xblast_result_handle:
+                        if not xblast_result:
                             print 'BLASTx for %s failed. Skipping...' \
                                 % coreg_gene.TTHERM_ID
                             logging.info('BLASTx for %s failed. Skipping...' \
                                 % coreg_gene.TTHERM_ID)
                             break
 
-                        else:
-                            # This is the case when BLAST was successful
-                            xblast_result = xblast_result_handle.read()
-
                         xf = open(xf_address, 'wb')
                         xf.write(xblast_result)
                         xf.close()
@@ -485,21 +1326,16 @@ def NCBI_qBLAST(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption,
                     if not os.path.exists(pf_address) and \
                         not os.path.exists(drop_pf_address):
 
-                        pblast_result_handle = NCBIWWW.qblast("blastp", "nr", 
-                            coreg_gene.protein[13:],
-                            entrez_query = entrez)
+                        pblast_result = forward_BLAST("blastp", coreg_gene, entrez, runOptions)
                         BLASTs_performed += 1
 
-                        if not pblast_result_handle:
+                        if not pblast_result:
                             print 'BLASTp for %s failed. Skipping...' \
                                 % coreg_gene.TTHERM_ID
                             logging.info('BLASTp for %s failed. Skipping...' \
                                 % coreg_gene.TTHERM_ID)
                             break
 
-                        else:
-                            # This is the case when BLAST was successful
-                            pblast_result = pblast_result_handle.read()
                         
                         pf = open(pf_address, 'wb')
                         pf.write(pblast_result)
@@ -561,22 +1397,16 @@ def NCBI_qBLAST(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption,
                 # keep things as before Dropbox integration
                 elif syncOption == 3:
                     if not os.path.exists(pf_address):
-                        pblast_result_handle = NCBIWWW.qblast("blastp", "nr", 
-                            coreg_gene.protein[13:],
-                            entrez_query = entrez)
+                        pblast_result = forward_BLAST("blastp", coreg_gene, entrez, runOptions)
                         BLASTs_performed += 1
 
-                        if not pblast_result_handle:
+                        if not pblast_result:
                             print 'BLASTp for %s failed. Skipping...' \
                                 % coreg_gene.TTHERM_ID
                             logging.info('BLASTp for %s failed. Skipping...' \
                                 % coreg_gene.TTHERM_ID)
                             break
 
-                        else:
-                            # This is the case when BLAST was successful
-                            pblast_result = pblast_result_handle.read()
-
                         pf = open(pf_address, 'wb')
                         pf.write(pblast_result)
                         pf.close()
@@ -606,22 +1436,16 @@ def NCBI_qBLAST(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption,
                     if not os.path.exists(xf_address) and \
                         not os.path.exists(drop_xf_address):
 
-                        xblast_result_handle = NCBIWWW.qblast("blastx", "nr", 
-                            coreg_gene.cDNA[10:],
-                            genetic_code = 'Ciliate Nuclear',
-                            entrez_query = entrez)
+                        xblast_result = forward_BLAST("blastx", coreg_gene, entrez, runOptions)
                         BLASTs_performed += 1
 
-                        if not xblast_result_handle:
+                        if not xblast_result:
                             print 'BLASTx for %s failed. Skipping...' \
                                 % coreg_gene.TTHERM_ID
                             logging.info('BLASTx for %s failed. Skipping...' \
                                 % coreg_gene.TTHERM_ID)
                             break
 
-                        else:
-                            # This is the case when BLAST was successful
-                            xblast_result = xblast_result_handle.read()
                         
                         xf = open(xf_address, 'wb')
                         xf.write(xblast_result)
@@ -683,23 +1507,16 @@ def NCBI_qBLAST(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption,
                 # same approach as before Dropbox integration
                 elif syncOption == 3:
                     if not os.path.exists(xf_address):
-                        xblast_result_handle = NCBIWWW.qblast("blastx", "nr", 
-                            coreg_gene.cDNA[10:],
-                            genetic_code = 'Ciliate Nuclear',
-                            entrez_query = entrez)
+                        xblast_result = forward_BLAST("blastx", coreg_gene, entrez, runOptions)
                         BLASTs_performed += 1
 
-                        if not xblast_result_handle:
+                        if not xblast_result:
                             print 'BLASTx for %s failed. Skipping...' \
                                 % coreg_gene.TTHERM_ID
                             logging.info('BLASTx for %s failed. Skipping...' \
                                 % coreg_gene.TTHERM_ID)
                             break
 
-                        else:
-                            # This is the case when BLAST was successful
-                            xblast_result = xblast_result_handle.read()
-
                         xf = open(xf_address, 'wb')
                         xf.write(xblast_result)
                         xf.close()
@@ -723,21 +1540,16 @@ def NCBI_qBLAST(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption,
                     if not os.path.exists(pf_address) and \
                         not os.path.exists(drop_pf_address):
 
-                        pblast_result_handle = NCBIWWW.qblast("blastp", "nr", 
-                            coreg_gene.protein[13:],
-                            entrez_query = entrez)
+                        pblast_result = forward_BLAST("blastp", coreg_gene, entrez, runOptions)
                         BLASTs_performed += 1
 
-                        if not pblast_result_handle:
+                        if not pblast_result:
                             print 'BLASTp for %s failed. Skipping...' \
                                 % coreg_gene.TTHERM_ID
                             logging.info('BLASTp for %s failed. Skipping...' \
                                 % coreg_gene.TTHERM_ID)
                             break
 
-                        else:
-                            # This is the case when BLAST was successful
-                            pblast_result = pblast_result_handle.read()
                         
                         pf = open(pf_address, 'wb')
                         pf.write(pblast_result)
@@ -799,21 +1611,16 @@ def NCBI_qBLAST(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption,
                 # keep things as before Dropbox integration
                 elif syncOption == 3:
                     if not os.path.exists(pf_address):
-                        pblast_result_handle = NCBIWWW.qblast("blastp", "nr", 
-                            coreg_gene.protein[13:],
-                            entrez_query = entrez)
+                        pblast_result = forward_BLAST("blastp", coreg_gene, entrez, runOptions)
                         BLASTs_performed += 1
 
-                        if not pblast_result_handle:
+                        if not pblast_result:
                             print 'BLASTp for %s failed. Skipping...' \
                                 % coreg_gene.TTHERM_ID
                             logging.info('BLASTp for %s failed. Skipping...' \
                                 % coreg_gene.TTHERM_ID)
                             break
 
-                        else:
-                            # This is the case when BLAST was successful
-                            pblast_result = pblast_result_handle.read()
                         
                         pf = open(pf_address, 'wb')
                         pf.write(pblast_result)
@@ -828,7 +1635,13 @@ def NCBI_qBLAST(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption,
                             % coreg_gene.TTHERM_ID
                         logging.info('The local BLASTp profile for %s already exists'\
                             % coreg_gene.TTHERM_ID)
-         
+
+        # Sort the unrestricted hits into the requested clade
+        if cladeTest is not None:
+            for program in programs:
+                derive_clade_forward_BLAST(
+                    coreg_gene, program, derivedClade, cladeTest, syncOption)
+
     return
 
 
@@ -837,8 +1650,285 @@ def NCBI_qBLAST(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption,
 # through the pickled coreg_list file). Checks each hit def for 
 # orthology by going to the TGD BLAST server.
 # Look only at the top hit from each species (use regex) and discard others.
+# One semaphore per server, shared by every thread
+_hostSemaphores = {}
+_hostSemaphoresLock = threading.Lock()
+
+def host_semaphore(url):
+    # The semaphore that bounds the open requests to the server of url
+    host = urlparse.urlparse(url).netloc
+    with _hostSemaphoresLock:
+        if host not in _hostSemaphores:
+            _hostSemaphores[host] = threading.BoundedSemaphore(HOST_CONNECTIONS)
+        return _hostSemaphores[host]
+
+
+# The parts of a TGD BLAST result page that parse_tgd_results needs
+PRE_REGEX = re.compile(r'<pre\b[^>]*>(.*?)</pre\s*>', re.DOTALL | re.IGNORECASE)
+LINK_REGEX = re.compile(r'<a\b[^>]*>(.*?)</a\s*>', re.DOTALL | re.IGNORECASE)
+TAG_REGEX = re.compile(r'<[^>]*>')
+NO_HITS_REGEX = re.compile(r'\*+\s*No hits found\s*\*+')
+# Only used for its unescape, which keeps no state between calls
+HTML_PARSER = HTMLParser.HTMLParser()
+
+def pre_text(block):
+    # The text of a <pre> block, as a browser would show it
+    block = block.replace('\r\n', '\n')
+    if block.startswith('\n'):
+        block = block[1:]
+    return HTML_PARSER.unescape(TAG_REGEX.sub('', block))
+
+
+def put_top_hit_first(reciprocalHits, topRecipHit):
+    # The top hit is the first link in the results, which should also be
+    # the first line, but make sure that it comes first.
+    topHits = [hit for hit in reciprocalHits if hit[0] == topRecipHit]
+    if topHits == []:
+        topHits = [(topRecipHit, '', '', '')]
+    return topHits[:1] + [hit for hit in reciprocalHits
+        if hit is not topHits[0]]
+
+
+def parse_tgd_results(html):
+    """ Read the ranked hits out of a TGD BLAST result page, as a list of
+        (TTHERM_ID, description, score, e-value) tuples with the top hit
+        first, or an empty list if nothing was found. The page is only
+        scanned for its <pre> blocks: the second says whether there were
+        hits, and the third has a table of them, after five header lines
+        and before one footer line. A page that does not look like that
+        raises a ValueError, since it means that the TGD has changed its
+        layout.
+    """
+    blocks = PRE_REGEX.findall(html)
+    if len(blocks) < 2:
+        raise ValueError('Unexpected TGD BLAST result layout: %d <pre> blocks' \
+            % len(blocks))
+
+    # Check if there are hits
+    if NO_HITS_REGEX.search(pre_text(blocks[1])):
+        return []
+
+    if len(blocks) < 3:
+        raise ValueError('Unexpected TGD BLAST result layout: no table of hits')
+
+    links = LINK_REGEX.findall(blocks[2])
+    if links == []:
+        raise ValueError('Unexpected TGD BLAST result layout: no linked hits')
+    topRecipHit = str(pre_text(links[0]))
+
+    reciprocalHits = []
+    for hit in pre_text(blocks[2]).split('\n')[5:-1]:
+        items = re.split('\s\s+', hit)
+        if len(items) < 4:
+            raise ValueError('Unexpected TGD BLAST result layout: %r' % hit)
+        reciprocalHits.append((str(items[0]), str(items[1]), str(items[2]),
+            str(items[3])))
+
+    return put_top_hit_first(reciprocalHits, topRecipHit)
+
+
+def parse_tgd_results_bs4(html):
+    """ The original parser for TGD BLAST result pages, through
+        BeautifulSoup and html5lib. It gives the same results as
+        parse_tgd_results, much more slowly, and is kept to check and
+        benchmark that one against (see benchmark_tgd_parsers).
+    """
+    result_soup = bs4.BeautifulSoup(html, 'html5lib')
+
+    # Check if there are hits
+    check = result_soup.find_all('pre')[1].text
+    if '***** No hits found ******' in check:
+        return []
+
+    # Dumps all of the results in one big string  
+    reciprocalResults = result_soup.find_all('pre')[2]
+    topRecipHit = str(reciprocalResults.find_all('a')[0].text)
+
+    reciprocalList = reciprocalResults.text.split('\n')
+    for i in range(5):
+        reciprocalList.pop(0)
+
+    reciprocalList.pop(-1)
+
+    reciprocalHits = []
+    for hit in reciprocalList:
+        items = re.split('\s\s+', hit)
+        reciprocalHits.append((str(items[0]), str(items[1]), str(items[2]),
+            str(items[3])))
+
+    return put_top_hit_first(reciprocalHits, topRecipHit)
+
+
+def benchmark_tgd_parsers(html_addresses, repeats = 20):
+    """ Time parse_tgd_results against parse_tgd_results_bs4 on saved TGD
+        BLAST result pages, and check that they agree.
+    """
+    pages = []
+    for html_address in html_addresses:
+        with open(html_address, 'rb') as html_file:
+            pages.append(html_file.read().decode('utf-8', 'replace'))
+
+    for page, html_address in zip(pages, html_addresses):
+        if parse_tgd_results(page) != parse_tgd_results_bs4(page):
+            print 'The parsers disagree on %s' % html_address
+
+    timings = []
+    for parser in [parse_tgd_results_bs4, parse_tgd_results]:
+        start = time.time()
+        for i in xrange(repeats):
+            for page in pages:
+                parser(page)
+        timings.append((time.time() - start) / (repeats * len(pages)))
+
+    print 'BeautifulSoup/html5lib: %.2f ms per page' % (1000 * timings[0])
+    print 'Streaming parser: %.2f ms per page (%.0fx faster)' \
+        % (1000 * timings[1], timings[0] / max(timings[1], 1e-9))
+
+
+def tgd_reciprocal_search(sequence):
+    """ BLAST sequence against the Tetrahymena proteome on the TGD server.
+        Returns the ranked hits as a list of (TTHERM_ID, description, score,
+        e-value) tuples, with the top hit first, or an empty list if nothing
+        was found.
+    """
+    # Go to the TGD BLAST server
+    with host_semaphore(TGD_BLAST_URL):
+        result = requests.post(TGD_BLAST_URL,
+            data = {"FILTER": 'L', "PROGRAM": 'blastp', "DATALIB": TGD_DATALIB, 
+            "SEQUENCE": sequence})
+
+    return parse_tgd_results(result.text)
+
+
+def cached_reciprocal_search(sequence):
+    """ tgd_reciprocal_search, through the persistent cache of reciprocal
+        results (see SequenceStore.ReciprocalCache). The answer for a
+        sequence only changes with the proteome, so cached results are kept
+        per TGD_PROTEOME_RELEASE.
+    """
+    reciprocalCache = SequenceStore.open_reciprocal_cache()
+    reciprocalHits = reciprocalCache.get(sequence, TGD_PROTEOME_RELEASE)
+    if reciprocalHits is not None:
+        print 'Found the reciprocal BLAST for this sequence in the local cache'
+        logging.info('Found the reciprocal BLAST for this sequence in the local cache')
+        return reciprocalHits
+
+    reciprocalHits = tgd_reciprocal_search(sequence)
+    reciprocalCache.put(sequence, TGD_PROTEOME_RELEASE, reciprocalHits)
+
+    return reciprocalHits
+
+
+def classify_homolog(TTHERM_ID, accessionKey, reciprocalHits):
+    """ Decide from the reciprocal hits of a homolog of TTHERM_ID whether it
+        is an ortholog, an informative paralog, or should be removed.
+        Returns 'ortholog', 'paralog', or 'remove'.
+    """
+    if reciprocalHits == []:
+        # Nothing was found
+        print 'There were no hits for the homolog with accession.version: %s' % accessionKey
+        logging.info('There were no hits for the homolog with accession.version: %s' % accessionKey)
+        return 'remove'
+
+    topRecipHit = reciprocalHits[0][0]
+    recipDict = dict([(ID, [description, evalue])
+        for ID, description, score, evalue in reciprocalHits])
+
+    if TTHERM_ID == topRecipHit:
+        print 'Putative ortholog found.'
+        logging.info('Putative ortholog found.')
+        return 'ortholog'
+
+    elif TTHERM_ID not in recipDict.keys():
+        print 'Reciprocal BLAST not even close.'
+        logging.info('Reciprocal BLAST not even close.')
+        return 'remove'
+
+    # 2017_01_23: Change to a more systematic analysis. Take
+    # reciprocal BLASTs as correct if e-value of original Tetrahymena
+    # gene is within two orders of magnitude of the top hit
+
+    topRecipHit_eval = str(recipDict[topRecipHit][1]).strip()
+    if topRecipHit_eval[0] == 'e':
+        topRecipHit_eval = '1' + topRecipHit_eval
+    topRecipHit_eval = float(topRecipHit_eval)
+
+    target_eval = str(recipDict[TTHERM_ID][1]).strip()
+    if target_eval[0] == 'e':
+        target_eval = '1' + target_eval
+    target_eval = float(target_eval)
+
+    try:
+
+        if topRecipHit_eval / target_eval >= 0.01:
+            print "e-value within two orders of magnitude of top hit: accepting as putative ortholog."
+            logging.info("e-value within two orders of magnitude of top hit: accepting as putative ortholog.")
+            return 'ortholog'
+
+        elif (topRecipHit_eval / target_eval < 0.01) and \
+        (recipDict[topRecipHit][0] == recipDict[TTHERM_ID][0]):
+            print "This gene is likely a paralog, but may still be informative."
+            logging.info("This gene is likely a paralog, but may still be informative.")
+            return 'paralog'
+        
+        else:
+            print "This gene is likely an uninformative paralog."
+            logging.info('This gene is likely an uninformative paralog.')
+            return 'remove'
+    except:
+        # Target e_value equals zero. I think we should take this
+        # even in the cases when it isn't the top hit for some
+        # reason
+        print 'Putative ortholog found.'
+        logging.info('Putative ortholog found.')
+        return 'ortholog'
+
+
+def rank_hits(root):
+    """ The accessions of the hits in a forward BLAST XML tree, best first:
+        by the bit score of their best HSP, then by its e-value.
+    """
+    hitTable = BlastXML.HitTable.from_hits(root.iter('Hit'))
+    return [hitTable.accessions[index] for index in hitTable.ranked()]
+
+
+def budget_minimum(budget):
+    # The fewest hits that budgeted mode reciprocates for a gene (if it has
+    # that many): the first round, after which it may stop
+    return min(budget, RECIPROCAL_WORKERS)
+
+
+def remove_redundant_species(root):
+    """ Keep only the top hit of each species in a forward BLAST XML tree.
+        Returns the number of hits removed.
+    """
+    # Make sure that each species is represented in the BLAST 
+    # results only once. The species are read out of the definitions with
+    # the same regex as used in CoregFilesIO to clean up the results for
+    # phrase analysis.
+    # For some reason, when removing nodes from XML files with
+    # this library, the node has to be referenced relative to
+    # its direct parent.
+    parent = root.find('BlastOutput_iterations').find(
+        'Iteration').find('Iteration_hits')
+    hits = list(parent)
+    redundant = set(BlastXML.HitTable.from_hits(hits).redundant_species())
+
+    # The kept hits are put back all at once, rather than removing the
+    # others one by one
+    if redundant:
+        parent[:] = [hit for index, hit in enumerate(hits) if index not in redundant]
+
+    hitDelCount = len(redundant)
+
+    print 'Removed %d redundant homologs' % hitDelCount
+    logging.info('Removed %d redundant homologs' % hitDelCount)
+
+    return hitDelCount
+
+
 def reciprocal_BLAST(blast_address, coreg_gene,
-    blastOption, clade):
+    blastOption, clade, runOptions = None):
     """ Use BLAST result reading from CoregFilesIO. 
 
         Called by get_BLAST_homologues_dict in CoregFilesIO
@@ -848,61 +1938,28 @@ def reciprocal_BLAST(blast_address, coreg_gene,
         coreg_gene
         blastOption, for file name
         clade, for file name
+        runOptions, from the master module. With runOptions['hspQueries'],
+        the reciprocal queries are the aligned subject regions from the
+        forward BLAST, and nothing is fetched from Entrez. With
+        runOptions['reciprocalBudget'], at most that many hits are
+        reciprocated, best first, stopping early once the remaining hits
+        could not change the summary phrases, whatever their reciprocal
+        BLASTs said. The others are marked 'skipped'.
 
 
     """
+    if runOptions is None:
+        runOptions = {}
+
     # pdb.set_trace()
     print
-    # blast_adress given as parameter
-    tree = ET.parse(blast_address)
+    # blast_adress given as parameter. Only the fields that are needed are
+    # read in, a hit at a time.
+    tree = BlastXML.load_blast_xml(blast_address)
 
     root = tree.getroot()
 
-    # First make sure that each species is represented in the BLAST 
-    # results only once. Use the same regex as used in CoregFilesIO
-    # to clean up the results for phrase analysis. I noticed that 
-    # There is one species listing in the form '[[genus] species]'
-    # that was causing me trouble, so I modified the regex. It seems
-    # to work.
-
-    speciesRegex = r'\[{1,2}[^\[]*\]'
-
-    hitDefs = [hitDef.text for hitDef in root.iter('Hit_def')]
-
-    specList = []
-    hitRemovalList = []
-
-    for hitDef in hitDefs:
-        specObj = re.search(speciesRegex, hitDef)
-        if specObj:
-            if specObj.group() not in specList:
-                specList.append(specObj.group())
-
-    for spec in specList:
-        specCount = 0
-        for hitDef in hitDefs:
-            if spec in hitDef:
-                specCount += 1
-                if specCount > 1:
-                    hitRemovalList.append(hitDef)
-
-    hitDelCount = 0
-    for target in hitRemovalList:
-        for hit in root.iter('Hit'):
-            if target == hit.find('Hit_def').text:
-
-                # For some reason, when removing nodes from XML files with
-                # this library, the node has to be referenced relative to
-                # its direct parent.
-                parent = root.find('BlastOutput_iterations').find(
-                    'Iteration').find('Iteration_hits')
-                parent.remove(hit)
-
-                hitDelCount += 1
-                break
-
-    print 'Removed %d redundant homologs' % hitDelCount
-    logging.info('Removed %d redundant homologs' % hitDelCount)
+    remove_redundant_species(root)
     
 
 
@@ -915,17 +1972,7 @@ def reciprocal_BLAST(blast_address, coreg_gene,
 
     #August 5, 2016
     #updating to migrate from gi ids to accession.version.
-    accessionseqDict = {}
-
-    # Much better way than the commented-out chunk below.
-    accessionidList = [ids.text for ids in root.iter('Hit_accession')]
-
-    for accession in accessionidList:
-        # Figured this out from Biopython tutorial section 9
-        handle = Entrez.efetch(db='protein', id=accession, retmode='xml')
-        record = Entrez.read(handle)
-        handle.close()
-        accessionseqDict[accession] = record[0]['GBSeq_sequence']
+    accessionseqDict = reciprocal_queries(root, runOptions)
 
     # Initialize an empty list that will contain all accession ids to remove
     # because I am confident that they are not informative
@@ -941,160 +1988,89 @@ def reciprocal_BLAST(blast_address, coreg_gene,
 
     quality_dict = {}
 
-    # loop over the keys (accession.versions) for the given gene from the coreg_list, as
-    # named by coreg_gene.TTHERM_ID
-    for accessionKey in accessionseqDict:
-        print
-        print
-        print 'Reciprocating next homolog with accession.version %s and sequence' % accessionKey
-        logging.info('Reciprocating next homolog with accession.version %s and sequence' % accessionKey)
-        print accessionseqDict[accessionKey]
-        logging.info(accessionseqDict[accessionKey])
-        print
-        recipDone = False
-        recipAttemptNum = 1
-        while not recipDone:
-            try:
-                # Go to the TGD BLAST server
-                result = requests.post('http://www.ciliate.org/blast/blast_link_result.cgi',
-                    data = {"FILTER": 'L', "PROGRAM": 'blastp', "DATALIB": 'tetrahymena/ttherm.aa', 
-                    "SEQUENCE": accessionseqDict[accessionKey]})
-
-                result_soup = bs4.BeautifulSoup(result.text, 'html5lib')
-
-                # if browser.title == u'':
-                #     # Database selection messed up
-                #     recipAttemptNum += 1
-                #     continue
-
-                # elif browser.title == u'BLAST Search Results':
-                    # Everything seems to have worked, but check if there are hits
-                check = result_soup.find_all('pre')[1].text
-                if '***** No hits found ******' in check:
-                    # Nothing was found
-                    print 'There were no hits for the homolog with accession.version: %s' % accessionKey
-                    logging.info('There were no hits for the homolog with accession.version: %s' % accessionKey)
-                    removalList.append(accessionKey)
-                    quality_dict[accessionKey] = 'remove'
-                    topRecipHit = 'fail'
-                    recipDone = True
-                    break
-
-            except:
-                print 'There was an error:'
-                raise
-                topRecipHit = 'fail'
-                recipDone = True
-                break
-
-            else:
-                # Everything worked 
-                # Get the top hit
-                # Dumps all of the results in one big string  
-                reciprocalResults = result_soup.find_all('pre')[2]
-                topRecipHit = str(reciprocalResults.find_all('a')[0].text)
-
-
-                if reciprocalResults == '':
-                    print 'There were no results for this sequence'
-                    logging.info('There were no results for this sequence')
-                    reciprocalResults = None
-                    recipDone = True
-
-                else:
-                    # Got the reciprocalHit:
-                    reciprocalList = reciprocalResults.text.split('\n')
-                    for i in range(5):
-                        reciprocalList.pop(0)
-
-                    reciprocalList.pop(-1)
-
-                    recipDict = {}
-
-                    for hit in reciprocalList:
-                        items = re.split('\s\s+', hit)
-                        recipDict[items[0]] = [items[1], items[3]]
-
-                    recipDone = True
-                    break
-
-
-        if topRecipHit == 'fail':
-            # Go to the next sequence without doing anything
-            # time.sleep(1)
-            continue
-        
-        elif coreg_gene.TTHERM_ID == topRecipHit:
-            print 'Putative ortholog found.'
-            logging.info('Putative ortholog found.')
-            quality_dict[accessionKey] = 'ortholog'
-            orthologList.append(accessionKey)
+    budget = runOptions.get('reciprocalBudget', 0)
+    if budget:
+        # Best forward hits first, so that what is skipped matters least
+        accessionOrder = [accession for accession in rank_hits(root)
+            if accession in accessionseqDict]
+        roundSize = RECIPROCAL_WORKERS
+        hitDefDict = dict([(hit.find('Hit_accession').text, hit.find('Hit_def').text)
+            for hit in root.iter('Hit')])
+        # The report goes through the homologs in the order of the file
+        fileOrder = [hit.find('Hit_accession').text for hit in root.iter('Hit')]
+    else:
+        accessionOrder = list(accessionseqDict)
+        roundSize = max(1, len(accessionOrder))
+
+    settled = False
+
+    # The reciprocal BLASTs of a round are run all at once. The results are
+    # then gone through in order, so the classification is the same as if
+    # they had been run one after another. Without a budget, everything is
+    # one round.
+    for start in xrange(0, len(accessionOrder), roundSize):
+        if budget and start >= budget:
+            break
+        roundKeys = accessionOrder[start:start + roundSize]
+        if budget:
+            roundKeys = roundKeys[:budget - start]
+
+        reciprocalHitsDict = reciprocate_sequences(
+            [accessionseqDict[accessionKey] for accessionKey in roundKeys])
+
+        # loop over the keys (accession.versions) for the given gene from the coreg_list, as
+        # named by coreg_gene.TTHERM_ID
+        for accessionKey in roundKeys:
+            print
             print
+            print 'Reciprocating next homolog with accession.version %s and sequence' % accessionKey
+            logging.info('Reciprocating next homolog with accession.version %s and sequence' % accessionKey)
+            print accessionseqDict[accessionKey]
+            logging.info(accessionseqDict[accessionKey])
             print
 
-        elif coreg_gene.TTHERM_ID not in recipDict.keys():
-            print 'Reciprocal BLAST not even close.'
-            logging.info('Reciprocal BLAST not even close.')
-            quality_dict[accessionKey] = 'remove'
-            removalList.append(accessionKey)
-            pass
+            quality = classify_homolog(coreg_gene.TTHERM_ID, accessionKey,
+                reciprocalHitsDict[accessionseqDict[accessionKey]])
+            quality_dict[accessionKey] = quality
+            if quality == 'ortholog':
+                orthologList.append(accessionKey)
+            elif quality == 'paralog':
+                paralogList.append(accessionKey)
+            else:
+                removalList.append(accessionKey)
             print
             print
 
+        if budget:
+            # Stop once the hits that are left within the budget could not
+            # change the summary phrases
+            remainingKeys = set(accessionOrder[start + len(roundKeys):budget])
+            if remainingKeys and CoregFilesIO.summary_is_settled(
+                [[hitDefDict[accessionKey], quality_dict.get(accessionKey)]
+                    for accessionKey in fileOrder
+                    if accessionKey in quality_dict or accessionKey in remainingKeys]):
+                settled = True
+                break
 
-        # 2017_01_23: Change to a more systematic analysis. Take
-        # reciprocal BLASTs as correct if e-value of original Tetrahymena
-        # gene is within two orders of magnitude of the top hit
-
-        elif (topRecipHit != coreg_gene.TTHERM_ID):
-                
-            if coreg_gene.TTHERM_ID in recipDict.keys():                
-                topRecipHit_eval = str(recipDict[topRecipHit][1]).strip()
-                if topRecipHit_eval[0] == 'e':
-                    topRecipHit_eval = '1' + topRecipHit_eval
-                topRecipHit_eval = float(topRecipHit_eval)
-
-                target_eval = str(recipDict[coreg_gene.TTHERM_ID][1]).strip()
-                if target_eval[0] == 'e':
-                    target_eval = '1' + target_eval
-                target_eval = float(target_eval)
-
-                try:
-
-                    if topRecipHit_eval / target_eval >= 0.01:
-                        print "e-value within two orders of magnitude of top hit: accepting as putative ortholog."
-                        logging.info("e-value within two orders of magnitude of top hit: accepting as putative ortholog.")
-                        orthologList.append(accessionKey)
-                        quality_dict[accessionKey] = 'ortholog'
-                        print
-                        print
-
-                    elif (topRecipHit_eval / target_eval < 0.01) and \
-                    (recipDict[topRecipHit][0] == recipDict[coreg_gene.TTHERM_ID][0]):
-                        print "This gene is likely a paralog, but may still be informative."
-                        logging.info("This gene is likely a paralog, but may still be informative.")
-                        paralogList.append(accessionKey)
-                        quality_dict[accessionKey] = 'paralog'
-                        print
-                        print
-                    
-                    else:
-                        print "This gene is likely an uninformative paralog."
-                        logging.info('This gene is likely an uninformative paralog.')
-                        removalList.append(accessionKey)
-                        quality_dict[accessionKey] = 'remove'
-                        print
-                        print
-                except:
-                    # Target e_value equals zero. I think we should take this
-                    # even in the cases when it isn't the top hit for some
-                    # reason
-                    print 'Putative ortholog found.'
-                    logging.info('Putative ortholog found.')
-                    quality_dict[accessionKey] = 'ortholog'
-                    orthologList.append(accessionKey)
-                    print
-                    print                    
+    # Hits that were never reciprocated are marked as skipped
+    skippedList = [accessionKey for accessionKey in accessionOrder
+        if accessionKey not in quality_dict]
+    for accessionKey in skippedList:
+        quality_dict[accessionKey] = 'skipped'
+
+    if budget:
+        if settled:
+            reason = 'the rest could not change the summary'
+        elif skippedList:
+            reason = 'the budget was spent'
+        else:
+            reason = 'all were within the budget'
+        print 'Reciprocated %d of %d homologs of %s; skipped %d (%s)' \
+            % (len(accessionOrder) - len(skippedList), len(accessionOrder),
+                coreg_gene.TTHERM_ID, len(skippedList), reason)
+        logging.info('Reciprocated %d of %d homologs of %s; skipped %d (%s)' \
+            % (len(accessionOrder) - len(skippedList), len(accessionOrder),
+                coreg_gene.TTHERM_ID, len(skippedList), reason))
 
     # Remove the uninformative homolog. Iterate over the hits_ids in the
     # forward BLAST data
@@ -1116,12 +2092,32 @@ def reciprocal_BLAST(blast_address, coreg_gene,
             hit_def.set('quality', 'paralog')
         elif plan == 'remove':
             hit_def.set('quality', 'remove')                                
+        elif plan == 'skipped':
+            hit_def.set('quality', 'skipped')
 
     print 'Marked the following homologs for removal from analysis: '
     logging.info('Marked the following homologs for removal from analysis: ' )
     print removalList
 
+    # The hits were worked on in their slim form. The result that is written
+    # out has the kept hits in full, as they are in the forward BLAST file.
+    hitQualities = dict([(hit.findtext('Hit_num'), hit.find('Hit_def').get('quality'))
+        for hit in root.iter('Hit')])
+    tree = BlastXML.load_blast_xml(blast_address, fullHits = hitQualities)
+    for hit in tree.getroot().iter('Hit'):
+        quality = hitQualities[hit.findtext('Hit_num')]
+        if quality is not None:
+            hit.find('Hit_def').set('quality', quality)
+
     # return new XML data without the paralogs. The file will be written by
     # the higher level function CoregFilesIO.get_BLAST_homologues_dict()
     return (tree, orthologList, paralogList)
 
+
+if (__name__ == '__main__'):
+    # Benchmark the TGD result parsers on saved result pages
+    if len(sys.argv) < 2:
+        print 'Usage: python BLASTmod.py saved_tgd_result.html [...]'
+        sys.exit()
+
+    benchmark_tgd_parsers(sys.argv[1:])
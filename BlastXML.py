@@ -0,0 +1,312 @@
+#!/usr/bin/python
+
+"""
+    Coregulation Data Harvester--A tool for organizing and predicting
+    Tetrahymena thermophila gene annotations
+
+    Copyright (C) 2015-2017 Lev M Tsypin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    If you choose to publish research based on this software, or distribute
+    any work containing it, please make a notice of the copyright holder's
+    attribution. If you derivitize or modify the software, please make
+    a note that it is a derived work.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+__author__ = 'Lev Tsypin (Ltsypin@gmail.com)'
+__version__ = '1.2.1'
+
+""" Streaming reader for BLAST XML files. Rather than building the whole
+    tree with ET.parse, the files are read with iterparse one hit at a
+    time. Only the fields that the pipeline uses are kept (see HIT_FIELDS
+    and HSP_FIELDS; the query and midline alignment strings, which are most
+    of a large file, are dropped), and each parsed hit is thrown away as
+    soon as it has been copied. Results that are written back out (the
+    reciprocal BLASTs) are read again for that with their hits in full, so
+    that nothing is lost from the files.
+
+    HitTable holds the parsed hits of one result in flat columns, so that
+    the species filter, the quality tags, and the cleaning of definitions
+    are each one pass over it.
+
+    Files may be gzip-compressed (they are recognized by their first two
+    bytes, whatever they are called). Plain files are memory-mapped, so that
+    reading them does not copy them into memory first.
+"""
+
+# imports
+import os
+import re
+import gzip
+import mmap
+from array import array
+import xml.etree.ElementTree as ET
+
+# constants
+
+# The fields of a hit, and of each of its HSPs, that the pipeline uses
+HIT_FIELDS = ['Hit_num', 'Hit_id', 'Hit_def', 'Hit_accession', 'Hit_len',
+    'Hit_taxid']
+HSP_FIELDS = ['Hsp_num', 'Hsp_bit-score', 'Hsp_score', 'Hsp_evalue',
+    'Hsp_query-from', 'Hsp_query-to', 'Hsp_hit-from', 'Hsp_hit-to',
+    'Hsp_identity', 'Hsp_positive', 'Hsp_align-len', 'Hsp_hseq']
+
+GZIP_MAGIC = '\x1f\x8b'
+
+# [genus species] at the end of a hit definition. I noticed that there is
+# one species listing in the form '[[genus] species]' that was causing me
+# trouble, so I modified the regex. It seems to work.
+SPECIES_REGEX = re.compile(r'\[{1,2}[^\[]*\]')
+# >gi identifiers that pollute some definitions. They have multiple forms,
+# but each starts with >gi and has no spaces.
+GI_REGEX = re.compile(r'(\>gi[^\s]*)')
+SPACES_REGEX = re.compile(r'\s{2,}')
+
+
+def open_blast_xml(address):
+    """ Open a BLAST XML file for reading: through gzip if it is
+        compressed, and memory-mapped otherwise.
+    """
+    with open(address, 'rb') as blast_file:
+        magic = blast_file.read(2)
+
+    if magic == GZIP_MAGIC:
+        return gzip.open(address, 'rb')
+
+    if os.path.getsize(address) == 0:
+        return open(address, 'rb')
+
+    with open(address, 'rb') as blast_file:
+        return mmap.mmap(blast_file.fileno(), 0, access = mmap.ACCESS_READ)
+
+
+def slim_hit(hit):
+    # A copy of a Hit element with only HIT_FIELDS and HSP_FIELDS
+    slim = ET.Element('Hit')
+    for child in hit:
+        if child.tag in HIT_FIELDS:
+            field = ET.SubElement(slim, child.tag, child.attrib)
+            field.text = child.text
+
+    hsps = ET.SubElement(slim, 'Hit_hsps')
+    for hsp in hit.iter('Hsp'):
+        slimHsp = ET.SubElement(hsps, 'Hsp')
+        for child in hsp:
+            if child.tag in HSP_FIELDS:
+                field = ET.SubElement(slimHsp, child.tag)
+                field.text = child.text
+
+    return slim
+
+
+def iter_hits(address):
+    """ Yield the hits of a BLAST XML file one at a time, as slim Hit
+        elements, without holding on to the rest of the file.
+    """
+    blast_file = open_blast_xml(address)
+    try:
+        parent = None
+        for event, element in ET.iterparse(blast_file, events = ('start', 'end')):
+            if event == 'start':
+                if element.tag == 'Iteration_hits':
+                    parent = element
+            elif element.tag == 'Hit':
+                yield slim_hit(element)
+                # Each hit is the only child left when it ends, so this is
+                # cheap, and nothing piles up
+                if parent is not None:
+                    parent.remove(element)
+                element.clear()
+    finally:
+        blast_file.close()
+
+
+def load_blast_xml(address, fullHits = None):
+    """ Read a BLAST XML file into an ElementTree, streaming the hits and
+        keeping only their slim copies. The tree has the same layout as the
+        one ET.parse would give, and can be used and written the same way.
+
+        If fullHits is given, only the hits whose Hit_num is in it are kept,
+        but these are kept whole, with every field. This is for writing out
+        a result that was worked out on the slim hits.
+    """
+    blast_file = open_blast_xml(address)
+    try:
+        root = None
+        parent = None
+        keptHits = []
+        for event, element in ET.iterparse(blast_file, events = ('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = element
+                if element.tag == 'Iteration_hits':
+                    parent = element
+                    keptHits = []
+            elif element.tag == 'Hit':
+                parent.remove(element)
+                if fullHits is None:
+                    keptHits.append(slim_hit(element))
+                    element.clear()
+                elif element.findtext('Hit_num') in fullHits:
+                    keptHits.append(element)
+                else:
+                    element.clear()
+            elif element.tag == 'Iteration_hits':
+                element.extend(keptHits)
+                keptHits = []
+    finally:
+        blast_file.close()
+
+    return ET.ElementTree(root)
+
+
+def read_homolog_definitions(address):
+    """ Stream the hit definitions of a reciprocal BLAST XML file. Returns
+        a list of [definition, quality] lists, and the list of iteration
+        messages (which explain an empty result).
+    """
+    definitions = []
+    messages = []
+    blast_file = open_blast_xml(address)
+    try:
+        for event, element in ET.iterparse(blast_file):
+            if element.tag == 'Hit_def':
+                definitions.append([element.text, element.get('quality')])
+            elif element.tag == 'Iteration_message':
+                messages.append(element.text)
+            elif element.tag == 'Hit':
+                element.clear()
+    finally:
+        blast_file.close()
+
+    return definitions, messages
+
+
+def tree_homolog_definitions(tree):
+    # read_homolog_definitions, for a reciprocal BLAST tree already in memory
+    definitions = []
+    messages = []
+    for element in tree.getroot().iter():
+        if element.tag == 'Hit_def':
+            definitions.append([element.text, element.get('quality')])
+        elif element.tag == 'Iteration_message':
+            messages.append(element.text)
+
+    return definitions, messages
+
+
+def read_blast_database(address):
+    """ The database that a BLAST XML file was searched against, from its
+        BlastOutput_db field (near the top, so little of the file is read),
+        or None if it has none.
+    """
+    blast_file = open_blast_xml(address)
+    try:
+        for event, element in ET.iterparse(blast_file):
+            if element.tag == 'BlastOutput_db':
+                return element.text
+            elif element.tag == 'Hit':
+                element.clear()
+    except ET.ParseError:
+        pass
+    finally:
+        blast_file.close()
+
+    return None
+
+
+def clean_definition(definition):
+    """ Remove >gi identifiers and [genus species] from a hit definition,
+        along with the left-over whitespace.
+    """
+    return SPACES_REGEX.sub(' ', SPECIES_REGEX.sub('', GI_REGEX.sub('', definition)))
+
+
+def intern_text(text):
+    # ElementTree gives unicode for non-ASCII text, which cannot be interned
+    # (or turned into str), so only str is
+    if type(text) is str:
+        return intern(text)
+    return text
+
+
+class HitTable:
+    # Column-wise table of the hits of a BLAST result, in their original
+    # order. Species and qualities are interned, since they repeat a lot.
+    # evalues and bitScores are those of each hit's best HSP.
+
+    def __init__(self):
+        self.accessions = []
+        self.definitions = []
+        self.species = []
+        self.evalues = array('d')
+        self.bitScores = array('d')
+        self.qualities = []
+
+    @classmethod
+    def from_hits(cls, hits):
+        """ Build the table in one pass over Hit elements (from a tree's
+            root.iter('Hit'), or from iter_hits)
+        """
+        table = cls()
+        for hit in hits:
+            definition = hit.findtext('Hit_def') or ''
+            table.accessions.append(hit.findtext('Hit_accession'))
+            table.definitions.append(definition)
+            table.species.append(tuple([intern_text(species) for species
+                in SPECIES_REGEX.findall(definition)]))
+
+            evalues = [float(hsp.findtext('Hsp_evalue')) for hsp in hit.iter('Hsp')
+                if hsp.findtext('Hsp_evalue')]
+            bitScores = [float(hsp.findtext('Hsp_bit-score')) for hsp in hit.iter('Hsp')
+                if hsp.findtext('Hsp_bit-score')]
+            table.evalues.append(min(evalues or [10.0]))
+            table.bitScores.append(max(bitScores or [0.0]))
+
+            quality = hit.find('Hit_def').get('quality') \
+                if hit.find('Hit_def') is not None else None
+            table.qualities.append(intern_text(quality) if quality else None)
+
+        return table
+
+    def __len__(self):
+        return len(self.accessions)
+
+    def redundant_species(self):
+        """ The indices of the hits that repeat a species already seen
+            higher up. A species is the first [genus species] of some
+            definition, and a hit repeats it if any of its own bracketed
+            names is that species.
+        """
+        listedSpecies = set([species[0] for species in self.species if species])
+
+        seen = set()
+        redundant = []
+        for index, species in enumerate(self.species):
+            listed = listedSpecies.intersection(species)
+            if listed & seen:
+                redundant.append(index)
+            seen.update(listed)
+
+        return redundant
+
+    def ranked(self):
+        # Indices of the hits, best first: by bit score, then by e-value
+        return sorted(xrange(len(self)), key = lambda index:
+            (-self.bitScores[index], self.evalues[index], index))
+
+    def clean_definitions(self):
+        return [clean_definition(definition) for definition in self.definitions]
@@ -36,20 +36,38 @@ import platform
 import time
 import re
 import dill
+import hashlib
 import difflib
 import csv
 import pdb
 import shutil
+import multiprocessing
+import multiprocessing.pool
 import CoregulationDataHarvester
 import BLASTmod
 import time
 import logging
 import filename_generator
+import OrthologGroups
+import BlastXML
+import LongestPhrases
+import TokenSummarizer
+import RunContext
+import GeneResults
 import xml.etree.ElementTree as ET
 
 if platform.system() == 'Windows':
     from win32com.shell import shell, shellcon
 
+# Source tag for homologs that were found by the BLASTs (as opposed to
+# OrthologGroups.SOURCE)
+BLAST_SOURCE = 'BLAST'
+
+# Part of the key of every gene's phrase analysis in the gene result store
+# (see analysis_version). Change it whenever the analysis changes, so that
+# results kept from earlier runs are not reused.
+PHRASE_ANALYSIS_VERSION = '1'
+
 def get_best_reciprocal_longest_matches(phrase_dict):
     """ Get two phrases from the ones found by 
         longest_phrases_in_homologue_info. Put the one with the most counts
@@ -129,21 +147,10 @@ def clean_homologue_info(raw_homologue_dict, clade):
             for index, info in enumerate(raw_homologue_dict[key]):
                 # info is the list [definition, quality]
 
-                # regex for getting all the gi codes
-                regex1 = r'(\>gi[^\s]*)'
-                # regex for getting all the [genus species]. I noticed that 
-                # There is one species listing in the form '[[genus] species]'
-                # that was causing me trouble, so I modified the regex. It seems
-                # to work.
-                regex2 = r'\[{1,2}[^\[]*\]'
-
                 # remove gi codes, [genus species], and extra left-over 
-                # whitespace
-                info_nogi = re.sub(regex1, '', info[0])
-                info_noSpecies = re.sub(regex2, '', info_nogi)
-                cleaned_info = re.sub(r'\s{2,}', ' ', info_noSpecies)
-                # pdb.set_trace()
-                raw_homologue_dict[key][index][0] = cleaned_info
+                # whitespace, with the same regexes that BLASTmod uses to
+                # find the species of each hit
+                raw_homologue_dict[key][index][0] = BlastXML.clean_definition(info[0])
         else:
             # Empty lists get explicitly explained (see above)
             raw_homologue_dict[key].append(
@@ -154,8 +161,43 @@ def clean_homologue_info(raw_homologue_dict, clade):
 
     return clean_homologue_dict
 
+def get_homologue_sources(clean_homologue_dict):
+    """ Say for each gene where its homologs came from: BLAST_SOURCE, or
+        OrthologGroups.SOURCE for genes answered by imported ortholog groups.
+        This goes into the bestPhraseDict, so that make_CSV can report it.
+    """
+    sourceDict = {}
+    for key in clean_homologue_dict:
+        sourceDict[key] = BLAST_SOURCE
+        for info in clean_homologue_dict[key]:
+            if len(info) > 2:
+                sourceDict[key] = info[2]
+                break
+
+    return sourceDict
+
+def get_blast_databases(clean_homologue_dict, program, clade):
+    """ Say for each gene which database its forward BLAST result came from
+        (with tiered searches, see BLASTmod.forward_BLAST). Genes without a
+        forward result, such as those answered by imported ortholog groups,
+        are left out. This goes into the bestPhraseDict, so that make_CSV
+        can report it.
+    """
+    databaseDict = {}
+    for key in clean_homologue_dict:
+        blast_address, drop_blast_address, reciprocal_blast_address, drop_reciprocal_blast_address = \
+            filename_generator.filename_generator('blast', [key],
+                clade = clade, blastOption = program)
+        for address in [blast_address, drop_blast_address]:
+            if os.path.exists(address):
+                databaseDict[key] = BlastXML.read_blast_database(address)
+                break
+
+    return databaseDict
+
 def get_BLAST_homologues_dict(
-    formatted_TTHERM_ID_list, threshold, owOption, syncOption, blastOption, clade):
+    formatted_TTHERM_ID_list, threshold, owOption, syncOption, blastOption, clade,
+    runOptions = None):
     """ Read through XML file and take all the hit info for the gene.
         Probably build a single dictionary that encompasses all genes in
         the coregulated group:
@@ -176,15 +218,30 @@ def get_BLAST_homologues_dict(
 
         output: a dictionary where each key is the TTHERM_ID of a gene in the
         coregulated gene group, and each value is a list of lists. The little
-        lists in the the item are a cleaned up homolog definition and its
-        quality (ortholog, paralog, or remove). I am calling this 
+        lists in the the item are a cleaned up homolog definition, its
+        quality (ortholog, paralog, or remove), and its source (BLAST, or
+        the imported ortholog groups). I am calling this 
         clean_homologue_dict.
 
         NOTE: always called with either BLASTp or BLASTx as the BLAST option.
         If the user specified that they want both, then the function is run
         twice, once with each. Otherwise, there is no good way to identify
         file names!
+
+        runOptions holds the optional strategies chosen in the master module.
+        Clades derived locally with runOptions['deriveClades'] have ordinary
+        forward results by now (see BLASTmod.derive_clade_forward_BLAST), so
+        only their own hits are reciprocated. With
+        runOptions['orthologGroups'], genes covered by the imported ortholog
+        groups (see OrthologGroups) take their homologs from there instead,
+        kept to the clade of runOptions['entrez'].
+        runOptions['hspQueries'] is passed on to BLASTmod.reciprocal_BLAST,
+        and runOptions['hspComparisonSample'] genes are first run both ways
+        for a comparison report.
     """
+    if runOptions is None:
+        runOptions = {}
+
     # Unpickle the file with coregs_zscores_cDNA_list for the given TTHERM_ID
     # and threshold for the search.
 
@@ -194,14 +251,35 @@ def get_BLAST_homologues_dict(
     p_homodict_pickle_address, x_homodict_pickle_address = filename_generator.filename_generator(
     	'homologue_dict', formatted_TTHERM_ID_list, threshold = threshold)
 
-    pickled_coregs_cDNA_file = open(pickled_coregs_cDNA_address, 'rb')
-    coregs_zscores_cDNA_list = dill.load(pickled_coregs_cDNA_file)
+    coregs_zscores_cDNA_list = RunContext.load_pickle(pickled_coregs_cDNA_address)
 
     toBLAST = BLASTmod.to_blast(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, threshold)
 
+    # Genes covered by imported ortholog groups do not need any BLASTs
+    orthologGroupStore = None
+    if runOptions.get('orthologGroups', False):
+        orthologGroupStore = OrthologGroups.open_store(runOptions.get('entrez', ''))
+
+    # Before the real run, compare HSP-subject queries with full sequences
+    # on a sample of the genes
+    if runOptions.get('hspComparisonSample', 0):
+        BLASTmod.compare_reciprocal_modes(
+            toBLAST[:runOptions['hspComparisonSample']], blastOption, clade,
+            filename_generator.filename_generator('hsp_comparison',
+                formatted_TTHERM_ID_list, clade = clade,
+                blastOption = blastOption, threshold = threshold))
+
     # Initialize the dictionary where everything will go
     raw_homologue_dict = {}
     for coreg_gene in toBLAST:
+        if orthologGroupStore is not None:
+            groupHomologs = orthologGroupStore.get_homologs(coreg_gene.TTHERM_ID)
+            if groupHomologs is not None:
+                print 'Using imported ortholog groups for %s' % coreg_gene.TTHERM_ID
+                logging.info('Using imported ortholog groups for %s' % coreg_gene.TTHERM_ID)
+                raw_homologue_dict[coreg_gene.TTHERM_ID] = groupHomologs
+                continue
+
         list_TTHERM_ID = []
         list_TTHERM_ID.append(coreg_gene.TTHERM_ID)
     	blast_address, drop_blast_address, reciprocal_blast_address, drop_reciprocal_blast_address = \
@@ -232,27 +310,27 @@ def get_BLAST_homologues_dict(
                 % (blastOption, coreg_gene.TTHERM_ID))
             
             recipTree = BLASTmod.reciprocal_BLAST(
-                blast_address, coreg_gene, blastOption, clade)[0]
+                blast_address, coreg_gene, blastOption, clade, runOptions)[0]
 
 
             if syncOption == 1:
                 # Write both locally and to Dropbox
                 print 'Writing reciprocal BLAST results both locally and to Dropbox'
                 logging.info('Writing reciprocal BLAST results both locally and to Dropbox')
-                recipTree.write(drop_reciprocal_blast_address)
-                recipTree.write(reciprocal_blast_address)
+                RunContext.write_tree(recipTree, drop_reciprocal_blast_address,
+                    reciprocal_blast_address)
 
             elif syncOption == 2:
                 # Write only to Dropbox
                 print 'Writing reciprocal BLAST results to Dropbox'
                 logging.info('Writing reciprocal BLAST results to Dropbox')
-                recipTree.write(drop_reciprocal_blast_address)
+                RunContext.write_tree(recipTree, drop_reciprocal_blast_address)
 
             elif syncOption == 3:
                 # Write only locally
                 print 'Writing reciprocal BLAST results locally'
                 logging.info('Writing reciprocal BLAST results locally')
-                recipTree.write(reciprocal_blast_address)
+                RunContext.write_tree(recipTree, reciprocal_blast_address)
 
         elif owOption == 3:
             # Keep everything possible
@@ -269,7 +347,7 @@ def get_BLAST_homologues_dict(
 
                     src = drop_reciprocal_blast_address
                     dst = reciprocal_blast_address
-                    shutil.copy2(src, dst)
+                    RunContext.copy_file(src, dst)
 
                 elif not os.path.exists(drop_reciprocal_blast_address) and\
                     os.path.exists(reciprocal_blast_address):
@@ -280,7 +358,7 @@ def get_BLAST_homologues_dict(
                     logging.info('Found local copy of reciprocally filtered %s for %s that is absent in Dropbox. Copying to Dropbox for synchronization.'.format(blastOption, coreg_gene.TTHERM_ID))
                     src = reciprocal_blast_address
                     dst = drop_reciprocal_blast_address
-                    shutil.copy2(src, dst)
+                    RunContext.copy_file(src, dst)
 
                 elif not os.path.exists(drop_reciprocal_blast_address) and\
                     not os.path.exists(reciprocal_blast_address):
@@ -298,20 +376,20 @@ def get_BLAST_homologues_dict(
                     # pdb.set_trace()
                     recipTree = BLASTmod.reciprocal_BLAST(
                         blast_address, coreg_gene, 
-                        blastOption, clade)[0]
+                        blastOption, clade, runOptions)[0]
 
                     if syncOption == 1:
                         # User wants both local and Dropbox
-                        recipTree.write(drop_reciprocal_blast_address)
-                        recipTree.write(reciprocal_blast_address)
+                        RunContext.write_tree(recipTree, drop_reciprocal_blast_address,
+                            reciprocal_blast_address)
 
                     elif syncOption == 2:
                         # User only wants to write to Dropbox
-                        recipTree.write(drop_reciprocal_blast_address)
+                        RunContext.write_tree(recipTree, drop_reciprocal_blast_address)
 
                     elif syncOption == 3:
                         # User only wants to write locally
-                        recipTree.write(reciprocal_blast_address)
+                        RunContext.write_tree(recipTree, reciprocal_blast_address)
 
             elif syncOption == 3:
                 # User only want to run things locally
@@ -334,21 +412,32 @@ def get_BLAST_homologues_dict(
                         % (blastOption, coreg_gene.TTHERM_ID))
                     recipTree = BLASTmod.reciprocal_BLAST(
                         blast_address, coreg_gene, 
-                        blastOption, clade)[0]
+                        blastOption, clade, runOptions)[0]
 
-                    recipTree.write(reciprocal_blast_address)
+                    RunContext.write_tree(recipTree, reciprocal_blast_address)
 
 
-        # When the file doesn't exist, it cannot be parsed and throws an error
+        # A tree that was made in this run is read in memory. Otherwise,
+        # when the file doesn't exist, it cannot be parsed and throws an
+        # error. The file is streamed, so only the definitions are kept in
+        # memory.
         try:
-            tree = ET.parse(reciprocal_blast_address)
+            recipTree = RunContext.fetch(reciprocal_blast_address)
+            if recipTree is not None:
+                homologDefinitions, messages = BlastXML.tree_homolog_definitions(
+                    recipTree)
+                # Only the definitions are needed from here on, so the tree
+                # is not held on to (beyond its pending writes)
+                RunContext.evict(reciprocal_blast_address,
+                    drop_reciprocal_blast_address)
+            else:
+                homologDefinitions, messages = BlastXML.read_homolog_definitions(
+                    reciprocal_blast_address)
         except:
             print 'No file for %s found. Skipping...' % coreg_gene.TTHERM_ID
             logging.info('No file for %s found. Skipping...' % coreg_gene.TTHERM_ID)
             continue
 
-        root = tree.getroot()
-
         # Populate the dictionary. Assigns a list of lists of all homology 
         # hits and their respective qualities to a gene. Sometimes, there 
         # are no homology hits due to a database error
@@ -358,24 +447,25 @@ def get_BLAST_homologues_dict(
         # raw_homologue_dict, with the key being the current gene ID
         # and value being a list of the definition and its quality
         raw_homologue_dict[coreg_gene.TTHERM_ID] = [
-        [hit_d.text, hit_d.get('quality')] for hit_d in root.iter(
-            'Hit_def')]
+        [hit_def, quality, BLAST_SOURCE] for hit_def, quality in homologDefinitions]
 
         # Check for database error from BLAST
         if raw_homologue_dict[coreg_gene.TTHERM_ID] == []:
-            for message in root.iter('Iteration_message'):
-                if message.text == '[blastsrv4.REAL]: '\
+            for message in messages:
+                if message == '[blastsrv4.REAL]: '\
                     'Error: CPU usage limit was exceeded, '\
                         'resulting in SIGXCPU (24).' \
-                        or 'Failed to collect db stats for nr' in message.text:
+                        or 'Failed to collect db stats for nr' in message:
                     raw_homologue_dict[coreg_gene.TTHERM_ID] = [[
-                    'db error', 'error']]
+                    'db error', 'error', BLAST_SOURCE]]
 
         print 'End reciprocal BLASTs'
         logging.info('End reciprocal BLASTs')
         
         # END LOOP
-    pickled_coregs_cDNA_file.close()
+
+    if orthologGroupStore is not None:
+        orthologGroupStore.close()
 
     # Cleanup
     clean_homologue_dict = clean_homologue_info(raw_homologue_dict, clade)
@@ -384,14 +474,10 @@ def get_BLAST_homologues_dict(
 
     # Pickle the homologue info dictionary for later use
     if blastOption == 'blastx':
-        pickle_f = open(x_homodict_pickle_address, 'wb')
-        dill.dump(clean_homologue_dict, pickle_f)
-        pickle_f.close()
+        RunContext.dump_pickle(clean_homologue_dict, x_homodict_pickle_address)
 
     elif blastOption == 'blastp':
-        pickle_f = open(p_homodict_pickle_address, 'wb')
-        dill.dump(clean_homologue_dict, pickle_f)
-        pickle_f.close()
+        RunContext.dump_pickle(clean_homologue_dict, p_homodict_pickle_address)
 
     # pdb.set_trace()             
 
@@ -430,6 +516,37 @@ def separate_orthologs_and_paralogs(clean_homologue_dict):
     return ortho_dict, para_dict, mix_dict
 
 
+def phrase_passes_filter(phrase):
+    """ The crude filter on the phrases found by
+        longest_phrases_in_homologue_info: phrases that are empty, too
+        short, or made of uninformative words like 'hypothetical protein'
+        are not counted.
+    """
+    if 'hypothetical protein' in phrase:
+        return False
+
+    return (phrase != '')\
+        and (phrase != 'unknown')\
+        and (phrase != 'repeat-containing protein')\
+        and (phrase != 'domain-containing protein')\
+        and (phrase != 'peptid')\
+        and (phrase != 'terminal domain')\
+        and (phrase != 'containing protein')\
+        and (phrase != 'membrane')\
+        and (phrase != 'repeat')\
+        and (phrase not in 'conserved unknown protein')\
+        and (phrase not in 'protein '*3) \
+        and (phrase not in 'hypothetical protein '*3) \
+        and (phrase not in 'predicted protein '*3) \
+        and (phrase not in 'predicted '*3) \
+        and (phrase not in 'hypothetical '*3)\
+        and (phrase not\
+            in 'conserved hypothetical protein '*3) \
+        and (phrase not\
+            in 'hypothetical protein variant '*3) \
+        and (len(phrase) > 4)
+
+
 def longest_phrases_in_homologue_info(homologue_dict):
     """ Initialize an empty dictionary of dictionaries:
         The inner dictionary will contain the phrases found as
@@ -453,106 +570,67 @@ def longest_phrases_in_homologue_info(homologue_dict):
         # Some genes have only two homologues, and the pairwise comparison may
         # be not informative...
         if len(homologue_dict[key]) > 2:
-            # Keep the first phrase to compare constant, while all the others 
-            # change. This next loop is simply for the index of the first
-            # string in the list. 
-            for i in xrange(len(homologue_dict[key])):
-
-                # Get the index for each string in the list of strings that is
-                # stored under the key in the dictionary homologue_dict.
-                for index in xrange(len(homologue_dict[key])):
-
-                    # Check that my for loop doesn't go beyond the length of
-                    # the list strings stored uder the key. Since I am 
-                    # comparing the strings pairwise, I need to stop at 
-                    # comparing with the last string. I am adding the two
-                    # indices from the two for inner for loops so that it 
-                    # always begins by comparing a string to the one 
-                    # immediately following it. I.e. if I am starting with
-                    # string #1, it will be compared to string #2, then #3,
-                    # and so on, until the list is exhausted. At that point we
-                    # go into the loop above this one, start with string #2,
-                    # compare it with string #3, and so on, and so on...
-                    if index + i + 1 < len(homologue_dict[key]): 
-
-                        # Remove any punctuation/ capitalization that may
-                        # intefere with finding common phrases between each 
-                        # pair. My re.sub replaces everything that isn't 
-                        # alphanumeric, a space, a dash, a forward slash,
-                        # an equals sign, or parantheses with an empty ''. 
-                        regex = r'[^A-Za-z0-9\s\-\/\=\(\)]+'
-                        s1 = re.sub(regex, '', homologue_dict[key][i].lower())
-                        s2 = re.sub(regex, 
-                            '', homologue_dict[key][index + i + 1].lower())
-
-                        # Get the handler for the SequenceMatcher.
-                        mh = difflib.SequenceMatcher(None, s1, s2)
-                        
-                        # difflib.SequenceMatcher.find_longest_match() takes
-                        # the beginning and end positions in the two strings, 
-                        # and returns a tuple (i, j, k) where 
-                        # s1[i: i + k] = s2[j: j + k],
-                        # which is the longest phrase matched. See the python
-                        # standard library docs for more.
-                        m = mh.find_longest_match(0, len(s1), 0, len(s2))
-
-                        # Strip off any whitespace from the matched phrase. I
-                        # made an obtuse if-statement to remove at least some
-                        # uninformative results. If the phrase passes that
-                        # test, then it is added as a key to the inner
-                        # dictionary and the counter is updated if that key
-                        # already exists.
-                        phrase = (s1[m[0]:(m[0] + m[2])]).strip(' -=/')
-                        
-                        # If most of the phrase consists of 'hypothetical 
-                        # protein', ignore that phrase
-                        if 'hypothetical protein' in phrase:
-                            if len('hypothetical protein')/\
-                                float(len(phrase)) > 0.6:  
-                                pass
-
-                        # A crude filter, but seems to work
-                        elif (phrase != '')\
-                            and (phrase != 'unknown')\
-                            and (phrase != 'repeat-containing protein')\
-                            and (phrase != 'domain-containing protein')\
-                            and (phrase != 'peptid')\
-                            and (phrase != 'terminal domain')\
-                            and (phrase != 'containing protein')\
-                            and (phrase != 'membrane')\
-                            and (phrase != 'repeat')\
-                            and (phrase not in 'conserved unknown protein')\
-                            and (phrase not in 'protein '*3) \
-                            and (phrase not in 'hypothetical protein '*3) \
-                            and (phrase not in 'predicted protein '*3) \
-                            and (phrase not in 'predicted '*3) \
-                            and (phrase not in 'hypothetical '*3)\
-                            and (phrase not\
-                                in 'conserved hypothetical protein '*3) \
-                            and (phrase not\
-                                in 'hypothetical protein variant '*3) \
-                            and (len(phrase) > 4):
-
-                            dict_of_genes_of_phrases[key][phrase] = \
-                                dict_of_genes_of_phrases[key].get(phrase,0) + 1
-
-
-                        # If no inter-string matches, choose the longest string
-                        # as the phrase
-                        elif phrase == '':
-                            longest = 0
-                            longList = ['']
-                            for string in homologue_dict[key]:
-                                # Find longest match
-                                if len(string) > longest:
-                                    longList.pop(0)
-                                    longList.insert(0, string)
-                                    longest = len(string)
-                            phrase = longList[0].lower().strip(' -=/')
-                            dict_of_genes_of_phrases[key][phrase] = \
-                                dict_of_genes_of_phrases[key].get(phrase,0) + 1
+            # Duplicate definitions are collapsed, so that each distinct pair
+            # is compared once, and counts for as many pairs as it stands for.
+            # The pairs are still those of the first string with each one
+            # after it, then the second with each one after it, and so on.
+            uniqueDefinitions, pairs = LongestPhrases.collapse_definitions(
+                homologue_dict[key])
+
+            # Punctuation and capitalization that may intefere with finding
+            # common phrases between each pair are removed once for all of
+            # the definitions
+            phraseMatcher = LongestPhrases.PhraseMatcher(uniqueDefinitions)
+            phraseMatcher.prefetch([(index1, index2) for index1, index2, weight in pairs])
+
+            for index1, index2, weight in pairs:
+
+                # Get the longest phrase that the pair of
+                # definitions has in common (see LongestPhrases:
+                # the result is the same as with
+                # difflib.SequenceMatcher.find_longest_match, which
+                # this used to call for every pair).
+                # Strip off any whitespace from the matched phrase. I
+                # made an obtuse if-statement to remove at least some
+                # uninformative results. If the phrase passes that
+                # test, then it is added as a key to the inner
+                # dictionary and the counter is updated if that key
+                # already exists.
+                phrase = phraseMatcher.longest_phrase(
+                    index1, index2).strip(' -=/')
+                
+                # If most of the phrase consists of 'hypothetical 
+                # protein', ignore that phrase
+                if 'hypothetical protein' in phrase:
+                    if len('hypothetical protein')/\
+                        float(len(phrase)) > 0.6:  
+                        pass
+
+                # A crude filter, but seems to work
+                elif phrase_passes_filter(phrase):
+
+                    dict_of_genes_of_phrases[key][phrase] = \
+                        dict_of_genes_of_phrases[key].get(phrase,0) + weight
+
+
+                # If no inter-string matches, choose the longest string
+                # as the phrase
+                elif phrase == '':
+                    longest = 0
+                    longList = ['']
+                    for string in homologue_dict[key]:
+                        # Find longest match
+                        if len(string) > longest:
+                            longList.pop(0)
+                            longList.insert(0, string)
+                            longest = len(string)
+                    phrase = longList[0].lower().strip(' -=/')
+                    dict_of_genes_of_phrases[key][phrase] = \
+                        dict_of_genes_of_phrases[key].get(phrase,0) + weight
+
+            phraseMatcher.flush()
+
 
-        
         # In the case when there are only two hits, just take both      
         elif len(homologue_dict[key]) == 2:
             regex = r'[^A-Za-z0-9\s\-\/\=\(\)]+'
@@ -594,22 +672,151 @@ def longest_phrases_in_homologue_info(homologue_dict):
 
     return dict_of_genes_of_phrases
 
-def dictionary_work(formatted_TTHERM_ID_list, threshold, owOption, 
-    syncOption, blastOption, clade):
-    ''' Combine all the above functions.
+def summary_is_settled(homologs):
+    ''' Whether the best phrases (most common and longest) that the report
+        would give for one gene are sure to be the same whatever the
+        homologs that are still to be reciprocated turn out to be. homologs
+        is the list of [definition, quality] of the gene in the order of its
+        BLAST file, with a quality of None for the homologs still to come.
+        Used by the budgeted reciprocal mode to stop as soon as the rest of
+        the homologs cannot change the summary.
+
+        The pairs of homologs that are already known count for the same
+        phrases whatever else is added, so each phrase can only gain the
+        pairs with a homolog still to come that count for it. The most
+        common phrase stays if it has more than any other phrase could
+        reach, and the longest phrase stays if no such pair gives a longer
+        new one. Pairs with nothing in common are summarized by whole
+        definitions (see longest_phrases_in_homologue_info), as are lists of
+        fewer than three homologs, and neither is ever settled.
     '''
-    p_bestdict_pickle_address, x_bestdict_pickle_address = filename_generator.filename_generator(
-    	'best_phrase_dict', formatted_TTHERM_ID_list, threshold = threshold)
+    for qualities in [['ortholog'], ['paralog'], ['ortholog', 'paralog']]:
+        entries = [(BlastXML.clean_definition(definition), quality is None)
+            for definition, quality in homologs
+            if quality is None or quality in qualities]
+        definitions = [definition for definition, pending in entries
+            if not pending]
+        if len(definitions) < 3:
+            return False
+
+        phrases = longest_phrases_in_homologue_info(
+            {'gene': definitions})['gene']
+        if phrases == {}:
+            return False
+
+        # The most that each phrase can still gain, from the pairs with a
+        # homolog still to come (in the order the report goes through them)
+        gains = {}
+        phraseMatcher = LongestPhrases.PhraseMatcher(
+            [definition for definition, pending in entries])
+        for index1 in xrange(len(entries)):
+            for index2 in xrange(index1 + 1, len(entries)):
+                if not (entries[index1][1] or entries[index2][1]):
+                    continue
+                phrase = phraseMatcher.longest_phrase(
+                    index1, index2).strip(' -=/')
+                # The same choices as longest_phrases_in_homologue_info
+                if 'hypothetical protein' in phrase:
+                    pass
+                elif phrase_passes_filter(phrase):
+                    gains[phrase] = gains.get(phrase, 0) + 1
+                elif phrase == '':
+                    phraseMatcher.flush()
+                    return False
+        phraseMatcher.flush()
+
+        best = max(phrases.values())
+        leaders = [phrase for phrase in phrases if phrases[phrase] == best]
+        if len(leaders) > 1:
+            return False
+        for phrase in set(phrases) | set(gains):
+            if phrase != leaders[0] and \
+                phrases.get(phrase, 0) + gains.get(phrase, 0) >= best:
+                return False
+
+        longest = max([len(phrase) for phrase in phrases])
+        if len([phrase for phrase in phrases if len(phrase) == longest]) > 1:
+            return False
+        for phrase in gains:
+            if phrase not in phrases and len(phrase) >= longest:
+                return False
+
+    return True
+
+
+def best_phrases_for_genes(genes):
+    ''' The phrase analysis of a chunk of genes, run in a worker process
+        by best_phrases. genes is a list of (key, ortholog definitions,
+        paralog definitions, mixed definitions). Returns the best phrases of
+        each gene, and the phrases of the definition pairs that this worker
+        matched, so that the parent can keep them.
+    '''
+    results = []
+    for key, ortho, para, mix in genes:
+        results.append((key, [get_best_reciprocal_longest_matches(
+            longest_phrases_in_homologue_info({key: definitions}))[key]
+            for definitions in [ortho, para, mix]]))
+
+    return results, LongestPhrases.take_new_pairs()
+
+
+def start_phrase_worker(diskCacheAddress):
+    # Workers keep track of the pairs they match, and send them back for
+    # the parent to keep. The parent's connection to the on-disk cache
+    # cannot be shared, so each worker looks phrases up through its own,
+    # read-only one. Only the address is passed in: spawned workers
+    # (Windows, and the frozen executables) inherit nothing, and pickling
+    # the parent's whole in-memory cache for each of them would cost more
+    # than it saves.
+    LongestPhrases.log_new_pairs(True)
+    LongestPhrases.close_disk_cache(forget = True)
+    if diskCacheAddress is not None:
+        LongestPhrases.open_disk_cache(diskCacheAddress, readOnly = True)
+
+
+def open_phrase_pool(runOptions):
+    ''' The process pool for the phrase analysis, or None if
+        runOptions['phraseWorkers'] does not ask for one (or the token
+        engine, which needs none, is used). It has to be made in the main
+        thread, before any others are started: forking while another thread
+        holds a lock (of logging, or of the stores) could leave the workers
+        stuck on it.
+    '''
+    workers = runOptions.get('phraseWorkers', 1)
+    if workers <= 1 or runOptions.get('phraseEngine') == 'tokens':
+        return None
 
-    # pdb.set_trace()
-    if blastOption == 'blastx':
-        homologue_dict = get_BLAST_homologues_dict(
-                            formatted_TTHERM_ID_list, threshold, 
-                            owOption, syncOption, blastOption, clade)
+    # No write should be under way in the background either
+    RunContext.flush()
 
-        ortho_dict, para_dict, mix_dict = separate_orthologs_and_paralogs(
-            homologue_dict)
-        
+    return multiprocessing.Pool(workers, start_phrase_worker,
+        (LongestPhrases.disk_cache_address(),))
+
+
+def best_phrases(ortho_dict, para_dict, mix_dict, runOptions, phrasePool = None):
+    ''' Run longest_phrases_in_homologue_info and
+        get_best_reciprocal_longest_matches on the ortholog, paralog, and
+        mixed definitions. Given a phrasePool (see open_phrase_pool), the
+        genes are spread over its processes: each gets a few chunks of
+        genes with about the same amount of work, and the three analyses of
+        a gene always go to the same process, so that they share its pair
+        cache. The result is the same as when run serially.
+
+        With runOptions['phraseEngine'] set to 'tokens', the phrases come
+        from n-gram supports instead (see TokenSummarizer).
+    '''
+    # The token-statistics engine counts all of the genes at once, and
+    # needs no pool
+    if runOptions.get('phraseEngine') == 'tokens':
+        TokenSummarizer.report_engine()
+        return tuple([TokenSummarizer.best_phrases_by_tokens(phrase_dict,
+            phrase_passes_filter) for phrase_dict in
+            [ortho_dict, para_dict, mix_dict]])
+
+    workers = runOptions.get('phraseWorkers', 1)
+    keys = list(ortho_dict)
+
+    if phrasePool is None or len(keys) < 2:
         ortho_phrase_dict = longest_phrases_in_homologue_info(ortho_dict)
         para_phrase_dict = longest_phrases_in_homologue_info(para_dict)
         mix_phrase_dict = longest_phrases_in_homologue_info(mix_dict)
@@ -618,84 +825,235 @@ def dictionary_work(formatted_TTHERM_ID_list, threshold, owOption,
         para_best = get_best_reciprocal_longest_matches(para_phrase_dict)
         mix_best = get_best_reciprocal_longest_matches(mix_phrase_dict)
 
-        # Now a dictionary of dictionaries: keep in mind for the CSV writing
-        bestPhraseDict = {
-            'ortho': ortho_best, 'para': para_best, 'mix': mix_best}
+        return ortho_best, para_best, mix_best
 
-        pickle_f = open(x_bestdict_pickle_address, 'wb')
-        dill.dump(bestPhraseDict, pickle_f)
-        pickle_f.close()
+    # The work of a gene grows with the square of its number of homologs.
+    # Dealing the genes out, heaviest first, evens the chunks out.
+    chunkCount = min(len(keys), workers * 4)
+    chunks = [[] for i in xrange(chunkCount)]
+    for rank, key in enumerate(sorted(keys,
+        key = lambda key: -len(mix_dict.get(key, [])) ** 2)):
+        chunks[rank % chunkCount].append((key, ortho_dict[key],
+            para_dict.get(key, []), mix_dict.get(key, [])))
 
-    elif blastOption == 'blastp':
-        homologue_dict = get_BLAST_homologues_dict(
-                            formatted_TTHERM_ID_list, threshold, owOption, 
-                            syncOption, blastOption, clade)
+    print 'Analyzing the phrases of %d genes in %d processes' % (len(keys), workers)
+    logging.info('Analyzing the phrases of %d genes in %d processes' % (len(keys), workers))
 
-        ortho_dict, para_dict, mix_dict = separate_orthologs_and_paralogs(
-            homologue_dict)
-        
-        ortho_phrase_dict = longest_phrases_in_homologue_info(ortho_dict)
-        para_phrase_dict = longest_phrases_in_homologue_info(para_dict)
-        mix_phrase_dict = longest_phrases_in_homologue_info(mix_dict)
+    chunkResults = phrasePool.map(best_phrases_for_genes, chunks)
 
-        ortho_best = get_best_reciprocal_longest_matches(ortho_phrase_dict)
-        para_best = get_best_reciprocal_longest_matches(para_phrase_dict)
-        mix_best = get_best_reciprocal_longest_matches(mix_phrase_dict)
+    bestDict = {}
+    for results, newPairs in chunkResults:
+        LongestPhrases.keep_pairs(newPairs)
+        for key, bests in results:
+            bestDict[key] = bests
 
-        # Now a dictionary of dictionaries: keep in mind for the CSV writing
-        bestPhraseDict = {
-            'ortho': ortho_best, 'para': para_best, 'mix': mix_best}
-        # pdb.set_trace()
-        pickle_f = open(p_bestdict_pickle_address, 'wb')
-        dill.dump(bestPhraseDict, pickle_f)
-        pickle_f.close()
+    return in_serial_order(keys, bestDict)
 
-    elif blastOption == 'both':
-        # First do it for the BLASTx
-        x_homologue_dict = get_BLAST_homologues_dict(
-            formatted_TTHERM_ID_list, threshold, owOption, syncOption, 'blastx', clade)
 
-        x_ortho_dict, x_para_dict, x_mix_dict = separate_orthologs_and_paralogs(
-            x_homologue_dict)
-        
-        x_ortho_phrase_dict = longest_phrases_in_homologue_info(x_ortho_dict)
-        x_para_phrase_dict = longest_phrases_in_homologue_info(x_para_dict)
-        x_mix_phrase_dict = longest_phrases_in_homologue_info(x_mix_dict)
+def in_serial_order(keys, bestDict):
+    ''' Split bestDict (gene -> [ortholog, paralog, mixed best phrases]) into
+        the three best phrase dictionaries that the serial analysis of the
+        genes keys gives.
+    '''
+    # The serial analysis fills the phrase dictionary in the order of keys,
+    # and the best phrase dictionary in the order of the phrase dictionary.
+    # Doing the same gives dictionaries that also iterate in the same order.
+    phraseOrder = {}
+    for key in keys:
+        phraseOrder[key] = None
+
+    return tuple([dict([(key, bestDict[key][index]) for key in phraseOrder])
+        for index in xrange(3)])
+
+
+def reciprocal_stage_addresses(formatted_TTHERM_ID_list, threshold, owOption,
+    syncOption, programs, clade, runOptions):
+    ''' The forward BLAST files that get_BLAST_homologues_dict is going to
+        reciprocate for programs, following the same overwriting, syncing
+        and run options. Used to plan the reciprocal stage of the whole run.
+    '''
+    pickled_coregs_cDNA_address = filename_generator.filename_generator('coregs_zscores',
+        formatted_TTHERM_ID_list)[0]
+    coregs_zscores_cDNA_list = RunContext.load_pickle(pickled_coregs_cDNA_address)
 
-        x_ortho_best = get_best_reciprocal_longest_matches(x_ortho_phrase_dict)
-        x_para_best = get_best_reciprocal_longest_matches(x_para_phrase_dict)
-        x_mix_best = get_best_reciprocal_longest_matches(x_mix_phrase_dict)
+    toBLAST = BLASTmod.to_blast(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, threshold)
 
-        # Now a dictionary of dictionaries: keep in mind for the CSV writing
-        x_bestPhraseDict = {
-            'ortho': x_ortho_best, 'para': x_para_best, 'mix': x_mix_best}
+    coveredGenes = set()
+    if runOptions.get('orthologGroups', False):
+        orthologGroupStore = OrthologGroups.open_store(runOptions.get('entrez', ''))
+        if orthologGroupStore is not None:
+            coveredGenes = orthologGroupStore.covered([g.TTHERM_ID for g in toBLAST])
+            orthologGroupStore.close()
+
+    blast_addresses = []
+    for program in programs:
+        for coreg_gene in toBLAST:
+            if coreg_gene.TTHERM_ID in coveredGenes:
+                continue
+
+            blast_address, drop_blast_address, reciprocal_blast_address, drop_reciprocal_blast_address = \
+                filename_generator.filename_generator('blast', [coreg_gene.TTHERM_ID],
+                    clade = clade, blastOption = program)
+            if not os.path.exists(blast_address):
+                continue
 
-        x_pickle_f = open(x_bestdict_pickle_address, 'wb')
-        dill.dump(x_bestPhraseDict, x_pickle_f)
-        x_pickle_f.close()
+            if syncOption != 3:
+                recipExists = os.path.exists(reciprocal_blast_address) or \
+                    os.path.exists(drop_reciprocal_blast_address)
+            else:
+                recipExists = os.path.exists(reciprocal_blast_address)
 
-        # Then do it for BLASTp
-        # Now a dictionary of dictionaries: keep in mind for the CSV writing
-        p_homologue_dict = get_BLAST_homologues_dict(
-            formatted_TTHERM_ID_list, threshold, owOption, syncOption, 'blastp', clade)
+            if owOption != 3 or not recipExists:
+                blast_addresses.append(blast_address)
+
+    return blast_addresses
+
+
+def analysis_version(runOptions):
+    # The version of the phrase analysis, including the phrase engine
+    return '%s-%s' % (PHRASE_ANALYSIS_VERSION,
+        runOptions.get('phraseEngine', 'pairwise'))
+
+
+def gene_input_hash(homologs):
+    # The content hash of what a gene's phrase analysis is computed from:
+    # its cleaned homologs
+    return hashlib.sha1(repr(homologs)).hexdigest()
+
+
+def incremental_best_phrases(homologue_dict, program, clade, runOptions,
+    phrasePool = None):
+    ''' best_phrases for the genes of homologue_dict, redoing only those
+        that the gene result store (see GeneResults) does not have for this
+        program, clade and analysis version, or has for other homologs
+        (see gene_input_hash). The results of the other genes are taken
+        from the store, whichever query they were first analyzed for, and
+        the store is brought up to date. The result is the same as analyzing
+        every gene again.
+    '''
+    ortho_dict, para_dict, mix_dict = separate_orthologs_and_paralogs(
+        homologue_dict)
+    keys = list(ortho_dict)
+
+    version = analysis_version(runOptions)
+    store = GeneResults.open_store()
+    stored = store.get_many(keys, program, clade, version)
+    inputHashes = {}
+    changed = []
+    for key in keys:
+        inputHashes[key] = gene_input_hash(homologue_dict[key])
+        if key not in stored or stored[key][0] != inputHashes[key]:
+            changed.append(key)
+
+    store.record(len(keys) - len(changed), len(changed))
+    print 'Reusing the %s phrase analysis of %d of %d genes' % (program, len(keys) - len(changed), len(keys))
+    logging.info('Reusing the %s phrase analysis of %d of %d genes' % (program, len(keys) - len(changed), len(keys)))
+
+    bestDict = {}
+    if changed:
+        changedBests = best_phrases(
+            dict([(key, ortho_dict[key]) for key in changed]),
+            dict([(key, para_dict[key]) for key in changed]),
+            dict([(key, mix_dict[key]) for key in changed]), runOptions,
+            phrasePool)
+        for key in changed:
+            bestDict[key] = [bests[key] for bests in changedBests]
+        store.put_many(dict([(key, (inputHashes[key], bestDict[key]))
+            for key in changed]), program, clade, version)
+
+    for key in keys:
+        if key not in bestDict:
+            bestDict[key] = stored[key][1]
+
+    return in_serial_order(keys, bestDict)
+
+
+def program_dictionary_work(formatted_TTHERM_ID_list, threshold, owOption,
+    syncOption, program, clade, runOptions, phrasePool = None):
+    ''' The homologues, their best phrases, and the best phrase pickle of
+        one BLAST program ('blastx' or 'blastp'), for dictionary_work.
+    '''
+    p_bestdict_pickle_address, x_bestdict_pickle_address = filename_generator.filename_generator(
+        'best_phrase_dict', formatted_TTHERM_ID_list, threshold = threshold)
+
+    homologue_dict = get_BLAST_homologues_dict(
+                        formatted_TTHERM_ID_list, threshold,
+                        owOption, syncOption, program, clade, runOptions)
+
+    # Only the genes that have not been analyzed before (for any query),
+    # or whose homologs changed since, are analyzed
+    ortho_best, para_best, mix_best = incremental_best_phrases(
+        homologue_dict, program, clade, runOptions, phrasePool)
+
+    # Now a dictionary of dictionaries: keep in mind for the CSV writing
+    bestPhraseDict = {
+        'ortho': ortho_best, 'para': para_best, 'mix': mix_best}
+    bestPhraseDict['source'] = get_homologue_sources(homologue_dict)
+    if runOptions.get('tieredSearch', False):
+        bestPhraseDict['database'] = get_blast_databases(
+            homologue_dict, program, clade)
+
+    # Handed to make_CSV in memory; the pickle is written in the background
+    if program == 'blastx':
+        RunContext.dump_pickle(bestPhraseDict, x_bestdict_pickle_address)
+    else:
+        RunContext.dump_pickle(bestPhraseDict, p_bestdict_pickle_address)
 
-        p_ortho_dict, p_para_dict, p_mix_dict = separate_orthologs_and_paralogs(
-            p_homologue_dict)
-        
-        p_ortho_phrase_dict = longest_phrases_in_homologue_info(p_ortho_dict)
-        p_para_phrase_dict = longest_phrases_in_homologue_info(p_para_dict)
-        p_mix_phrase_dict = longest_phrases_in_homologue_info(p_mix_dict)
 
-        p_ortho_best = get_best_reciprocal_longest_matches(p_ortho_phrase_dict)
-        p_para_best = get_best_reciprocal_longest_matches(p_para_phrase_dict)
-        p_mix_best = get_best_reciprocal_longest_matches(p_mix_phrase_dict)
+def dictionary_work(formatted_TTHERM_ID_list, threshold, owOption, 
+    syncOption, blastOption, clade, runOptions = None):
+    ''' Combine all the above functions.
+    '''
+    if runOptions is None:
+        runOptions = {}
+
+    # Phrases of definition pairs are always shared within the run; this
+    # keeps them for later runs too
+    if runOptions.get('phraseCacheOnDisk', False):
+        LongestPhrases.open_disk_cache()
+
+    # Fetch and reciprocate each distinct homolog of the run only once,
+    # before the genes are gone through one at a time
+    if blastOption == 'both':
+        programs = ['blastx', 'blastp']
+    else:
+        programs = [blastOption]
+    BLASTmod.prepare_reciprocal_stage(reciprocal_stage_addresses(
+        formatted_TTHERM_ID_list, threshold, owOption, syncOption, programs,
+        clade, runOptions), runOptions)
+
+    # The phrase workers are started here, in the main thread, and shared
+    # by both programs
+    phrasePool = open_phrase_pool(runOptions)
+    try:
+        # pdb.set_trace()
+        if blastOption == 'both':
+            # The blastx and blastp chains share no data, so they run side by
+            # side: one waits on the reciprocal BLASTs while the other does
+            # its phrase analysis
+            print 'Analyzing the blastx and blastp results in parallel'
+            logging.info('Analyzing the blastx and blastp results in parallel')
+
+            branchPool = multiprocessing.pool.ThreadPool(len(programs))
+            try:
+                branches = [branchPool.apply_async(program_dictionary_work,
+                    (formatted_TTHERM_ID_list, threshold, owOption, syncOption,
+                    program, clade, runOptions, phrasePool)) for program in programs]
+                # get re-raises anything that went wrong in a branch
+                for branch in branches:
+                    branch.get()
+            finally:
+                branchPool.close()
+                branchPool.join()
 
-        p_bestPhraseDict = {
-            'ortho': p_ortho_best, 'para': p_para_best, 'mix': p_mix_best}
+        else:
+            program_dictionary_work(formatted_TTHERM_ID_list, threshold, owOption,
+                syncOption, blastOption, clade, runOptions, phrasePool)
 
-        p_pickle_f = open(p_bestdict_pickle_address, 'wb')
-        dill.dump(p_bestPhraseDict, p_pickle_f)
-        p_pickle_f.close()
+    finally:
+        if phrasePool is not None:
+            phrasePool.close()
+            phrasePool.join()
 
     return
 
@@ -749,12 +1107,22 @@ def append_summaries_to_csv_row(bestPhraseDict, row, key):
 
     return row
 
-def make_CSV(formatted_TTHERM_ID_list, threshold, blastOption, clade):
+def make_CSV(formatted_TTHERM_ID_list, threshold, blastOption, clade,
+    runOptions = None):
     """ Take bestPhraseDict and coregs_zscores_cDNA_list (unpickle). Write .csv
         file that is in the excel dialect: 
             GeneID,CommonName,Description,z-score,BLAST_analyses
 
+        If the forward searches were run in family-representative mode
+        (runOptions['familyRepresentatives']), a last column records the
+        representative whose search each gene reused. If imported ortholog
+        groups were used (runOptions['orthologGroups']), a last column says
+        where each gene's homologs came from. With tiered searches
+        (runOptions['tieredSearch']), the last columns give the database
+        that each program's forward search was taken from.
     """
+    if runOptions is None:
+        runOptions = {}
 
     # Unpickle coregs_zscores_cDNA_list and bestPhraseDict
     pickled_coregs_cDNA_address, drop_pickled_coregs_cDNA_file  = filename_generator.filename_generator('coregs_zscores',
@@ -763,28 +1131,43 @@ def make_CSV(formatted_TTHERM_ID_list, threshold, blastOption, clade):
     	'best_phrase_dict', formatted_TTHERM_ID_list, threshold = threshold)
 
     # Load the files into manipulable objects
-    pickled_coregs_cDNA_file = open(pickled_coregs_cDNA_address, 'rb')
-    coregs_zscores_cDNA_list = dill.load(pickled_coregs_cDNA_file)
-    pickled_coregs_cDNA_file.close()
+    coregs_zscores_cDNA_list = RunContext.load_pickle(pickled_coregs_cDNA_address)
 
     if blastOption == 'blastx':
-        x_pickled_bestPhraseDict_file = open(x_bestdict_pickle_address, 'rb')
-        x_bestPhraseDict = dill.load(x_pickled_bestPhraseDict_file)
-        x_pickled_bestPhraseDict_file.close()
+        x_bestPhraseDict = RunContext.load_pickle(x_bestdict_pickle_address)
 
     elif blastOption == 'blastp':
-        p_pickled_bestPhraseDict_file = open(p_bestdict_pickle_address, 'rb')
-        p_bestPhraseDict = dill.load(p_pickled_bestPhraseDict_file)
-        p_pickled_bestPhraseDict_file.close()
+        p_bestPhraseDict = RunContext.load_pickle(p_bestdict_pickle_address)
 
     elif blastOption == 'both':
-        x_pickled_bestPhraseDict_file = open(x_bestdict_pickle_address, 'rb')
-        x_bestPhraseDict = dill.load(x_pickled_bestPhraseDict_file)
-        x_pickled_bestPhraseDict_file.close()
+        x_bestPhraseDict = RunContext.load_pickle(x_bestdict_pickle_address)
+
+        p_bestPhraseDict = RunContext.load_pickle(p_bestdict_pickle_address)
+
+    familyDict = {}
+    if runOptions.get('familyRepresentatives', False):
+        families_address = filename_generator.filename_generator(
+            'families', formatted_TTHERM_ID_list, threshold = threshold)
+        if RunContext.fetch(families_address) is not None or\
+            os.path.exists(families_address):
+            familyDict = RunContext.load_pickle(families_address)
+
+    # Where the homologs of each gene came from (BLAST or ortholog groups).
+    # In 'both' mode, the two dictionaries agree for genes covered by the
+    # ortholog groups.
+    sourceDict = {}
+    if blastOption in ['blastx', 'both']:
+        sourceDict = x_bestPhraseDict.get('source', {})
+    elif blastOption == 'blastp':
+        sourceDict = p_bestPhraseDict.get('source', {})
 
-        p_pickled_bestPhraseDict_file = open(p_bestdict_pickle_address, 'rb')
-        p_bestPhraseDict = dill.load(p_pickled_bestPhraseDict_file)
-        p_pickled_bestPhraseDict_file.close()
+    # The database each forward search was taken from, per program
+    databaseDicts = []
+    if runOptions.get('tieredSearch', False):
+        if blastOption in ['blastx', 'both']:
+            databaseDicts.append(('BLASTx', x_bestPhraseDict.get('database', {})))
+        if blastOption in ['blastp', 'both']:
+            databaseDicts.append(('BLASTp', p_bestPhraseDict.get('database', {})))
 
     # Make the csv file
     csv_address = filename_generator.filename_generator('csv', formatted_TTHERM_ID_list, 
@@ -846,6 +1229,15 @@ def make_CSV(formatted_TTHERM_ID_list, threshold, blastOption, clade):
                     'BLASTp.Paralog.Summary',
                     'BLASTp.Mixed.Summary',
                     'BLASTp.Mixed.Longest.Common.Phrase', 'cDNA', 'protein']            
+        # Extra columns go at the end, so that sanitize_database_errors
+        # still finds the summaries where it expects them
+        if familyDict:
+            header.append('Family.Representative')
+        if runOptions.get('orthologGroups', False):
+            header.append('Homolog.Source')
+        for program, databaseDict in databaseDicts:
+            header.append('%s.Database' % program)
+
         infoWriter.writerow(header)
         if len(formatted_TTHERM_ID_list) == 1:
             for i in xrange(len(coregs_zscores_cDNA_list)):
@@ -868,6 +1260,12 @@ def make_CSV(formatted_TTHERM_ID_list, threshold, blastOption, clade):
 
                 row.append(coregs_zscores_cDNA_list[i].cDNA)
                 row.append(coregs_zscores_cDNA_list[i].protein)
+                if familyDict:
+                    row.append(familyDict.get(key, ''))
+                if runOptions.get('orthologGroups', False):
+                    row.append(sourceDict.get(key, ''))
+                for program, databaseDict in databaseDicts:
+                    row.append(databaseDict.get(key, ''))
                 #print row
                 infoWriter.writerow(row)
         else:
@@ -891,11 +1289,108 @@ def make_CSV(formatted_TTHERM_ID_list, threshold, blastOption, clade):
 
                 row.append(coregs_zscores_cDNA_list[i].cDNA)
                 row.append(coregs_zscores_cDNA_list[i].protein)
+                if familyDict:
+                    row.append(familyDict.get(key, ''))
+                if runOptions.get('orthologGroups', False):
+                    row.append(sourceDict.get(key, ''))
+                for program, databaseDict in databaseDicts:
+                    row.append(databaseDict.get(key, ''))
                 #print row
                 infoWriter.writerow(row)            
     return
 
 
+def threshold_reports(formatted_TTHERM_ID_list, threshold, blastOption, clade,
+    runOptions = None):
+    ''' Make the reports for the higher thresholds in
+        runOptions['reportThresholds'] out of the analysis done at threshold
+        (the lowest one). Everything a search at a higher threshold would
+        have found is already there: its genes are a subset, and each gene's
+        analysis does not depend on the threshold. So the best phrase
+        dictionaries are only filtered down to the genes that the higher
+        threshold lets through, and saved under its file names, for make_CSV
+        to make its report as usual. The other genes come out as they would
+        have: without reciprocal BLASTs.
+
+        Gene families (runOptions['familyRepresentatives']) are filtered the
+        same way as long as every representative passes. If one does not,
+        the families are formed again from the genes that pass, as a run at
+        the higher threshold would form them. The members of a re-formed
+        family keep the homologs of their old representative's search,
+        though, where that run would have searched the new representative,
+        so their summaries can differ from that run's.
+    '''
+    if runOptions is None:
+        runOptions = {}
+
+    higherThresholds = [t for t in runOptions.get('reportThresholds', [])
+        if t > threshold]
+    if higherThresholds == []:
+        return
+
+    pickled_coregs_cDNA_address, drop_pickled_coregs_cDNA_file = filename_generator.filename_generator('coregs_zscores',
+        formatted_TTHERM_ID_list)
+    coregs_zscores_cDNA_list = RunContext.load_pickle(pickled_coregs_cDNA_address)
+
+    p_bestdict_pickle_address, x_bestdict_pickle_address = filename_generator.filename_generator(
+        'best_phrase_dict', formatted_TTHERM_ID_list, threshold = threshold)
+    if blastOption == 'both':
+        programs = ['blastx', 'blastp']
+    else:
+        programs = [blastOption]
+
+    bestPhraseDicts = {}
+    for program in programs:
+        if program == 'blastx':
+            bestPhraseDicts[program] = RunContext.load_pickle(x_bestdict_pickle_address)
+        else:
+            bestPhraseDicts[program] = RunContext.load_pickle(p_bestdict_pickle_address)
+
+    familyDict = {}
+    if runOptions.get('familyRepresentatives', False):
+        families_address = filename_generator.filename_generator(
+            'families', formatted_TTHERM_ID_list, threshold = threshold)
+        if RunContext.fetch(families_address) is not None or\
+            os.path.exists(families_address):
+            familyDict = RunContext.load_pickle(families_address)
+
+    for higherThreshold in higherThresholds:
+        print 'Making the report for the z-score threshold %s' % higherThreshold
+        logging.info('Making the report for the z-score threshold %s' % higherThreshold)
+
+        keptGenes = BLASTmod.to_blast(
+            coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, higherThreshold)
+        kept = set([g.TTHERM_ID for g in keptGenes])
+
+        p_address, x_address = filename_generator.filename_generator(
+            'best_phrase_dict', formatted_TTHERM_ID_list, threshold = higherThreshold)
+        for program in programs:
+            bestPhraseDict = dict([(part, dict([(key, phrases[key])
+                for key in phrases if key in kept]))
+                for part, phrases in bestPhraseDicts[program].iteritems()])
+            if program == 'blastx':
+                RunContext.dump_pickle(bestPhraseDict, x_address)
+            else:
+                RunContext.dump_pickle(bestPhraseDict, p_address)
+
+        if familyDict:
+            keptFamilies = dict([(key, familyDict[key])
+                for key in familyDict if key in kept])
+            if [key for key in keptFamilies if keptFamilies[key] not in kept]:
+                print 'Some family representatives do not pass %s; forming the families again' \
+                    % higherThreshold
+                logging.info('Some family representatives do not pass %s; forming the families again' \
+                    % higherThreshold)
+                keptFamilies = BLASTmod.cluster_gene_families(
+                    [g for g in keptGenes if g.TTHERM_ID in familyDict])
+            RunContext.dump_pickle(keptFamilies,
+                filename_generator.filename_generator('families',
+                    formatted_TTHERM_ID_list, threshold = higherThreshold))
+
+        make_CSV(formatted_TTHERM_ID_list, higherThreshold, blastOption, clade,
+            runOptions)
+
+
 def sanitize_database_errors(formatted_TTHERM_ID_list, threshold, 
     syncOption, blastOption, clade):
     """ Check each row of .csv file for "db error" in either the BLASTx
@@ -936,7 +1431,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
                         # dropbox files. Make sure that program doesn't crash
                         # if the files already don't exist for some reason
                         try:
-                            os.remove(blastx_address)
+                            RunContext.remove_file(blastx_address)
                             print 'Removed local BLASTx profile for %s' \
                                 % row[0]
                             logging.info('Removed local BLASTx profile for %s' \
@@ -949,7 +1444,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
                             pass
                         
                         try:
-                            os.remove(reciprocal_blastx_address)
+                            RunContext.remove_file(reciprocal_blastx_address)
                             print 'Removed local reciprocally-filtered BLASTx profile for %s' \
                                 % row[0]
                             logging.info('Removed local reciprocally-filtered BLASTx profile for %s' \
@@ -962,7 +1457,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
                             pass
 
                         try:
-                            os.remove(drop_blastx_address)
+                            RunContext.remove_file(drop_blastx_address)
                             print 'Removed dropbox BLASTx profile for %s' \
                                 % row[0]
                             logging.info('Removed dropbox BLASTx profile for %s' \
@@ -974,7 +1469,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
                                 'already been removed. Moving on...' % row[0])
 
                         try:
-                            os.remove(drop_reciprocal_blastx_address)
+                            RunContext.remove_file(drop_reciprocal_blastx_address)
                             print 'Removed dropbox reciprocally-filtered BLASTx profile for %s' \
                                 % row[0]
                             logging.info('Removed dropbox reciprocally-filtered BLASTx profile for %s' \
@@ -993,7 +1488,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
                         # dropbox file. Make sure that program doesn't crash
                         # if the files already don't exist for some reason
                         try:
-                            os.remove(blastp_address)
+                            RunContext.remove_file(blastp_address)
                             print 'Removed local BLASTp profile for %s' \
                                 % row[0]
                             logging.info('Removed local BLASTp profile for %s' \
@@ -1006,7 +1501,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
                             pass
 
                         try:
-                            os.remove(reciprocal_blastp_address)
+                            RunContext.remove_file(reciprocal_blastp_address)
 
                             print 'Removed local reciprocally-filtered BLASTp profile for %s' \
                                 % row[0]
@@ -1022,7 +1517,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
 
                         
                         try:
-                            os.remove(drop_blastp_address)
+                            RunContext.remove_file(drop_blastp_address)
                             print 'Removed dropbox BLASTp profile for %s' \
                                 % row[0]
                             logging.info('Removed dropbox BLASTp profile for %s' \
@@ -1034,7 +1529,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
                                 'already been removed. Moving on...' % row[0])
 
                         try:
-                            os.remove(drop_reciprocal_blastp_address)
+                            RunContext.remove_file(drop_reciprocal_blastp_address)
                             print 'Removed dropbox reciprocally-filtered BLASTp profile for %s' \
                                 % row[0]
                             logging.info('Removed dropbox reciprocally-filtered BLASTp profile for %s' \
@@ -1050,7 +1545,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
                 elif blastOption == 'both':
                     if 'db error' in row[5]:
                         try:
-                            os.remove(blastx_address)
+                            RunContext.remove_file(blastx_address)
                             print 'Removed local BLASTx profile for %s' \
                                 % row[0]
                             logging.info('Removed local BLASTx profile for %s' \
@@ -1063,7 +1558,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
                             pass
 
                         try:
-                            os.remove(reciprocal_blastx_address)
+                            RunContext.remove_file(reciprocal_blastx_address)
                             print 'Removed local reciprocally-filtered BLASTx profile for %s' \
                                 % row[0]
                             logging.info('Removed local reciprocally-filtered BLASTx profile for %s' \
@@ -1077,7 +1572,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
                             pass
 
                         try:
-                            os.remove(drop_blastx_address)
+                            RunContext.remove_file(drop_blastx_address)
                             print 'Removed dropbox BLASTx profile for %s' \
                                 % row[0]
                             logging.info('Removed dropbox BLASTx profile for %s' \
@@ -1089,7 +1584,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
                                 'already been removed. Moving on...' % row[0])
 
                         try:
-                            os.remove(drop_reciprocal_blastx_address)
+                            RunContext.remove_file(drop_reciprocal_blastx_address)
                             print 'Removed dropbox reciprocally-filtered BLASTx profile for %s' \
                                 % row[0]
                             logging.info('Removed dropbox reciprocally-filtered BLASTx profile for %s' \
@@ -1102,7 +1597,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
 
                     if 'db error' in row[7]:
                         try:
-                            os.remove(blastp_address)
+                            RunContext.remove_file(blastp_address)
                             print 'Removed local BLASTp profile for %s' \
                                 % row[0]
                             logging.info('Removed local BLASTp profile for %s' \
@@ -1116,7 +1611,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
                         
 
                         try:
-                            os.remove(reciprocal_blastp_address)
+                            RunContext.remove_file(reciprocal_blastp_address)
                             print 'Removed local reciprocally-filtered BLASTp profile for %s' \
                                 % row[0]
                             logging.info('Removed local reciprocally-filtered BLASTp profile for %s' \
@@ -1129,7 +1624,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
                             pass
 
                         try:
-                            os.remove(drop_blastp_address)
+                            RunContext.remove_file(drop_blastp_address)
                             print 'Removed dropbox BLASTp profile for %s' \
                                 % row[0]
                             logging.info('Removed dropbox BLASTp profile for %s' \
@@ -1141,7 +1636,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
                                 'already been removed. Moving on...' % row[0])
             
                         try:
-                            os.remove(drop_reciprocal_blastp_address)
+                            RunContext.remove_file(drop_reciprocal_blastp_address)
                             print 'Removed dropbox reciprocally-filtered BLASTp profile for %s' \
                                 % row[0]
                             logging.info('Removed dropbox reciprocally-filtered BLASTp profile for %s' \
@@ -1159,7 +1654,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
                 if blastOption == 'blastx':
                     if 'db error' in row[5]:
                         try:
-                            os.remove(blastx_address)
+                            RunContext.remove_file(blastx_address)
                             print 'Removed local BLASTx profile for %s' \
                                 % row[0]
                             logging.info('Removed local BLASTx profile for %s' \
@@ -1172,7 +1667,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
                             pass
 
                         try:
-                            os.remove(reciprocal_blastx_address)
+                            RunContext.remove_file(reciprocal_blastx_address)
                             print 'Removed local reciprocally-filtered BLASTx profile for %s' \
                                 % row[0]
                             logging.info('Removed local reciprocally-filtered BLASTx profile for %s' \
@@ -1188,7 +1683,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
                 elif blastOption == 'blastp':
                     if 'db error' in row[5]:
                         try:
-                            os.remove(blastp_address)
+                            RunContext.remove_file(blastp_address)
                             print 'Removed local BLASTp profile for %s' \
                                 % row[0]
                             logging.info('Removed local BLASTp profile for %s' \
@@ -1202,7 +1697,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
                         
 
                         try:
-                            os.remove(reciprocal_blastp_address)
+                            RunContext.remove_file(reciprocal_blastp_address)
                             print 'Removed local reciprocally-filtered BLASTp profile for %s' \
                                 % row[0]
                             logging.info('Removed local reciprocally-filtered BLASTp profile for %s' \
@@ -1218,7 +1713,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
                 elif blastOption == 'both':
                     if 'db error' in row[5]:
                         try:
-                            os.remove(blastx_address)
+                            RunContext.remove_file(blastx_address)
                             print 'Removed local BLASTx profile for %s' \
                                 % row[0]
                             logging.info('Removed local BLASTx profile for %s' \
@@ -1232,7 +1727,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
 
 
                         try:
-                            os.remove(reciprocal_blastx_address)
+                            RunContext.remove_file(reciprocal_blastx_address)
                             print 'Removed local reciprocally-filtered BLASTx profile for %s' \
                                 % row[0]
                             logging.info('Removed local reciprocally-filtered BLASTx profile for %s' \
@@ -1247,7 +1742,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
 
                     if 'db error' in row[7]:
                         try:
-                            os.remove(blastp_address)
+                            RunContext.remove_file(blastp_address)
                             print 'Removed local BLASTp profile for %s ' \
                                 % row[0]
                             logging.info('Removed local BLASTp profile for %s ' \
@@ -1261,7 +1756,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
     
                     # if 'db error' in row[7]:
                         try:
-                            os.remove(reciprocal_blastp_address)
+                            RunContext.remove_file(reciprocal_blastp_address)
                             print 'Removed local reciprocally-filtered BLASTp profile for %s ' \
                                 % row[0]
                             logging.info('Removed local reciprocally-filtered BLASTp profile for %s ' \
@@ -1278,7 +1773,7 @@ def sanitize_database_errors(formatted_TTHERM_ID_list, threshold,
 
 
 def CoregFilesIO(formatted_TTHERM_ID_list, threshold, owOption, 
-    syncOption, blastOption, clade):
+    syncOption, blastOption, clade, runOptions = None):
     """ Manage all of the above functions.
     """
 
@@ -1290,8 +1785,11 @@ def CoregFilesIO(formatted_TTHERM_ID_list, threshold, owOption,
         print 'Initializing homology analysis'
         logging.info('Initializing homology analysis')
         dictionary_work(formatted_TTHERM_ID_list, threshold, owOption, 
-            syncOption, blastOption, clade)
-        make_CSV(formatted_TTHERM_ID_list, threshold, blastOption, clade)
+            syncOption, blastOption, clade, runOptions)
+        make_CSV(formatted_TTHERM_ID_list, threshold, blastOption, clade,
+            runOptions)
+        threshold_reports(formatted_TTHERM_ID_list, threshold, blastOption,
+            clade, runOptions)
         print
         print 'Analysis complete'
         logging.info('Analysis complete')
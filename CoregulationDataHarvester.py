@@ -53,8 +53,12 @@ __version__ = '1.2.1'
 import sys
 import os
 import platform
+import multiprocessing
 import WebdriverModule as WebMod
 import CoregFilesIO
+import SequenceStore
+import RunContext
+import GeneResults
 import time
 import logging
 import filename_generator
@@ -63,6 +67,108 @@ import filename_generator
 
 # functions
 
+def ask_run_options():
+    """ Ask the user which of the optional search strategies to use. The
+        answers are collected into the runOptions dictionary that is passed
+        through WebMod and CoregFilesIO to the functions that use them. Any
+        option that is left out of runOptions keeps the standard behavior.
+    """
+    runOptions = {}
+
+    advancedOption = raw_input(
+        '''Would you like to choose any optional search strategies
+(y: choose, n: run the standard searches)? ''').strip().lower()[:1]
+
+    if advancedOption != 'y':
+        return runOptions
+
+    print
+
+    tieredOption = raw_input(
+        '''Search small curated databases first, and escalate to nr only
+for genes whose homologs are uninformative (y/n)? ''').strip().lower()[:1]
+    runOptions['tieredSearch'] = (tieredOption == 'y')
+
+    print
+
+    chunkedOption = raw_input(
+        '''Split very long queries into overlapping windows that are searched
+at the same time (y/n)? ''').strip().lower()[:1]
+    runOptions['chunkedSearch'] = (chunkedOption == 'y')
+
+    print
+
+    deriveOption = raw_input(
+        '''Search once without taxonomic restriction and sort the hits into
+your chosen clade locally, so that other clades can later be reported
+without new searches (needs the NCBI taxonomy, see the manual) (y/n)? ''').strip().lower()[:1]
+    runOptions['deriveClades'] = (deriveOption == 'y')
+
+    print
+
+    familyOption = raw_input(
+        '''Group near-identical paralogs into families, and run the forward
+searches only for one representative of each family (y/n)? ''').strip().lower()[:1]
+    runOptions['familyRepresentatives'] = (familyOption == 'y')
+
+    print
+
+    orthologGroupOption = raw_input(
+        '''Take the homologs of genes covered by imported ortholog groups
+from the groups, and BLAST only the other genes (import a dump first
+with OrthologGroups.py) (y/n)? ''').strip().lower()[:1]
+    runOptions['orthologGroups'] = (orthologGroupOption == 'y')
+
+    print
+
+    hspOption = raw_input(
+        '''Reciprocate with the aligned regions of the homologs from the forward
+BLAST instead of downloading their full sequences (y/n)? ''').strip().lower()[:1]
+    runOptions['hspQueries'] = (hspOption == 'y')
+
+    if runOptions['hspQueries']:
+        sampleInput = raw_input(
+            '''Number of genes on which to compare this with full sequences
+first (0 for no comparison): ''').strip()
+        if sampleInput.isdigit():
+            runOptions['hspComparisonSample'] = int(sampleInput)
+
+    print
+
+    budgetInput = raw_input(
+        '''Most homologs to reciprocally BLAST per gene, best first, stopping
+early once the rest could not change the summary (0 or blank for all of
+them): ''').strip()
+    if budgetInput.isdigit():
+        runOptions['reciprocalBudget'] = int(budgetInput)
+
+    print
+
+    phraseCacheOption = raw_input(
+        '''Keep the common phrases of homolog definitions on disk, so that
+later runs do not have to find them again (y/n)? ''').strip().lower()[:1]
+    runOptions['phraseCacheOnDisk'] = (phraseCacheOption == 'y')
+
+    print
+
+    engineOption = raw_input(
+        '''Summarize homolog definitions by word n-gram counts instead of
+pairwise common phrases (faster for genes with many homologs) (y/n)? ''').strip().lower()[:1]
+    if engineOption == 'y':
+        runOptions['phraseEngine'] = 'tokens'
+
+    print
+
+    workersInput = raw_input(
+        '''Number of processes for the phrase analysis of the report
+(blank for 1): ''').strip()
+    if workersInput.isdigit() and int(workersInput) > 1:
+        runOptions['phraseWorkers'] = int(workersInput)
+
+    print
+
+    return runOptions
+
 def main():
 
     """ Currently just initializing variables and running the functions
@@ -126,11 +232,29 @@ def main():
 
         print
 
-        threshold = float(input(
-            '''To determine how many of the co-regulated genes should be
+        # Ask again until the thresholds can be read
+        thresholds = []
+        while thresholds == []:
+            thresholdInput = raw_input(
+                '''To determine how many of the co-regulated genes should be
 subject to homology analysis, please enter the lower-bound
 z-score for the strength of co-regulation. If you have 
-entered multiple TTHERM_IDs, this number will be used for all of them: '''))
+entered multiple TTHERM_IDs, this number will be used for all of them.
+To compare thresholds, enter several, separated by commas: one report
+is made for each, from a single analysis at the lowest one: ''')
+
+            try:
+                thresholds = sorted(set([float(t) for t in thresholdInput.split(',')
+                    if t.strip() != '']))
+            except ValueError:
+                thresholds = []
+            if thresholds == []:
+                print
+                print "I'm sorry, I do not understand your input. Please try again."
+                print
+
+        # Everything is searched and analyzed at the lowest threshold
+        threshold = thresholds[0]
 
         print
 
@@ -171,10 +295,12 @@ entered multiple TTHERM_IDs, this number will be used for all of them: '''))
         
         # User only wants to run the FGD/TGD search
         elif owOption == 5:
+            RunContext.flush(forget = True)
             print 'Run started:', time.ctime()
             logging.info('Run started: {}'.format(time.ctime()))
             WebMod.WebMod(
                 formatted_TTHERM_ID_list, threshold, owOption, syncOption, blastOption=None, entrez=None, clade=None)
+            RunContext.flush(forget = True)
             print 'Run ended:', time.ctime()
             logging.info('Run ended: {}'.format(time.ctime()))
             print
@@ -267,16 +393,27 @@ These descriptions should not include any spaces or punctuation, as
 they will be used in file names. Take care to use something succinct
 and informative: ''')
 
+        print
+        runOptions = ask_run_options()
+        # CoregFilesIO only knows the clade by its name, but the ortholog
+        # groups are sorted into it by the entrez query
+        runOptions['entrez'] = entrez
+        if len(thresholds) > 1:
+            runOptions['reportThresholds'] = thresholds
+
+        # A run that was cut short by restarting main may have left objects
+        # behind; this one starts from the disk
+        RunContext.flush(forget = True)
         print
         print 'Run started:', time.ctime()
         logging.info('Run started: {}'.format(time.ctime()))
         print
         if owOption == 1 or owOption == 2 or owOption == 3:
             WebMod.WebMod(formatted_TTHERM_ID_list, threshold, owOption, 
-                syncOption, blastOption, entrez, clade)
+                syncOption, blastOption, entrez, clade, runOptions)
             
             CoregFilesIO.CoregFilesIO(formatted_TTHERM_ID_list, threshold, owOption, 
-                syncOption, blastOption, clade)
+                syncOption, blastOption, clade, runOptions)
 
         elif owOption == 4:
             # First sanitize, using the given parameters
@@ -287,16 +424,21 @@ and informative: ''')
             # threshold, owOption = 3 (so that nothing is needlessly overwritten),
             # same syncOption, same blastOption, same clade.
             WebMod.WebMod(formatted_TTHERM_ID_list, threshold, 3, syncOption, 
-                blastOption, entrez, clade)
+                blastOption, entrez, clade, runOptions)
 
             # Then reanalyze the data. Here the owOption doesn't matter, so I'll 
             # just keep it at 3 for consistency and ease of understanding the 
             # intention
 
             CoregFilesIO.CoregFilesIO(
-                formatted_TTHERM_ID_list, threshold, 3, syncOption, blastOption, clade)
-
+                formatted_TTHERM_ID_list, threshold, 3, syncOption, blastOption, clade,
+                runOptions)
 
+        SequenceStore.report_hit_rate()
+        GeneResults.report_reuse()
+        # The files of the run are written in the background. The next run
+        # starts from them, not from what this one kept in memory.
+        RunContext.flush(forget = True)
 
 
         print
@@ -360,6 +502,10 @@ and informative: ''')
 
 
 if (__name__ == "__main__"):
+    # The phrase analysis may start worker processes. In the frozen
+    # executables, a worker runs this same program, and has to stop here
+    # instead of starting the interactive session.
+    multiprocessing.freeze_support()
     print
     print """Coregulation Data Harvester Copyright (C) 2015-2017 Lev M Tsypin
 This program comes with ABSOLUTELY NO WARRANTY.
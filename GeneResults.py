@@ -0,0 +1,147 @@
+#!/usr/bin/python
+
+"""
+    Coregulation Data Harvester--A tool for organizing and predicting
+    Tetrahymena thermophila gene annotations
+
+    Copyright (C) 2015-2017 Lev M Tsypin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    If you choose to publish research based on this software, or distribute
+    any work containing it, please make a notice of the copyright holder's
+    attribution. If you derivitize or modify the software, please make
+    a note that it is a derived work.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+__author__ = 'Lev Tsypin (Ltsypin@gmail.com)'
+__version__ = '1.2.1'
+
+""" A local store of the phrase analysis of each gene, shared by all
+    queries and thresholds.
+
+    The best phrases of a gene only depend on its own homologs, the BLAST
+    program and clade they came from, and the version of the analysis, so
+    they are kept under (TTHERM_ID, program, clade, analysis version), along
+    with a hash of the homologs they were computed from. Co-regulated
+    neighborhoods overlap a lot, so a gene that was analyzed for one query
+    (or cross-analysis, or threshold) is not analyzed again for the next,
+    unless its homologs changed. The best phrase dictionaries of a query
+    are put together from these.
+"""
+
+# imports
+import sqlite3
+import zlib
+import logging
+import threading
+import dill
+import filename_generator
+
+# constants
+
+STORE_NAME = 'gene_results'
+
+# Number of genes per lookup query
+LOOKUP_BATCH_SIZE = 500
+
+# The store is opened once, and shared by every query in the run
+_store = None
+_openLock = threading.Lock()
+
+
+class GeneResultStore:
+    # (TTHERM_ID, program, clade, analysis version) -> input hash and
+    # compressed [ortholog, paralog, mixed best phrases]. The blastx and
+    # blastp analyses of dictionary_work share the connection from two
+    # threads, so every use of it goes through the lock.
+
+    def __init__(self, store_address):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(store_address,
+            check_same_thread = False)
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS gene_results
+            (TTHERM_ID TEXT, program TEXT, clade TEXT, version TEXT,
+            input_hash TEXT, phrases BLOB,
+            PRIMARY KEY (TTHERM_ID, program, clade, version))''')
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, TTHERM_IDs, program, clade, version):
+        """ Returns a dictionary from TTHERM_ID to (input hash, best phrases)
+            for the genes that have been analyzed for program, clade and
+            version.
+        """
+        TTHERM_IDs = list(TTHERM_IDs)
+        found = {}
+        with self._lock:
+            for start in xrange(0, len(TTHERM_IDs), LOOKUP_BATCH_SIZE):
+                batch = TTHERM_IDs[start:start + LOOKUP_BATCH_SIZE]
+                for TTHERM_ID, input_hash, phrases in self._connection.execute(
+                    '''SELECT TTHERM_ID, input_hash, phrases FROM gene_results
+                    WHERE program = ? AND clade = ? AND version = ?
+                    AND TTHERM_ID IN (%s)''' % ','.join('?' * len(batch)),
+                    [program, clade, version] + batch):
+                    found[str(TTHERM_ID)] = (str(input_hash),
+                        dill.loads(zlib.decompress(phrases)))
+
+        return found
+
+    def put_many(self, results, program, clade, version):
+        # results: TTHERM_ID -> (input hash, best phrases)
+        with self._lock:
+            with self._connection:
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO gene_results VALUES (?, ?, ?, ?, ?, ?)',
+                    [(TTHERM_ID, program, clade, version, input_hash,
+                        sqlite3.Binary(zlib.compress(dill.dumps(phrases))))
+                        for TTHERM_ID, (input_hash, phrases) in results.items()])
+
+    def record(self, reused, analyzed):
+        with self._lock:
+            self.hits += reused
+            self.misses += analyzed
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def open_store():
+    # The shared store, opened the first time it is needed
+    global _store
+    with _openLock:
+        if _store is None:
+            _store = GeneResultStore(filename_generator.filename_generator(
+                'local_store', [], storeName = STORE_NAME))
+    return _store
+
+
+def report_reuse():
+    """ Print and log how many of the gene analyses of this run were taken
+        from the store, then start counting afresh for the next run.
+    """
+    if _store is None:
+        return
+
+    total = _store.hits + _store.misses
+    if total > 0:
+        print 'Gene result store: %d of %d gene analyses (%.1f%%) were reused' \
+            % (_store.hits, total, 100.0 * _store.hits / total)
+        logging.info('Gene result store: %d of %d gene analyses (%.1f%%) were reused' \
+            % (_store.hits, total, 100.0 * _store.hits / total))
+
+    _store.hits = 0
+    _store.misses = 0
@@ -0,0 +1,388 @@
+#!/usr/bin/python
+
+"""
+    Coregulation Data Harvester--A tool for organizing and predicting
+    Tetrahymena thermophila gene annotations
+
+    Copyright (C) 2015-2017 Lev M Tsypin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    If you choose to publish research based on this software, or distribute
+    any work containing it, please make a notice of the copyright holder's
+    attribution. If you derivitize or modify the software, please make
+    a note that it is a derived work.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+__author__ = 'Lev Tsypin (Ltsypin@gmail.com)'
+__version__ = '1.2.1'
+
+""" Longest common phrases between homolog definitions, for
+    longest_phrases_in_homologue_info in CoregFilesIO.
+
+    Each definition is normalized once, and gets a suffix automaton, built
+    once no matter how many pairs it is in. The longest common substring of
+    s1 and s2 is then found by running s1 through the automaton of s2, which
+    is linear in the length of s1.
+
+    The answers are the same as difflib.SequenceMatcher(None, s1, s2)
+    .find_longest_match(0, len(s1), 0, len(s2)) gave: the longest match
+    that starts earliest in s1. The one exception is that SequenceMatcher
+    starts treating popular characters of s2 as junk once s2 is
+    DIFFLIB_AUTOJUNK_LENGTH characters or longer, which can shorten its
+    matches, so such pairs still go through difflib to keep the phrase
+    counts identical.
+
+    Homolog definitions repeat a lot once species and gi codes are gone
+    (dozens of 'tubulin alpha chain', say), so collapse_definitions reduces
+    them to the distinct ones, and the pairwise comparisons to the distinct
+    pairs, each with the number of times it came up.
+
+    The phrase of a pair of normalized definitions never changes, so it is
+    cached by content: in memory for the run, where the ortholog, paralog,
+    and mixed analyses (and other genes) find it again, and optionally on
+    disk for later runs.
+"""
+
+# imports
+import re
+import bisect
+import difflib
+import sqlite3
+import hashlib
+import threading
+import filename_generator
+
+# constants
+
+# Everything that isn't alphanumeric, a space, a dash, a forward slash,
+# an equals sign, or parentheses is removed from the definitions
+PUNCTUATION_REGEX = re.compile(r'[^A-Za-z0-9\s\-\/\=\(\)]+')
+
+# SequenceMatcher's autojunk heuristic applies to sequences this long
+DIFFLIB_AUTOJUNK_LENGTH = 200
+
+# The in-memory pair cache is emptied when it grows past this many pairs
+MEMORY_CACHE_LIMIT = 500000
+DISK_CACHE_NAME = 'phrase_pairs'
+LOOKUP_BATCH_SIZE = 500
+
+# Normalized definition pair -> matched phrase, shared by every
+# PhraseMatcher (the ortholog, paralog, and mixed analyses of every gene)
+_pairCache = {}
+# The optional on-disk tier (see open_disk_cache)
+_diskCache = None
+# Pairs matched since the last take_new_pairs, when log_new_pairs is on
+_newPairLog = None
+
+
+def normalize(definition):
+    # Remove punctuation and capitalization that may interfere with
+    # finding common phrases
+    return PUNCTUATION_REGEX.sub('', definition.lower())
+
+
+class SuffixAutomaton:
+    # The smallest automaton that accepts every substring of a string.
+    # State 0 is the initial state; transitions are dictionaries from
+    # character to state.
+
+    def __init__(self, string):
+        self.transitions = [{}]
+        self.links = [-1]
+        self.lengths = [0]
+
+        last = 0
+        for character in string:
+            current = len(self.lengths)
+            self.transitions.append({})
+            self.links.append(0)
+            self.lengths.append(self.lengths[last] + 1)
+
+            state = last
+            while state != -1 and character not in self.transitions[state]:
+                self.transitions[state][character] = current
+                state = self.links[state]
+
+            if state != -1:
+                following = self.transitions[state][character]
+                if self.lengths[state] + 1 == self.lengths[following]:
+                    self.links[current] = following
+                else:
+                    clone = len(self.lengths)
+                    self.transitions.append(dict(self.transitions[following]))
+                    self.links.append(self.links[following])
+                    self.lengths.append(self.lengths[state] + 1)
+                    while state != -1 and \
+                        self.transitions[state].get(character) == following:
+                        self.transitions[state][character] = clone
+                        state = self.links[state]
+                    self.links[following] = clone
+                    self.links[current] = clone
+
+            last = current
+
+    def longest_match(self, string):
+        """ Returns (start, length) of the longest substring of string that
+            is also a substring of the automaton's string, taking the
+            earliest one if there are several.
+        """
+        transitions = self.transitions
+        links = self.links
+        lengths = self.lengths
+
+        state = 0
+        length = 0
+        bestStart = 0
+        bestLength = 0
+        for position, character in enumerate(string):
+            while state and character not in transitions[state]:
+                state = links[state]
+                length = lengths[state]
+
+            if character in transitions[state]:
+                state = transitions[state][character]
+                length += 1
+            else:
+                state = 0
+                length = 0
+
+            # Strictly longer only, so that the earliest match is kept
+            if length > bestLength:
+                bestLength = length
+                bestStart = position - length + 1
+
+        return bestStart, bestLength
+
+
+class PhraseMatcher:
+    # Longest common phrases among one gene's homolog definitions. The
+    # definitions are normalized once, and each distinct one gets its
+    # automaton only once.
+
+    def __init__(self, definitions):
+        self.strings = [normalize(definition) for definition in definitions]
+        self._automata = {}
+        self._newPairs = []
+
+    def _automaton(self, string):
+        if string not in self._automata:
+            self._automata[string] = SuffixAutomaton(string)
+        return self._automata[string]
+
+    def longest_match(self, index1, index2):
+        """ (start, length) of the longest phrase that definitions index1 and
+            index2 have in common, with the start in definition index1, as
+            SequenceMatcher.find_longest_match would give it.
+        """
+        s1 = self.strings[index1]
+        s2 = self.strings[index2]
+
+        if len(s2) >= DIFFLIB_AUTOJUNK_LENGTH:
+            m = difflib.SequenceMatcher(None, s1, s2).find_longest_match(
+                0, len(s1), 0, len(s2))
+            return m[0], m[2]
+
+        if s1 == '' or s2 == '':
+            return 0, 0
+
+        return self._automaton(s2).longest_match(s1)
+
+    def longest_phrase(self, index1, index2):
+        pair = (self.strings[index1], self.strings[index2])
+        # The phrase is held on to here, since another thread (the blastx
+        # and blastp analyses of dictionary_work run side by side) may
+        # clear the cache in between
+        phrase = _pairCache.get(pair)
+        if phrase is None:
+            if len(_pairCache) >= MEMORY_CACHE_LIMIT:
+                _pairCache.clear()
+            start, length = self.longest_match(index1, index2)
+            phrase = self.strings[index1][start:start + length]
+            _pairCache[pair] = phrase
+            self._newPairs.append(pair)
+            if _newPairLog is not None:
+                _newPairLog.append((pair, phrase))
+        return phrase
+
+    def prefetch(self, pairs):
+        """ Bring the phrases of pairs (index1, index2) that are in the
+            on-disk cache into memory, in a few batched lookups.
+        """
+        if _diskCache is None:
+            return
+        _diskCache.load([(self.strings[index1], self.strings[index2])
+            for index1, index2 in pairs
+            if (self.strings[index1], self.strings[index2]) not in _pairCache])
+
+    def flush(self):
+        # Save the phrases computed by this matcher to the on-disk cache
+        if _diskCache is not None and self._newPairs:
+            _diskCache.save([(pair, _pairCache[pair]) for pair in self._newPairs
+                if pair in _pairCache])
+        self._newPairs = []
+
+
+class DiskPairCache:
+    # SQLite table of pair hash -> phrase. The hash is of both normalized
+    # definitions, in order. A readOnly cache only looks phrases up, and
+    # leaves saving them to the process that opened the table.
+
+    def __init__(self, store_address, readOnly = False):
+        self.address = store_address
+        self._readOnly = readOnly
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(store_address,
+            check_same_thread = False)
+        if not readOnly:
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS phrases
+                (pair_hash TEXT PRIMARY KEY, phrase TEXT)''')
+
+    def _hash(self, pair):
+        return hashlib.sha1('%s\x00%s' % (pair[0].encode('utf-8')
+            if isinstance(pair[0], unicode) else pair[0],
+            pair[1].encode('utf-8') if isinstance(pair[1], unicode)
+            else pair[1])).hexdigest()
+
+    def load(self, pairs):
+        # Copy the stored phrases of pairs into the in-memory cache
+        hashedPairs = dict([(self._hash(pair), pair) for pair in pairs])
+        hashes = hashedPairs.keys()
+        with self._lock:
+            for start in xrange(0, len(hashes), LOOKUP_BATCH_SIZE):
+                batch = hashes[start:start + LOOKUP_BATCH_SIZE]
+                for pair_hash, phrase in self._connection.execute(
+                    'SELECT pair_hash, phrase FROM phrases WHERE pair_hash IN (%s)'
+                        % ','.join('?' * len(batch)), batch):
+                    pair = hashedPairs[pair_hash]
+                    _pairCache[pair] = phrase if isinstance(pair[0], unicode) \
+                        else phrase.encode('utf-8')
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def save(self, pairPhrases):
+        if self._readOnly:
+            return
+        with self._lock:
+            with self._connection:
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO phrases VALUES (?, ?)',
+                    [(self._hash(pair), phrase.decode('utf-8')
+                        if not isinstance(phrase, unicode) else phrase)
+                        for pair, phrase in pairPhrases])
+
+
+def open_disk_cache(store_address = None, readOnly = False):
+    """ Turn on the on-disk tier of the pair cache for the rest of the
+        process. store_address defaults to the local store of the phrases.
+    """
+    global _diskCache
+    if _diskCache is None:
+        if store_address is None:
+            store_address = filename_generator.filename_generator(
+                'local_store', [], storeName = DISK_CACHE_NAME)
+        _diskCache = DiskPairCache(store_address, readOnly)
+    return _diskCache
+
+
+def disk_cache_address():
+    # Where the on-disk tier is kept, or None if it is off
+    if _diskCache is None:
+        return None
+    return _diskCache.address
+
+
+def collapse_definitions(definitions):
+    """ Collapse a list of definitions to its distinct definitions, and
+        the pairs (i, j) with i < j that the pairwise comparison goes
+        through to the distinct pairs of definitions. Returns the list of
+        distinct definitions, and a list of (index1, index2, weight) for the
+        pairs, where the indices are into the distinct definitions and
+        weight is how many of the original pairs they stand for. The pairs
+        are in the order in which the pairwise comparison first meets them.
+    """
+    uniqueIndex = {}
+    uniqueDefinitions = []
+    positions = []
+    ids = []
+    for position, definition in enumerate(definitions):
+        if definition not in uniqueIndex:
+            uniqueIndex[definition] = len(uniqueDefinitions)
+            uniqueDefinitions.append(definition)
+            positions.append([])
+        ids.append(uniqueIndex[definition])
+        positions[uniqueIndex[definition]].append(position)
+
+    # Going backwards, count for each position how many times each
+    # distinct definition comes after it
+    followingCounts = [0] * len(uniqueDefinitions)
+    weights = {}
+    for position in xrange(len(ids) - 1, -1, -1):
+        index1 = ids[position]
+        for index2, count in enumerate(followingCounts):
+            if count:
+                weights[(index1, index2)] = weights.get((index1, index2), 0) + count
+        followingCounts[index1] += 1
+
+    def first_meeting(pair):
+        # The pair is first met at the first occurrence of its first
+        # definition, with the next occurrence of its second
+        firstPosition = positions[pair[0]][0]
+        return (firstPosition, positions[pair[1]][
+            bisect.bisect_right(positions[pair[1]], firstPosition)])
+
+    return uniqueDefinitions, [(pair[0], pair[1], weights[pair])
+        for pair in sorted(weights, key = first_meeting)]
+
+
+def close_disk_cache(forget = False):
+    """ Turn the on-disk tier off again. With forget, the connection is
+        dropped without being closed, for processes forked from the one
+        that opened it.
+    """
+    global _diskCache
+    if _diskCache is not None and not forget:
+        _diskCache.close()
+    _diskCache = None
+
+
+def log_new_pairs(on):
+    # Start (or stop) keeping a list of the pairs that get matched
+    global _newPairLog
+    _newPairLog = [] if on else None
+
+
+def take_new_pairs():
+    """ Returns the (pair, phrase) entries matched since the last call, and
+        starts a new list.
+    """
+    global _newPairLog
+    if _newPairLog is None:
+        return []
+    newPairs = _newPairLog
+    _newPairLog = []
+    return newPairs
+
+
+def keep_pairs(pairPhrases):
+    """ Add (pair, phrase) entries matched elsewhere (in a worker process)
+        to the in-memory cache, and to the on-disk cache if it is open.
+    """
+    for pair, phrase in pairPhrases:
+        _pairCache[pair] = phrase
+    if _diskCache is not None and pairPhrases:
+        _diskCache.save(pairPhrases)
@@ -0,0 +1,311 @@
+#!/usr/bin/python
+
+"""
+    Coregulation Data Harvester--A tool for organizing and predicting
+    Tetrahymena thermophila gene annotations
+
+    Copyright (C) 2015-2017 Lev M Tsypin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    If you choose to publish research based on this software, or distribute
+    any work containing it, please make a notice of the copyright holder's
+    attribution. If you derivitize or modify the software, please make
+    a note that it is a derived work.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+__author__ = 'Lev Tsypin (Ltsypin@gmail.com)'
+__version__ = '1.2.1'
+
+""" Precomputed ortholog groups (e.g. from OrthoMCL-DB) as a shortcut around
+    the forward and reciprocal BLASTs for genes that they already cover.
+
+    A downloaded dump is imported once into a local, indexed SQLite store:
+
+        python OrthologGroups.py path/to/dump.txt
+
+    The dump should be tab-separated, one protein per line:
+
+        group ID    protein ID    taxon    description    [relation]
+
+    Protein IDs may carry a taxon prefix ('tthe|TTHERM_00001234'), which is
+    dropped. relation is optional, and is 'ortholog' or 'paralog' relative
+    to the query taxon; without it (or when it is blank), the member is
+    taken as an ortholog. Case, spacing, and common variants such as
+    'Orthologue', 'co-ortholog' or 'inparalog' are accepted (see
+    RELATION_ALIASES). Lines with any other relation are left out, with a
+    warning. Lines starting with '#' are skipped.
+
+    For a covered gene, the homologs are the members of its groups from
+    other taxa, with their descriptions standing in for BLAST hit
+    definitions. They are tagged with SOURCE, so that the report can say
+    where they came from.
+
+    So that the homologs can be kept to the clade of a run (e.g. outside
+    the ciliates), each taxon is placed in the NCBI taxonomy at import (see
+    TaxonomyTree): it may be a taxid ('5911' or 'txid5911') or a name from
+    names.dmp ('Homo sapiens'). In a run restricted to a clade, only the
+    members inside it are used, and a gene with any member that could not
+    be placed is not covered, and gets BLASTed as usual.
+"""
+
+# imports
+import sys
+import os
+import re
+import sqlite3
+import logging
+import filename_generator
+import TaxonomyTree
+
+# constants
+
+SOURCE = 'ortholog groups'
+STORE_NAME = 'ortholog_groups'
+
+# The relations that a dump may give, lower-cased and without spaces,
+# hyphens or underscores, and the homolog quality that each one stands for
+RELATION_ALIASES = {
+    'ortholog': 'ortholog', 'orthologs': 'ortholog',
+    'orthologue': 'ortholog', 'orthologues': 'ortholog',
+    'coortholog': 'ortholog', 'coorthologs': 'ortholog',
+    'paralog': 'paralog', 'paralogs': 'paralog',
+    'paralogue': 'paralog', 'paralogues': 'paralog',
+    'inparalog': 'paralog', 'inparalogs': 'paralog',
+    'outparalog': 'paralog', 'outparalogs': 'paralog'}
+
+
+def normalize_relation(relation):
+    """ The homolog quality ('ortholog' or 'paralog') for a relation from a
+        dump, or None if it is not a known one. A blank relation is an
+        ortholog.
+    """
+    relation = re.sub(r'[\s_\-]', '', relation.lower())
+    if relation == '':
+        return 'ortholog'
+    return RELATION_ALIASES.get(relation)
+
+
+def taxon_taxids(taxa):
+    """ Place the taxa of a dump in the NCBI taxonomy. Returns a dictionary
+        from each taxon that could be placed to its taxid. Taxids are taken
+        as they are; names need the local taxonomy.
+    """
+    taxids = {}
+    names = []
+    for taxon in taxa:
+        txidObj = re.match(r'^(txid)?(\d+)$', taxon, re.IGNORECASE)
+        if txidObj:
+            taxids[taxon] = int(txidObj.group(2))
+        else:
+            names.append(taxon)
+
+    if names:
+        taxonomy = TaxonomyTree.load_taxonomy()
+        if taxonomy is not None:
+            taxids.update(taxonomy.find_taxids(names))
+
+    return taxids
+
+
+class OrthologGroupStore:
+    # The local store of ortholog groups. Members are indexed by protein ID
+    # and by group, so that looking up a gene's homologs is two index
+    # lookups. memberTest restricts the homologs to the clade of the run
+    # (see open_store).
+
+    def __init__(self, store_address, memberTest = None):
+        self._memberTest = memberTest
+        self._connection = sqlite3.connect(store_address)
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS members
+            (group_id TEXT, protein_id TEXT, taxon TEXT, definition TEXT,
+            relation TEXT, taxid INTEGER)''')
+        # Stores imported before members were placed have no taxids, so
+        # none of their genes are covered in restricted runs
+        columns = [row[1] for row in
+            self._connection.execute('PRAGMA table_info(members)')]
+        if 'taxid' not in columns:
+            self._connection.execute(
+                'ALTER TABLE members ADD COLUMN taxid INTEGER')
+        self._connection.execute('''CREATE INDEX IF NOT EXISTS
+            members_by_protein ON members (protein_id)''')
+        self._connection.execute('''CREATE INDEX IF NOT EXISTS
+            members_by_group ON members (group_id)''')
+
+    def import_dump(self, dump_address):
+        """ Load a dump (see the module notes for the format) into the store,
+            replacing whatever was imported before. Returns the number of
+            proteins imported.
+        """
+        unknownRelations = {}
+
+        # The taxa are placed all at once, in a first pass over the dump
+        taxa = set()
+        with open(dump_address, 'rU') as dump_file:
+            for line in dump_file:
+                fields = line.rstrip('\r\n').split('\t')
+                if not line.startswith('#') and len(fields) >= 4 and \
+                    fields[0].lower() != 'group':
+                    taxa.add(fields[2].strip())
+        taxids = taxon_taxids(taxa)
+
+        def rows():
+            with open(dump_address, 'rU') as dump_file:
+                for line in dump_file:
+                    if line.startswith('#') or not line.strip():
+                        continue
+                    fields = line.rstrip('\r\n').split('\t')
+                    if len(fields) < 4 or fields[0].lower() == 'group':
+                        continue
+
+                    group_id, protein_id, taxon, definition = fields[:4]
+                    protein_id = protein_id.split('|')[-1].strip()
+                    if len(fields) > 4:
+                        relation = normalize_relation(fields[4])
+                    else:
+                        relation = 'ortholog'
+
+                    if relation is None:
+                        unknownRelations[fields[4].strip()] = \
+                            unknownRelations.get(fields[4].strip(), 0) + 1
+                        continue
+
+                    yield (group_id.strip(), protein_id, taxon.strip(),
+                        definition.strip(), relation, taxids.get(taxon.strip()))
+
+        with self._connection:
+            self._connection.execute('DELETE FROM members')
+            self._connection.executemany(
+                'INSERT INTO members VALUES (?, ?, ?, ?, ?, ?)', rows())
+
+        unplaced = sorted([taxon for taxon in taxa if taxon not in taxids])
+        if unplaced:
+            print 'Warning: %d taxa could not be placed in the NCBI taxonomy: %s' \
+                % (len(unplaced), ', '.join(unplaced))
+            print 'Genes in their groups will be BLASTed in runs restricted to a clade.'
+            logging.info('%d taxa could not be placed in the NCBI taxonomy: %s' \
+                % (len(unplaced), ', '.join(unplaced)))
+
+        for relation in sorted(unknownRelations):
+            print 'Warning: left out %d proteins with the unknown relation "%s"' \
+                % (unknownRelations[relation], relation)
+            logging.info('Left out %d proteins with the unknown relation "%s"' \
+                % (unknownRelations[relation], relation))
+
+        return self._connection.execute(
+            'SELECT COUNT(*) FROM members').fetchone()[0]
+
+    def covered(self, TTHERM_IDs):
+        # The subset of TTHERM_IDs that belong to at least one group, and
+        # (in a restricted run) whose group members can all be placed
+        covered = set()
+        TTHERM_IDs = list(TTHERM_IDs)
+        for start in xrange(0, len(TTHERM_IDs), 500):
+            batch = TTHERM_IDs[start:start + 500]
+            covered.update([row[0] for row in self._connection.execute(
+                'SELECT DISTINCT protein_id FROM members WHERE protein_id IN (%s)'
+                    % ','.join('?' * len(batch)), batch)])
+
+        if self._memberTest is not None:
+            covered = set([TTHERM_ID for TTHERM_ID in covered
+                if None not in [self._memberTest(row[0]) for row in
+                    self._connection.execute('''SELECT DISTINCT member.taxid
+                    FROM members AS gene JOIN members AS member
+                    ON member.group_id = gene.group_id
+                    AND member.taxon != gene.taxon
+                    WHERE gene.protein_id = ?''', (TTHERM_ID,))]])
+        return covered
+
+    def get_homologs(self, TTHERM_ID):
+        """ Returns the homologs of TTHERM_ID from its groups as a list of
+            [definition, quality, source] lists, in the same form that
+            get_BLAST_homologues_dict builds from the reciprocal BLASTs, or
+            None if the gene is not covered (see covered). In a restricted
+            run, only the members inside the clade are homologs.
+        """
+        groups = self._connection.execute(
+            'SELECT group_id, taxon FROM members WHERE protein_id = ?',
+            (TTHERM_ID,)).fetchall()
+        if groups == []:
+            return None
+
+        homologs = []
+        for group_id, taxon in groups:
+            for definition, relation, taxid in self._connection.execute(
+                '''SELECT definition, relation, taxid FROM members
+                WHERE group_id = ? AND taxon != ?
+                ORDER BY rowid''', (group_id, taxon)):
+                if self._memberTest is not None:
+                    inClade = self._memberTest(taxid)
+                    if inClade is None:
+                        return None
+                    if not inClade:
+                        continue
+                # Stores imported before relations were normalized may
+                # still hold them as they were in the dump
+                quality = normalize_relation(relation)
+                if quality is not None:
+                    homologs.append([definition, quality, SOURCE])
+
+        return homologs
+
+    def close(self):
+        self._connection.close()
+
+
+def open_store(entrez):
+    """ Open the local ortholog group store for a run searching the clade of
+        the entrez query, or return None if nothing has been imported yet,
+        or if the group members cannot be sorted into the clade locally
+        (see TaxonomyTree.clade_test).
+    """
+    store_address = filename_generator.filename_generator(
+        'local_store', [], storeName = STORE_NAME)
+    if not os.path.exists(store_address):
+        print 'No ortholog groups have been imported. Every gene will be BLASTed.'
+        logging.info('No ortholog groups have been imported.')
+        return None
+
+    if entrez.strip() == '(none)':
+        return OrthologGroupStore(store_address)
+
+    taxonomy = TaxonomyTree.load_taxonomy()
+    cladeTest = None
+    if taxonomy is not None:
+        cladeTest = taxonomy.clade_test(entrez)
+    if cladeTest is None:
+        print 'The ortholog groups cannot be sorted into "%s" locally. Every gene will be BLASTed.' \
+            % entrez
+        logging.info('The ortholog groups cannot be sorted into "%s" locally.' % entrez)
+        return None
+
+    # None for members that cannot be placed
+    def memberTest(taxid):
+        if taxid is None or taxid not in taxonomy:
+            return None
+        return cladeTest(taxid)
+
+    return OrthologGroupStore(store_address, memberTest)
+
+
+if (__name__ == '__main__'):
+    if len(sys.argv) != 2:
+        print 'Usage: python OrthologGroups.py path/to/ortholog_group_dump.txt'
+        sys.exit()
+
+    store = OrthologGroupStore(filename_generator.filename_generator(
+        'local_store', [], storeName = STORE_NAME))
+    print 'Imported %d proteins from %s' % (store.import_dump(sys.argv[1]), sys.argv[1])
+    store.close()
@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+"""
+    Coregulation Data Harvester--A tool for organizing and predicting
+    Tetrahymena thermophila gene annotations
+
+    Copyright (C) 2015-2017 Lev M Tsypin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    If you choose to publish research based on this software, or distribute
+    any work containing it, please make a notice of the copyright holder's
+    attribution. If you derivitize or modify the software, please make
+    a note that it is a derived work.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+__author__ = 'Lev Tsypin (Ltsypin@gmail.com)'
+__version__ = '1.2.1'
+
+""" Hands the objects that one stage of a run makes to the next ones in
+    memory, instead of through the disk.
+
+    WebMod, CoregFilesIO and make_CSV used to pass the coregulated gene list,
+    the reciprocal BLAST trees, and the homologue and best phrase
+    dictionaries to each other by writing them to files and reading them
+    back. Objects are now kept here under the address of their file, so
+    whatever would have been read from that address in this run comes from
+    memory, and anything that was not made in this run is still read from
+    disk (and then kept). Writing the files is left to a background thread,
+    so that the next runs, and Dropbox, still get them.
+
+    Objects that are handed over are written some time later, so they must
+    not be changed after dump_pickle or write_tree. Files that may have been
+    handed over are removed and copied with remove_file and copy_file, so
+    that what is kept follows them. flush waits for the writes to finish;
+    at the end of a run, it also drops everything that was kept, so that
+    the next run in the session starts from the disk. It is also run when
+    the program exits.
+"""
+
+# imports
+import os
+import shutil
+import atexit
+import logging
+import threading
+import Queue
+import dill
+
+# Objects made or read in this run, by the absolute address of their file
+_artifacts = {}
+_artifactsLock = threading.Lock()
+
+# Pending writes, as (write function, object, address), and the errors of
+# those that failed since the last flush
+_writeQueue = Queue.Queue()
+_writeErrors = []
+_writer = None
+_writerLock = threading.Lock()
+
+
+def keep(address, obj):
+    # Make obj what is found at address for the rest of the run
+    with _artifactsLock:
+        _artifacts[os.path.abspath(address)] = obj
+
+
+def fetch(address):
+    # The object kept for address in this run, or None
+    with _artifactsLock:
+        return _artifacts.get(os.path.abspath(address))
+
+
+def evict(*addresses):
+    # Stop keeping anything for addresses, which are read from disk again
+    with _artifactsLock:
+        for address in addresses:
+            _artifacts.pop(os.path.abspath(address), None)
+
+
+def remove_file(address):
+    ''' os.remove address, once any pending write to it is done (so that
+        the write does not bring it back), and stop keeping its object.
+    '''
+    _writeQueue.join()
+    evict(address)
+    os.remove(address)
+
+
+def copy_file(src, dst):
+    ''' shutil.copy2 src to dst, once any pending write to src is done. dst
+        then holds whatever was kept for src (or is read from disk).
+    '''
+    _writeQueue.join()
+    shutil.copy2(src, dst)
+    obj = fetch(src)
+    if obj is None:
+        evict(dst)
+    else:
+        keep(dst, obj)
+
+
+def _write_pickle(obj, address):
+    pickle_f = open(address, 'wb')
+    try:
+        dill.dump(obj, pickle_f)
+    finally:
+        pickle_f.close()
+
+
+def _write_tree(tree, address):
+    tree.write(address)
+
+
+def _write_loop():
+    while True:
+        write, obj, address = _writeQueue.get()
+        # The program is exiting
+        if write is None:
+            _writeQueue.task_done()
+            return
+        try:
+            write(obj, address)
+        except Exception as error:
+            print 'Could not write %s: %s' % (address, error)
+            logging.info('Could not write %s: %s' % (address, error))
+            _writeErrors.append((address, error))
+        finally:
+            _writeQueue.task_done()
+
+
+def _schedule(write, obj, address):
+    global _writer
+    with _writerLock:
+        if _writer is None:
+            _writer = threading.Thread(target = _write_loop)
+            _writer.daemon = True
+            _writer.start()
+    _writeQueue.put((write, obj, address))
+
+
+def dump_pickle(obj, *addresses):
+    ''' Keep obj for each of addresses, and dill it to them in the
+        background.
+    '''
+    for address in addresses:
+        keep(address, obj)
+        _schedule(_write_pickle, obj, address)
+
+
+def load_pickle(address):
+    ''' The object kept for address in this run, or else the one dilled
+        there by an earlier run (which is then kept).
+    '''
+    obj = fetch(address)
+    if obj is None:
+        pickle_f = open(address, 'rb')
+        try:
+            obj = dill.load(pickle_f)
+        finally:
+            pickle_f.close()
+        keep(address, obj)
+
+    return obj
+
+
+def write_tree(tree, *addresses):
+    ''' Keep the ElementTree tree for each of addresses, and write it to
+        them in the background.
+    '''
+    for address in addresses:
+        keep(address, tree)
+        _schedule(_write_tree, tree, address)
+
+
+def flush(forget = False):
+    ''' Wait for the pending writes. With forget (at the end of a run), also
+        drop every object that was kept. Raises IOError if any of the writes
+        failed since the last flush.
+    '''
+    _writeQueue.join()
+    if forget:
+        with _artifactsLock:
+            _artifacts.clear()
+    if _writeErrors:
+        failed = [address for address, error in _writeErrors]
+        del _writeErrors[:]
+        raise IOError('Could not write %s' % ', '.join(failed))
+
+
+def _finish():
+    # Write what is left, and stop the writer before the interpreter shuts
+    # down under it. Nobody is left to handle a failed write at exit, so it
+    # is only reported.
+    global _writer
+    try:
+        flush()
+    except IOError as error:
+        print '%s before exiting' % error
+        logging.info('%s before exiting' % error)
+    finally:
+        with _writerLock:
+            if _writer is not None:
+                _writeQueue.put((None, None, None))
+                _writer.join()
+                _writer = None
+
+
+atexit.register(_finish)
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+
+"""
+    Coregulation Data Harvester--A tool for organizing and predicting
+    Tetrahymena thermophila gene annotations
+
+    Copyright (C) 2015-2017 Lev M Tsypin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    If you choose to publish research based on this software, or distribute
+    any work containing it, please make a notice of the copyright holder's
+    attribution. If you derivitize or modify the software, please make
+    a note that it is a derived work.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+__author__ = 'Lev Tsypin (Ltsypin@gmail.com)'
+__version__ = '1.2.1'
+
+""" A persistent local store of homolog protein sequences, so that the
+    same accession (the common actins and tubulins, for example) is only
+    fetched from Entrez once, no matter how many genes or runs hit it.
+
+    Sequences are kept zlib-compressed in an SQLite table keyed by
+    accession, and are looked up a batch at a time. The store keeps count
+    of its hits and misses, which are reported at the end of each run.
+
+    The reciprocal BLAST of a homolog against the Tetrahymena proteome does
+    not change either, until the proteome does. ReciprocalCache keeps the
+    parsed reciprocal hits, keyed by a hash of the sequence and the
+    proteome release they were computed against.
+"""
+
+# imports
+import sqlite3
+import zlib
+import json
+import hashlib
+import logging
+import threading
+import filename_generator
+
+# constants
+
+STORE_NAME = 'homolog_sequences'
+RECIPROCAL_CACHE_NAME = 'reciprocal_hits'
+
+# Number of accessions per lookup query
+LOOKUP_BATCH_SIZE = 500
+
+# The stores are opened once, and shared by every gene in the run
+_store = None
+_reciprocalCache = None
+# The reciprocal search threads, and the blastx and blastp analyses of
+# dictionary_work, may all be the first to ask for a store
+_openLock = threading.Lock()
+
+
+class SequenceStore:
+    # Accession -> compressed sequence. The connection is shared between
+    # threads, so every use of it goes through the lock.
+
+    def __init__(self, store_address):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(store_address,
+            check_same_thread = False)
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS sequences
+            (accession TEXT PRIMARY KEY, sequence BLOB)''')
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, accessions):
+        """ Returns a dictionary from accession to sequence for the
+            accessions that are in the store.
+        """
+        accessions = list(accessions)
+        found = {}
+        with self._lock:
+            for start in xrange(0, len(accessions), LOOKUP_BATCH_SIZE):
+                batch = accessions[start:start + LOOKUP_BATCH_SIZE]
+                for accession, sequence in self._connection.execute(
+                    'SELECT accession, sequence FROM sequences WHERE accession IN (%s)'
+                        % ','.join('?' * len(batch)), batch):
+                    found[accession] = zlib.decompress(sequence)
+
+            self.hits += len(found)
+            self.misses += len(set(accessions)) - len(found)
+
+        return found
+
+    def put_many(self, accessionseqDict):
+        with self._lock:
+            with self._connection:
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO sequences VALUES (?, ?)',
+                    [(accession, sqlite3.Binary(zlib.compress(str(sequence))))
+                        for accession, sequence in accessionseqDict.items()])
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class ReciprocalCache:
+    # (sequence hash, proteome release) -> compressed list of reciprocal
+    # hits as [TTHERM_ID, description, score, e-value]. Shared between threads like
+    # SequenceStore.
+
+    def __init__(self, store_address):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(store_address,
+            check_same_thread = False)
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS reciprocal_hits
+            (sequence_hash TEXT, release TEXT, hits BLOB,
+            PRIMARY KEY (sequence_hash, release))''')
+        self.hits = 0
+        self.misses = 0
+
+    def _hash(self, sequence):
+        return hashlib.sha1(str(sequence).upper()).hexdigest()
+
+    def get(self, sequence, release):
+        """ Returns the cached reciprocal hits of sequence as a list of
+            (TTHERM_ID, description, score, e-value) tuples, or None if it
+            has not been searched against release.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT hits FROM reciprocal_hits WHERE sequence_hash = ? AND release = ?',
+                (self._hash(sequence), release)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        return [tuple([str(field) for field in hit])
+            for hit in json.loads(zlib.decompress(row[0]))]
+
+    def put(self, sequence, release, reciprocalHits):
+        with self._lock:
+            with self._connection:
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO reciprocal_hits VALUES (?, ?, ?)',
+                    (self._hash(sequence), release, sqlite3.Binary(
+                        zlib.compress(json.dumps(reciprocalHits)))))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def open_store():
+    # The shared store for this run, opened the first time it is needed
+    global _store
+    with _openLock:
+        if _store is None:
+            _store = SequenceStore(filename_generator.filename_generator(
+                'local_store', [], storeName = STORE_NAME))
+    return _store
+
+
+def open_reciprocal_cache():
+    # The shared reciprocal cache for this run
+    global _reciprocalCache
+    with _openLock:
+        if _reciprocalCache is None:
+            _reciprocalCache = ReciprocalCache(filename_generator.filename_generator(
+                'local_store', [], storeName = RECIPROCAL_CACHE_NAME))
+    return _reciprocalCache
+
+
+def report_hit_rate():
+    """ Print and log how much of what was asked of the stores in this run
+        was already in them, then start counting afresh for the next run.
+    """
+    for store, description in [(_store, 'Homolog sequence store'),
+        (_reciprocalCache, 'Reciprocal BLAST cache')]:
+        if store is None:
+            continue
+
+        total = store.hits + store.misses
+        if total > 0:
+            print '%s: %d of %d lookups (%.1f%%) were already stored' \
+                % (description, store.hits, total, 100.0 * store.hits / total)
+            logging.info('%s: %d of %d lookups (%.1f%%) were already stored' \
+                % (description, store.hits, total, 100.0 * store.hits / total))
+
+        store.hits = 0
+        store.misses = 0
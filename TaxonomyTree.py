@@ -0,0 +1,259 @@
+#!/usr/bin/python
+
+"""
+    Coregulation Data Harvester--A tool for organizing and predicting
+    Tetrahymena thermophila gene annotations
+
+    Copyright (C) 2015-2017 Lev M Tsypin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    If you choose to publish research based on this software, or distribute
+    any work containing it, please make a notice of the copyright holder's
+    attribution. If you derivitize or modify the software, please make
+    a note that it is a derived work.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+__author__ = 'Lev Tsypin (Ltsypin@gmail.com)'
+__version__ = '1.2.1'
+
+""" A compact, local copy of the NCBI taxonomy, so that BLAST hits from one
+    unrestricted search can be sorted into clades (e.g. ciliates or
+    everything but the ciliates) without asking the NCBI again.
+
+    The tree is built from nodes.dmp in the NCBI taxdump, which the user
+    downloads into the folder given by filename_generator('taxonomy', []).
+    Every taxon gets an interval label from a depth-first walk of the tree:
+    entry is its position in the walk, and last is the largest position
+    among its descendants. A taxon is then inside a clade exactly when its
+    entry falls in the clade's interval, which is a constant-time test.
+    Both labels are kept in flat integer arrays indexed by taxid, and are
+    cached to disk in binary form after the first build.
+"""
+
+# imports
+import os
+import re
+import logging
+from array import array
+import filename_generator
+
+# constants
+
+# taxid of the root of the NCBI taxonomy
+ROOT_TAXID = 1
+
+# Names used in the entrez queries of the master module that the NCBI
+# resolves to a taxon, but that are not in names.dmp under that spelling.
+KNOWN_CLADES = {'ciliata': 5878, 'ciliophora': 5878}
+
+# functions
+
+class TaxonomyTree:
+    # Interval-labelled NCBI taxonomy. entry[taxid] is -1 for taxids that
+    # are not in the taxonomy.
+
+    def __init__(self, entry, last, names_address = None):
+        self._entry = entry
+        self._last = last
+        self._names_address = names_address
+
+    @classmethod
+    def from_taxdump(cls, nodes_address, names_address = None):
+        """ Build the tree from nodes.dmp. Each line looks like
+            'taxid\t|\tparent taxid\t|\trank\t|...'
+        """
+        taxids = array('i')
+        parents = array('i')
+        with open(nodes_address, 'rb') as nodes_file:
+            for line in nodes_file:
+                fields = line.split('\t|\t', 2)
+                taxids.append(int(fields[0]))
+                parents.append(int(fields[1]))
+
+        size = max(taxids) + 1
+
+        # Lay out the children of every taxon next to each other
+        # (offsets[t] to offsets[t + 1] in children), so that the walk
+        # below does not need a list per taxon.
+        offsets = array('i', [0]) * (size + 1)
+        for taxid, parent in zip(taxids, parents):
+            if taxid != parent:
+                offsets[parent + 1] += 1
+        for i in xrange(size):
+            offsets[i + 1] += offsets[i]
+
+        children = array('i', [0]) * len(taxids)
+        fill = array('i', offsets)
+        for taxid, parent in zip(taxids, parents):
+            if taxid != parent:
+                children[fill[parent]] = taxid
+                fill[parent] += 1
+
+        # Depth-first walk from the root, without recursion
+        entry = array('i', [-1]) * size
+        last = array('i', [-1]) * size
+        nextChild = array('i', offsets)
+        position = 0
+        entry[ROOT_TAXID] = position
+        stack = [ROOT_TAXID]
+        while stack:
+            node = stack[-1]
+            if nextChild[node] < offsets[node + 1]:
+                child = children[nextChild[node]]
+                nextChild[node] += 1
+                position += 1
+                entry[child] = position
+                stack.append(child)
+            else:
+                last[node] = position
+                stack.pop()
+
+        return cls(entry, last, names_address)
+
+    @classmethod
+    def load(cls, cache_address, names_address = None):
+        """ Load a tree that was cached with save() """
+        with open(cache_address, 'rb') as cache_file:
+            size = array('i')
+            size.fromfile(cache_file, 1)
+            entry = array('i')
+            entry.fromfile(cache_file, size[0])
+            last = array('i')
+            last.fromfile(cache_file, size[0])
+
+        return cls(entry, last, names_address)
+
+    def save(self, cache_address):
+        with open(cache_address, 'wb') as cache_file:
+            array('i', [len(self._entry)]).tofile(cache_file)
+            self._entry.tofile(cache_file)
+            self._last.tofile(cache_file)
+
+    def __contains__(self, taxid):
+        return 0 <= taxid < len(self._entry) and self._entry[taxid] >= 0
+
+    def is_ancestor(self, ancestor, taxid):
+        """ True if taxid is ancestor or one of its descendants """
+        if taxid not in self or ancestor not in self:
+            return False
+        return self._entry[ancestor] <= self._entry[taxid] <= self._last[ancestor]
+
+    def find_taxid(self, name):
+        """ Look up a taxon name (any name class: scientific name, synonym,
+            etc.) in names.dmp. Returns None if the name is not found.
+        """
+        return self.find_taxids([name]).get(name)
+
+    def find_taxids(self, names):
+        """ find_taxid for many names, with a single pass over names.dmp.
+            Returns a dictionary from each name that was found (as given)
+            to its taxid.
+        """
+        taxids = {}
+        wanted = {}
+        for name in names:
+            key = name.strip().lower()
+            if key in KNOWN_CLADES:
+                taxids[name] = KNOWN_CLADES[key]
+            else:
+                wanted.setdefault(key, []).append(name)
+
+        if wanted == {} or not self._names_address or \
+            not os.path.exists(self._names_address):
+            return taxids
+
+        with open(self._names_address, 'rb') as names_file:
+            for line in names_file:
+                fields = line.split('\t|\t', 2)
+                key = fields[1].lower()
+                if key in wanted:
+                    for name in wanted.pop(key):
+                        taxids[name] = int(fields[0])
+                    if wanted == {}:
+                        break
+
+        return taxids
+
+    def clade_test(self, entrez):
+        """ Turn an entrez query from the master module into a function that
+            takes a taxid and says whether it belongs to the clade. Only
+            simple queries can be translated: '(none)', a single taxon
+            ('Ciliata', 'Opisthokonta[Organism]', 'txid5878[Orgn]'), or
+            NOT a single taxon. For anything else (or for an unknown taxon),
+            None is returned, and the clade has to be searched at the NCBI.
+        """
+        if entrez.strip() == '(none)':
+            return lambda taxid: True
+
+        entrezObj = re.match(
+            r'^\s*(NOT\s+)?([^()\[\]]+?)\s*(\[(Organism|Orgn|ORGN)\])?\s*$',
+            entrez)
+        if not entrezObj:
+            return None
+
+        negate = entrezObj.group(1) is not None
+        name = entrezObj.group(2)
+
+        # Compound queries are beyond this simple translation
+        if re.search(r'\s(AND|OR|NOT)\s', ' %s ' % name):
+            return None
+
+        txidObj = re.match(r'^txid(\d+)$', name, re.IGNORECASE)
+        if txidObj:
+            cladeTaxid = int(txidObj.group(1))
+        else:
+            cladeTaxid = self.find_taxid(name)
+
+        if cladeTaxid is None or cladeTaxid not in self:
+            return None
+
+        # Hits without a known taxid are kept out of restricted clades
+        if negate:
+            return lambda taxid: taxid in self and \
+                not self.is_ancestor(cladeTaxid, taxid)
+        else:
+            return lambda taxid: self.is_ancestor(cladeTaxid, taxid)
+
+
+def load_taxonomy():
+    """ Load the local taxonomy, building (and caching) the compact tree
+        from the NCBI taxdump the first time. Returns None if the taxdump
+        has not been downloaded.
+    """
+    taxonomy_dir_address, taxonomy_cache_address = \
+        filename_generator.filename_generator('taxonomy', [])
+
+    nodes_address = os.path.join(taxonomy_dir_address, 'nodes.dmp')
+    names_address = os.path.join(taxonomy_dir_address, 'names.dmp')
+
+    if os.path.exists(taxonomy_cache_address) and \
+        (not os.path.exists(nodes_address) or
+            os.path.getmtime(taxonomy_cache_address) >= os.path.getmtime(nodes_address)):
+        return TaxonomyTree.load(taxonomy_cache_address, names_address)
+
+    if not os.path.exists(nodes_address):
+        print 'No NCBI taxonomy found. To sort BLAST hits into clades locally,'
+        print 'please download taxdump.tar.gz from the NCBI and extract'
+        print 'nodes.dmp and names.dmp into %s' % taxonomy_dir_address
+        logging.info('No NCBI taxonomy found in %s' % taxonomy_dir_address)
+        return None
+
+    print 'Building the local taxonomy tree. This only happens once...'
+    logging.info('Building the local taxonomy tree from %s' % nodes_address)
+    taxonomy = TaxonomyTree.from_taxdump(nodes_address, names_address)
+    taxonomy.save(taxonomy_cache_address)
+
+    return taxonomy
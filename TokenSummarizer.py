@@ -0,0 +1,251 @@
+#!/usr/bin/python
+
+"""
+    Coregulation Data Harvester--A tool for organizing and predicting
+    Tetrahymena thermophila gene annotations
+
+    Copyright (C) 2015-2017 Lev M Tsypin
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    If you choose to publish research based on this software, or distribute
+    any work containing it, please make a notice of the copyright holder's
+    attribution. If you derivitize or modify the software, please make
+    a note that it is a derived work.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+__author__ = 'Lev Tsypin (Ltsypin@gmail.com)'
+__version__ = '1.2.1'
+
+""" A token-statistics alternative to the pairwise phrase analysis of
+    longest_phrases_in_homologue_info, for genes with hundreds of homologs.
+
+    Instead of finding the longest common substring of every pair of
+    definitions, each normalized definition is split into words, and every
+    run of 1 to MAX_NGRAM words in it (its n-grams) is counted once. The
+    support of an n-gram in a gene is the number of that gene's definitions
+    that contain it. With NumPy and SciPy, the definitions of all genes go
+    into one sparse definition x n-gram matrix, and the supports of every
+    gene come out of a single sparse product; without them, the same counts
+    are made with dictionaries.
+
+    N-grams have to pass the same filter as the pairwise phrases
+    (phrase_passes_filter in CoregFilesIO). Of those, the most common
+    phrase of a gene is the one with the highest support (the one with more
+    words, then more letters, then the alphabetically first, on ties), and the longest phrase is the
+    longest one shared by at least two definitions. The result is in the
+    form that get_best_reciprocal_longest_matches gives: gene -> [most
+    common phrase, longest phrase].
+"""
+
+# imports
+import logging
+import LongestPhrases
+
+# NumPy and SciPy are optional: without them, the counts are made in pure
+# Python, which gives the same phrases, only more slowly
+try:
+    import numpy
+    import scipy.sparse
+    HAVE_SCIPY = True
+except ImportError:
+    HAVE_SCIPY = False
+
+# constants
+
+# The longest runs of words that are counted
+MAX_NGRAM = 6
+# An n-gram has to be in this many definitions to be the longest phrase
+LONGEST_MIN_SUPPORT = 2
+# Definitions that are left out of the rescue when no n-gram passes the
+# filter, as in longest_phrases_in_homologue_info
+RESCUE_EXCLUDED = ['predicted protein '*3, 'unnamed protein product '*3,
+    'uncharacterized protein '*3]
+
+
+def definition_ngrams(definition):
+    # The distinct runs of 1 to MAX_NGRAM words of the normalized definition
+    words = LongestPhrases.normalize(definition).split()
+    ngrams = set()
+    for size in xrange(1, min(MAX_NGRAM, len(words)) + 1):
+        for start in xrange(len(words) - size + 1):
+            ngrams.add(' '.join(words[start:start + size]))
+
+    return ngrams
+
+
+def rescue_phrases(definitions):
+    ''' When no n-gram of a gene passes the filter, fall back on its
+        definitions that do not say 'hypothetical protein', as
+        longest_phrases_in_homologue_info does, and pick among them.
+    '''
+    counts = {}
+    for string in definitions:
+        if 'hypothetical protein' not in string and\
+            not [excluded for excluded in RESCUE_EXCLUDED if string in excluded]:
+            phrase = string.lower().strip(' -=/')
+            counts[phrase] = counts.get(phrase, 0) + 1
+
+    if not counts:
+        return [0, 0]
+
+    return [max(counts, key = lambda phrase: counts[phrase]),
+        max(counts, key = len)]
+
+
+def count_supports_sparse(genes, vocabulary):
+    ''' The n-gram supports of each of the genes [(key, definitions)], from
+        one sparse product: a gene x definition indicator matrix times a
+        binary definition x n-gram matrix. Returns the gene x n-gram
+        support matrix, in CSR form.
+    '''
+    definitionRows = []
+    ngramColumns = []
+    geneColumns = []
+    row = 0
+    for geneIndex, (key, definitions) in enumerate(genes):
+        for definition in definitions:
+            for ngram in definition_ngrams(definition):
+                definitionRows.append(row)
+                ngramColumns.append(vocabulary.setdefault(ngram, len(vocabulary)))
+            geneColumns.append(geneIndex)
+            row += 1
+
+    ngramMatrix = scipy.sparse.csr_matrix(
+        (numpy.ones(len(definitionRows), dtype = numpy.int32),
+        (definitionRows, ngramColumns)), shape = (row, len(vocabulary)))
+    geneMatrix = scipy.sparse.csr_matrix(
+        (numpy.ones(row, dtype = numpy.int32),
+        (geneColumns, numpy.arange(row))), shape = (len(genes), row))
+
+    return geneMatrix.dot(ngramMatrix).tocsr()
+
+
+def best_phrases_sparse(genes, phraseFilter):
+    vocabulary = {}
+    supportMatrix = count_supports_sparse(genes, vocabulary)
+
+    # Per n-gram properties, as arrays over the vocabulary
+    ngrams = [None] * len(vocabulary)
+    for ngram, column in vocabulary.iteritems():
+        ngrams[column] = ngram
+    passes = numpy.array([bool(phraseFilter(ngram)) for ngram in ngrams],
+        dtype = bool)
+    letterCounts = numpy.array([len(ngram) for ngram in ngrams], dtype = numpy.int32)
+    wordCounts = numpy.array([ngram.count(' ') + 1 for ngram in ngrams],
+        dtype = numpy.int32)
+    # Last ties are broken alphabetically, so that the phrases do not
+    # depend on the order the n-grams were met in
+    alphabeticalRanks = numpy.empty(len(ngrams), dtype = numpy.int32)
+    alphabeticalRanks[sorted(xrange(len(ngrams)), key = ngrams.__getitem__)] = \
+        numpy.arange(len(ngrams))
+
+    bestPhraseDict = {}
+    for geneIndex, (key, definitions) in enumerate(genes):
+        start = supportMatrix.indptr[geneIndex]
+        end = supportMatrix.indptr[geneIndex + 1]
+        columns = supportMatrix.indices[start:end]
+        supports = supportMatrix.data[start:end]
+
+        kept = passes[columns]
+        columns = columns[kept]
+        supports = supports[kept]
+        if not len(columns):
+            bestPhraseDict[key] = rescue_phrases(definitions)
+            continue
+
+        # lexsort sorts by its last key first
+        best = columns[numpy.lexsort((-alphabeticalRanks[columns],
+            letterCounts[columns], wordCounts[columns], supports))[-1]]
+
+        shared = columns[supports >= LONGEST_MIN_SUPPORT]
+        if not len(shared):
+            shared = columns
+        longest = shared[numpy.lexsort((-alphabeticalRanks[shared],
+            letterCounts[shared]))[-1]]
+
+        bestPhraseDict[key] = [ngrams[best], ngrams[longest]]
+
+    return bestPhraseDict
+
+
+def best_phrases_python(genes, phraseFilter):
+    bestPhraseDict = {}
+    filterCache = {}
+    for key, definitions in genes:
+        supports = {}
+        for definition in definitions:
+            for ngram in definition_ngrams(definition):
+                supports[ngram] = supports.get(ngram, 0) + 1
+
+        for ngram in supports.keys():
+            if ngram not in filterCache:
+                filterCache[ngram] = bool(phraseFilter(ngram))
+            if not filterCache[ngram]:
+                del supports[ngram]
+
+        if not supports:
+            bestPhraseDict[key] = rescue_phrases(definitions)
+            continue
+
+        best = min(supports, key = lambda ngram: (-supports[ngram],
+            -ngram.count(' '), -len(ngram), ngram))
+
+        shared = [ngram for ngram in supports
+            if supports[ngram] >= LONGEST_MIN_SUPPORT] or supports.keys()
+        longest = min(shared, key = lambda ngram: (-len(ngram), ngram))
+
+        bestPhraseDict[key] = [best, longest]
+
+    return bestPhraseDict
+
+
+def best_phrases_by_tokens(homologue_dict, phraseFilter):
+    ''' The token-statistics counterpart of running
+        longest_phrases_in_homologue_info and then
+        get_best_reciprocal_longest_matches on homologue_dict (gene ->
+        list of definitions). phraseFilter is the stop-phrase filter that
+        n-grams have to pass.
+    '''
+    bestPhraseDict = {}
+    genes = []
+    for key in homologue_dict:
+        definitions = homologue_dict[key]
+        if len(definitions) == 0:
+            bestPhraseDict[key] = [0, 0]
+        # With one homolog, there is nothing to count: its definition is
+        # the phrase, as in longest_phrases_in_homologue_info
+        elif len(definitions) == 1:
+            phrase = LongestPhrases.normalize(definitions[0])
+            bestPhraseDict[key] = [phrase, phrase]
+        else:
+            genes.append((key, definitions))
+
+    if genes:
+        if HAVE_SCIPY:
+            bestPhraseDict.update(best_phrases_sparse(genes, phraseFilter))
+        else:
+            bestPhraseDict.update(best_phrases_python(genes, phraseFilter))
+
+    return bestPhraseDict
+
+
+def report_engine():
+    if HAVE_SCIPY:
+        message = 'Summarizing homolog definitions by token statistics (NumPy/SciPy)'
+    else:
+        message = 'Summarizing homolog definitions by token statistics (NumPy/SciPy not found; using pure Python)'
+    print message
+    logging.info(message)
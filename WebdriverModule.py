@@ -71,6 +71,7 @@ import re
 # from Bio.Blast import NCBIWWW
 import dill
 import filename_generator
+import RunContext
 
 if platform.system() == 'Windows':
     from win32com.shell import shell, shellcon
@@ -554,7 +555,7 @@ def coreg_intersection(list_of_coreg_lists):
 ################ Driving the web searches and forward blasts ##############
 
 def WebMod(formatted_TTHERM_ID_list, threshold, owOption, 
-    syncOption, blastOption, entrez, clade):
+    syncOption, blastOption, entrez, clade, runOptions = None):
     """ Takes searchInput (formatted_TTHERM_ID_list) and threshold (the lower-bound for
         z-scores that we are interested in), as well as the user-defined 
         (in the CoregulationDataHarvester Module) overwrite option (owOption),
@@ -562,7 +563,8 @@ def WebMod(formatted_TTHERM_ID_list, threshold, owOption,
         entrez coded (entrez), and phrase for file naming (clade).
         Makes sure that everything is formatted properly.
 
-        Runs get_coregs_zscores_list, append_cDNA_TGD_FGD, and NCBI_qBLAST
+        Runs get_coregs_zscores_list, append_cDNA_TGD_FGD, and NCBI_qBLAST.
+        runOptions (optional search strategies) is passed on to NCBI_qBLAST.
         
     """
     pickle_address, drop_pickle_address = filename_generator.filename_generator('coregs_zscores', formatted_TTHERM_ID_list)
@@ -614,29 +616,20 @@ def WebMod(formatted_TTHERM_ID_list, threshold, owOption,
         coregs_zscores_cDNA_list = coreg_intersection(list_of_coreg_lists)
         # Write both to Dropbox and locally
         if syncOption == 1:
-            drop_pickle_f = open(drop_pickle_address, 'wb')
-            dill.dump(coregs_zscores_cDNA_list, drop_pickle_f)
-            drop_pickle_f.close()
-
-            pickle_f = open(pickle_address, 'wb')
-            dill.dump(coregs_zscores_cDNA_list, pickle_f)
-            pickle_f.close()         
+            RunContext.dump_pickle(coregs_zscores_cDNA_list, drop_pickle_address,
+                pickle_address)
 
         # Write only to Dropbox
         elif syncOption == 2:
-            drop_pickle_f = open(drop_pickle_address, 'wb')
-            dill.dump(coregs_zscores_cDNA_list, drop_pickle_f)
-            drop_pickle_f.close()
+            RunContext.dump_pickle(coregs_zscores_cDNA_list, drop_pickle_address)
 
         # Write only locally
         elif syncOption == 3:
-            pickle_f = open(pickle_address, 'wb')
-            dill.dump(coregs_zscores_cDNA_list, pickle_f)
-            pickle_f.close()
+            RunContext.dump_pickle(coregs_zscores_cDNA_list, pickle_address)
 
         BLASTmod.NCBI_qBLAST(
             coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption, 
-            blastOption, syncOption, entrez, clade, threshold)
+            blastOption, syncOption, entrez, clade, threshold, runOptions)
 
 
     # In this case might only need to overwrite BLAST searches
@@ -680,24 +673,17 @@ def WebMod(formatted_TTHERM_ID_list, threshold, owOption,
 
                     # Write both to Dropbox and locally
                     if syncOption == 1:
-                        drop_pickle_f = open(drop_pickle_address, 'wb')
-                        dill.dump(coregs_zscores_cDNA_list, drop_pickle_f)
-                        drop_pickle_f.close()
-
-                        pickle_f = open(pickle_address, 'wb')
-                        dill.dump(coregs_zscores_cDNA_list, pickle_f)
-                        pickle_f.close()         
+                        RunContext.dump_pickle(coregs_zscores_cDNA_list, drop_pickle_address,
+                            pickle_address)
 
                     # Write only to Dropbox
                     elif syncOption == 2:
-                        drop_pickle_f = open(drop_pickle_address, 'wb')
-                        dill.dump(coregs_zscores_cDNA_list, drop_pickle_f)
-                        drop_pickle_f.close()
+                        RunContext.dump_pickle(coregs_zscores_cDNA_list, drop_pickle_address)
 
 
                     BLASTmod.NCBI_qBLAST(
                         coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption, 
-                        blastOption, syncOption, entrez, clade, threshold)
+                        blastOption, syncOption, entrez, clade, threshold, runOptions)
 
                 elif contChoice == 'n':
                     print
@@ -715,17 +701,16 @@ def WebMod(formatted_TTHERM_ID_list, threshold, owOption,
                 
                 src = drop_pickle_address
                 dst = pickle_address
-                shutil.copy2(src, dst)
+                RunContext.copy_file(src, dst)
 
                 print 'Initializing using the FGD/TGD search stored in Dropbox'
                 logging.info('Initializing using the FGD/TGD search stored in Dropbox')
                 print
-                coregs_zscores_cDNA_list_file = open(drop_pickle_address, 'rb')
-                coregs_zscores_cDNA_list = dill.load(
-                    coregs_zscores_cDNA_list_file)
-                coregs_zscores_cDNA_list_file.close()
+                coregs_zscores_cDNA_list = RunContext.load_pickle(drop_pickle_address)
+                # The local copy is now the same as the Dropbox one
+                RunContext.keep(pickle_address, coregs_zscores_cDNA_list)
                 BLASTmod.NCBI_qBLAST(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption, 
-                    blastOption, syncOption, entrez, clade, threshold)
+                    blastOption, syncOption, entrez, clade, threshold, runOptions)
                 
             
             # Case when needed file is present locally, but not in Dropbox:
@@ -739,18 +724,15 @@ def WebMod(formatted_TTHERM_ID_list, threshold, owOption,
                 logging.info('Writing FGD/TGD search from local directory to Dropbox')
                 src = pickle_address
                 dst = drop_pickle_address
-                shutil.copy2(src, dst)
+                RunContext.copy_file(src, dst)
 
                 print 'Initializing using the FGD/TGD search stored locally'
                 logging.info('Initializing using the FGD/TGD search stored locally')
                 print
-                coregs_zscores_cDNA_list_file = open(pickle_address, 'rb')
-                coregs_zscores_cDNA_list = dill.load(
-                    coregs_zscores_cDNA_list_file)
-                coregs_zscores_cDNA_list_file.close()
+                coregs_zscores_cDNA_list = RunContext.load_pickle(pickle_address)
 
                 BLASTmod.NCBI_qBLAST(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption, 
-                    blastOption, syncOption, entrez, clade, threshold)
+                    blastOption, syncOption, entrez, clade, threshold, runOptions)
 
             # Case when the needed file is present both locally and in Dropbox
             # Here, because I would rather every file be synchronized than
@@ -765,17 +747,16 @@ def WebMod(formatted_TTHERM_ID_list, threshold, owOption,
                 logging.info('Writing FGD/TGD search from Dropbox to local directory')
                 src = drop_pickle_address
                 dst = pickle_address
-                shutil.copy2(src, dst)
+                RunContext.copy_file(src, dst)
 
                 print 'Initializing using the FGD/TGD search stored in Dropbox'
                 logging.info('Initializing using the FGD/TGD search stored in Dropbox')
                 print
-                coregs_zscores_cDNA_list_file = open(drop_pickle_address, 'rb')
-                coregs_zscores_cDNA_list = dill.load(
-                    coregs_zscores_cDNA_list_file)
-                coregs_zscores_cDNA_list_file.close()
+                coregs_zscores_cDNA_list = RunContext.load_pickle(drop_pickle_address)
+                # The local copy is now the same as the Dropbox one
+                RunContext.keep(pickle_address, coregs_zscores_cDNA_list)
                 BLASTmod.NCBI_qBLAST(coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption, 
-                    blastOption, syncOption, entrez, clade, threshold)
+                    blastOption, syncOption, entrez, clade, threshold, runOptions)
 
 
         # Here the user wants to run the program locally. This is just as it
@@ -808,13 +789,11 @@ def WebMod(formatted_TTHERM_ID_list, threshold, owOption,
                     coregs_zscores_cDNA_list = coreg_intersection(list_of_coreg_lists)
 
                     # Write only locally
-                    pickle_f = open(pickle_address, 'wb')
-                    dill.dump(coregs_zscores_cDNA_list, pickle_f)
-                    pickle_f.close()
+                    RunContext.dump_pickle(coregs_zscores_cDNA_list, pickle_address)
                     # pdb.set_trace()
                     BLASTmod.NCBI_qBLAST(
                         coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption, 
-                        blastOption, syncOption, entrez, clade, threshold)
+                        blastOption, syncOption, entrez, clade, threshold, runOptions)
 
                 elif contChoice == 'n':
                     print
@@ -822,13 +801,10 @@ def WebMod(formatted_TTHERM_ID_list, threshold, owOption,
             else:
                 # print 'should redo the NCBI blasts'
                 # pdb.set_trace()
-                coregs_zscores_cDNA_list_file = open(pickle_address, 'rb')
-                coregs_zscores_cDNA_list = dill.load(
-                    coregs_zscores_cDNA_list_file)
-                coregs_zscores_cDNA_list_file.close()
+                coregs_zscores_cDNA_list = RunContext.load_pickle(pickle_address)
                 BLASTmod.NCBI_qBLAST(
                     coregs_zscores_cDNA_list, formatted_TTHERM_ID_list, owOption, 
-                    blastOption, syncOption, entrez, clade, threshold)
+                    blastOption, syncOption, entrez, clade, threshold, runOptions)
 
     elif owOption == 5:
         print 'FGD/TGD search initialized with query:', formatted_TTHERM_ID_list
@@ -847,25 +823,16 @@ def WebMod(formatted_TTHERM_ID_list, threshold, owOption,
 
         # Write both to Dropbox and locally
         if syncOption == 1:
-            drop_pickle_f = open(drop_pickle_address, 'wb')
-            dill.dump(coregs_zscores_cDNA_list, drop_pickle_f)
-            drop_pickle_f.close()
-
-            pickle_f = open(pickle_address, 'wb')
-            dill.dump(coregs_zscores_cDNA_list, pickle_f)
-            pickle_f.close()         
+            RunContext.dump_pickle(coregs_zscores_cDNA_list, drop_pickle_address,
+                pickle_address)
 
         # Write only to Dropbox
         elif syncOption == 2:
-            drop_pickle_f = open(drop_pickle_address, 'wb')
-            dill.dump(coregs_zscores_cDNA_list, drop_pickle_f)
-            drop_pickle_f.close()
+            RunContext.dump_pickle(coregs_zscores_cDNA_list, drop_pickle_address)
 
         # Write only locally
         elif syncOption == 3:
-            pickle_f = open(pickle_address, 'wb')
-            dill.dump(coregs_zscores_cDNA_list, pickle_f)
-            pickle_f.close()
+            RunContext.dump_pickle(coregs_zscores_cDNA_list, pickle_address)
 
     return
 
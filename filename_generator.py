@@ -33,15 +33,21 @@ if platform.system() == 'Windows':
     from win32com.shell import shell, shellcon
 
 
-def filename_generator(mode, formatted_TTHERM_ID_list, clade = '', blastOption = '', threshold = ''):
+def filename_generator(mode, formatted_TTHERM_ID_list, clade = '', blastOption = '', threshold = '',
+    storeName = ''):
     '''
     mode is the sort of file address that you want to get out. Options:
     mode = 'coregs_zscores'
     mode = 'blast'
+    mode = 'derivation_source'
     mode = 'csv'
     mode = 'best_phrase_dict'
     mode = 'homologue_dict'
     mode = 'log'
+    mode = 'taxonomy'
+    mode = 'families'
+    mode = 'local_store' (with storeName)
+    mode = 'hsp_comparison'
     '''
     # Filenames will include all the TTHERMs that went into making them
     TTHERM_ID = '_'.join(formatted_TTHERM_ID_list)
@@ -199,6 +205,14 @@ def filename_generator(mode, formatted_TTHERM_ID_list, clade = '', blastOption =
 
         return blast_address, drop_blast_address, reciprocal_blast_address, drop_reciprocal_blast_address
 
+    # The unrestricted search that clades are derived from locally asks for
+    # more hits than an ordinary search, so it must not be mistaken for the
+    # clade 'all' results (or the other way around). Same folders and
+    # return values as mode = 'blast'.
+    elif mode == 'derivation_source':
+        return filename_generator('blast', formatted_TTHERM_ID_list,
+            clade = 'derivationSource', blastOption = blastOption)
+
     elif mode == 'csv':
         # Get csv file adresses
         if platform.system() == 'Darwin':
@@ -233,6 +247,30 @@ def filename_generator(mode, formatted_TTHERM_ID_list, clade = '', blastOption =
 
         return csv_address
 
+    elif mode == 'hsp_comparison':
+        # Report comparing HSP-subject reciprocal queries to full sequences
+        if platform.system() == 'Darwin':
+            ######### MAC DISTRO #############
+            csv_dir_address = os.path.expanduser(
+                r'~/Documents/CoregulationDataHarvester/csvFiles')
+
+        elif platform.system() == 'Windows':
+            ######### WIN DISTRO #############
+            csv_dir_address = os.path.join(
+                shell.SHGetFolderPath(0, shellcon.CSIDL_PERSONAL, None, 0),
+                r'CoregulationDataHarvester/csvFiles')
+
+        elif platform.system() == 'Linux':
+            ########## UNIX DISTRO ############
+            csv_dir_address = os.path.abspath(r'csvFiles')
+
+        if not os.path.exists(csv_dir_address):
+            os.makedirs(csv_dir_address)
+
+        return os.path.join(csv_dir_address,
+            r'hsp_comparison_for_%s_%s_%s_%s.csv' \
+                % (TTHERM_ID, clade, blastOption, threshold))
+
     elif mode == 'best_phrase_dict':
         # NOTE: RIGHT NOW DICTIONARY WORK AND MAKE CSV USE DIFFERENT NOTATIONS WITH THESE FILES
         if platform.system() == 'Darwin':
@@ -305,6 +343,54 @@ def filename_generator(mode, formatted_TTHERM_ID_list, clade = '', blastOption =
 
         return p_homodict_pickle_address, x_homodict_pickle_address
 
+    elif mode == 'families':
+        # Gene families used by the family-representative search mode
+        if platform.system() == 'Darwin':
+            ######## MAC DISTRO ##############
+            families_address = os.path.expanduser(
+                r'~/Library/CoregulationDataHarvester/pickledData/'\
+                'gene_families_for_%s_%s.p' % (TTHERM_ID, threshold))
+
+        elif platform.system() == 'Windows':
+            ######## WIN DISTRO ##############
+            families_address = os.path.join(
+                shell.SHGetFolderPath(0, shellcon.CSIDL_LOCAL_APPDATA, None, 0),
+                r'CoregulationDataHarvester/pickledData/',
+                r'gene_families_for_%s_%s.p' % (TTHERM_ID, threshold))
+
+        elif platform.system() == 'Linux':
+            ######## UNIX DISTRO #############
+            families_address = os.path.abspath(
+                r'pickledData/gene_families_for_%s_%s.p' % (TTHERM_ID, threshold))
+
+        if not os.path.exists(os.path.dirname(families_address)):
+            os.makedirs(os.path.dirname(families_address))
+
+        return families_address
+
+    elif mode == 'local_store':
+        # Local databases (ortholog groups, caches) that are shared by all
+        # queries. storeName says which one.
+        if platform.system() == 'Darwin':
+            ######## MAC DISTRO ##############
+            store_dir_address = os.path.expanduser(
+                r'~/Library/CoregulationDataHarvester/localStores/')
+
+        elif platform.system() == 'Windows':
+            ######## WIN DISTRO ##############
+            store_dir_address = os.path.join(
+                shell.SHGetFolderPath(0, shellcon.CSIDL_LOCAL_APPDATA, None, 0),
+                r'CoregulationDataHarvester/localStores/')
+
+        elif platform.system() == 'Linux':
+            ######## UNIX DISTRO #############
+            store_dir_address = os.path.abspath(r'localStores/')
+
+        if not os.path.exists(store_dir_address):
+            os.makedirs(store_dir_address)
+
+        return os.path.join(store_dir_address, r'%s.sqlite' % storeName)
+
     elif mode == 'log':
         log_dir = os.path.abspath('./CDH_logs')
         log_address = os.path.join(log_dir, '{}.log'.format(TTHERM_ID))
@@ -314,5 +400,32 @@ def filename_generator(mode, formatted_TTHERM_ID_list, clade = '', blastOption =
 
         return log_address
 
+    elif mode == 'taxonomy':
+        # The NCBI taxonomy dump (nodes.dmp and names.dmp from taxdump.tar.gz)
+        # goes into this folder. The compact tree built from it is cached
+        # next to it.
+        if platform.system() == 'Darwin':
+            ######## MAC DISTRO ##############
+            taxonomy_dir_address = os.path.expanduser(
+                r'~/Library/CoregulationDataHarvester/taxonomy/')
+
+        elif platform.system() == 'Windows':
+            ######## WIN DISTRO ##############
+            taxonomy_dir_address = os.path.join(
+                shell.SHGetFolderPath(0, shellcon.CSIDL_LOCAL_APPDATA, None, 0),
+                r'CoregulationDataHarvester/taxonomy/')
+
+        elif platform.system() == 'Linux':
+            ######## UNIX DISTRO #############
+            taxonomy_dir_address = os.path.abspath(r'taxonomy/')
+
+        if not os.path.exists(taxonomy_dir_address):
+            os.makedirs(taxonomy_dir_address)
+
+        taxonomy_cache_address = os.path.join(taxonomy_dir_address,
+            r'taxonomy_tree.bin')
+
+        return taxonomy_dir_address, taxonomy_cache_address
+
 
 